@@ -0,0 +1,300 @@
+"""HDS downloader running on an asyncio event loop
+
+Unlike hds.fetch(), which blocks a thread for each download, fetch() here
+is a coroutine, so one event loop can run many downloads at once, sharing
+an HttpSession. The manifest, bootstrap and fragment parsing is done by
+the "hds" module. Each fragment is downloaded into memory before it is
+converted, and at most "prefetch" fragments are held for each download.
+Downloads are not resumed. Requires Python 3.5."""
+
+import asyncio
+import http.client
+from urllib.parse import urljoin, urlsplit
+from urllib.error import HTTPError
+from io import BytesIO
+from collections import deque
+from itertools import islice
+from sys import stderr
+from . import hds
+from . import config
+from .utils import CounterWriter, ContentTypeError
+
+async def fetch(*pos, dest_file, session=None, frontend=None, player=None,
+prefetch=4, bitrate="highest", max_bitrate=None, **kw):
+    """Download an HDS stream to an FLV file
+    
+    If "session" is not given, a new HttpSession is used for just this
+    download. The "bitrate" policy may be "highest" or "lowest"; see
+    hds.choose_rendition()."""
+    if session is None:
+        session = HttpSession()
+        try:
+            return await fetch(*pos, dest_file=dest_file, session=session,
+                frontend=frontend, player=player, prefetch=prefetch,
+                bitrate=bitrate, max_bitrate=max_bitrate, **kw)
+        finally:
+            session.close()
+    
+    url = hds.manifest_url(*pos, **kw)
+    manifest = await get_manifest(url, session)
+    children = dict()
+    for media in manifest["media"]:
+        if media.get("href") is not None:
+            child = hds.child_manifest_url(manifest, media)
+            children[child] = await get_manifest(child, session)
+    renditions = hds.get_renditions(manifest, None, player, children)
+    rendition = hds.choose_rendition(renditions, bitrate, max_bitrate)
+    media = rendition["media"]
+    url = rendition["url"]
+    player = rendition["player"]
+    
+    bootstrap = await get_bootstrap(media,
+        session=session, url=url, player=player)
+    media_url = hds.get_media_url(url, media, bootstrap)
+    duration = hds.stream_duration(rendition["manifest"], media, bootstrap)
+    
+    flv = CounterWriter(dest_file)
+    hds.progress_update(frontend, flv, 0, duration)
+    frags = iter(hds.new_flv(flv, metadata=media.get("metadata"),
+        bootstrap=bootstrap))
+    
+    table = bootstrap["frag_runs"]
+    next_index = table["frag_index"][-1] + table["span"][-1]
+    pending = deque()
+    strip_headers = False
+    try:
+        while True:
+            for (index, seg, frag) in islice(frags, prefetch - len(pending)):
+                download = get_frag(session, media_url, seg, frag, player)
+                pending.append(asyncio.ensure_future(download))
+                next_index = index + 1
+            
+            if not pending:
+                if (not bootstrap["live"] or
+                hds.bootstrap_url(media, url) is None):
+                    break
+                interval = table["duration"][-1]
+                interval /= bootstrap["frag_timescale"] * 1000
+                await asyncio.sleep(interval)
+                await get_bootstrap(media, session=session, url=url,
+                    player=player, update=bootstrap)
+                frags = hds.frags_from(bootstrap, next_index)
+                continue
+            
+            data = await pending.popleft()
+            parser = hds.frag_to_flv(BytesIO(data), flv,
+                strip_headers=strip_headers,
+                frontend=frontend, duration=duration)
+            next(parser)  # First FLV tag
+            next(parser)  # End of fragment
+            timestamp = next(parser)  # Write to FLV
+            strip_headers = True
+            if bootstrap["live"]:
+                latency = hds.live_latency(bootstrap, timestamp)
+                hds.progress_update(frontend, flv, timestamp / 1000,
+                    duration, latency=latency)
+    finally:
+        for download in pending:
+            download.cancel()
+    
+    if not frontend:
+        print(file=stderr)
+
+async def get_manifest(url, session):
+    """Coroutine version of hds.get_manifest()"""
+    response = await session.get(url, ("video/f4m",))
+    return hds.parse_manifest(BytesIO(response.body), url)
+
+async def get_bootstrap(media, *, session, url, player="", update=None):
+    """Coroutine version of hds.get_bootstrap()"""
+    bsurl = hds.bootstrap_url(media, url, player)
+    if bsurl is not None:
+        response = await session.get(bsurl, ("video/abst",))
+        bootstrap = response.body
+    else:
+        bootstrap = media["bootstrapInfo"]["data"]
+    return hds.parse_bootstrap(BytesIO(bootstrap), update)
+
+async def get_frag(session, url, seg, frag, player="", *,
+retries=None, delay=None):
+    """Download a whole fragment, retrying after errors and stalls"""
+    if retries is None:
+        retries = config.hds_retries
+    if delay is None:
+        delay = config.hds_retry_delay
+    url = "{}Seg{}-Frag{}".format(url, seg, frag)
+    url = urljoin(url, player)
+    attempt = 0
+    while True:
+        try:
+            response = await session.get(url, ("video/f4f",))
+            return response.body
+        except (EnvironmentError, EOFError, http.client.HTTPException,
+        asyncio.TimeoutError) as err:
+            if isinstance(err, HTTPError) and err.code < 500:
+                raise  # Retrying is not likely to help
+            if attempt >= retries:
+                raise
+            print("Retrying fragment after {!r}".format(err), file=stderr)
+        await asyncio.sleep(delay * 2 ** attempt)
+        attempt += 1
+
+class HttpSession:
+    """Minimal HTTP/1.1 client, keeping connections open between requests
+    
+    Only GET requests are supported, and whole response bodies are read
+    into memory. At most "per_host" requests are made to each host at
+    once. The "timeout" applies to each read from the connection, and
+    defaults to "config.http_timeout"."""
+    
+    def __init__(self, *, per_host=8, timeout=None):
+        if timeout is None:
+            timeout = config.http_timeout
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = dict()  # (scheme, host, port) -> [(reader, writer), ...]
+        self.limits = dict()  # (scheme, host, port) -> Semaphore
+    
+    async def get(self, url, types=None, *, headers=dict(), redirects=5):
+        """Returns a Response object, after following redirects"""
+        headers = dict(headers)
+        if types is not None:
+            headers["Accept"] = ", ".join(types)
+        for _ in range(redirects + 1):
+            response = await self._request(url, headers)
+            location = response.headers.get("Location")
+            if response.status not in REDIRECT_CODES or location is None:
+                break
+            url = urljoin(url, location)
+        response.url = url
+        
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                response.headers, BytesIO(response.body))
+        type = response.headers.get_content_type()
+        if types is not None and type not in types:
+            msg = "Unexpected content type {}"
+            raise ContentTypeError(msg.format(type))
+        return response
+    
+    async def _request(self, url, headers):
+        split = urlsplit(url)
+        if split.scheme not in DEFAULT_PORTS:
+            raise ValueError("Unsupported URL scheme {!r}".format(url))
+        key = (split.scheme, split.hostname,
+            split.port or DEFAULT_PORTS[split.scheme])
+        target = split.path or "/"
+        if split.query:
+            target += "?" + split.query
+        request = ["GET {} HTTP/1.1".format(target)]
+        request.append("Host: {}".format(split.netloc))
+        for (name, value) in headers.items():
+            request.append("{}: {}".format(name, value))
+        request = "\r\n".join(request + ["", ""]).encode("latin-1")
+        
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = asyncio.Semaphore(self.per_host)
+            self.limits[key] = limit
+        async with limit:
+            idle = self.idle.setdefault(key, list())
+            while idle:
+                connection = idle.pop()
+                try:
+                    return await self._attempt(key, connection, request)
+                except (EOFError, ConnectionError):
+                    pass  # Server probably closed the idle connection
+            
+            connection = asyncio.open_connection(key[1], key[2],
+                ssl=key[0] == "https")
+            connection = await asyncio.wait_for(connection, self.timeout)
+            return await self._attempt(key, connection, request)
+    
+    async def _attempt(self, key, connection, request):
+        (reader, writer) = connection
+        try:
+            writer.write(request)
+            response = await self._read_response(reader)
+        except:
+            writer.close()
+            raise
+        if response.will_close:
+            writer.close()
+        else:
+            self.idle[key].append(connection)
+        return response
+    
+    async def _read_response(self, reader):
+        line = await self._wait(reader.readline())
+        if not line:
+            raise EOFError("Connection closed before response")
+        status = line.decode("latin-1").rstrip("\r\n").split(None, 2)
+        if len(status) < 2 or not status[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(line)
+        status.append("")
+        [version, code, reason] = status[:3]
+        
+        lines = list()
+        while True:
+            line = await self._wait(reader.readline())
+            lines.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        headers = http.client.parse_headers(BytesIO(b"".join(lines)))
+        headers.set_default_type(None)
+        
+        will_close = (version == "HTTP/1.0" or
+            headers.get("Connection", "").lower() == "close")
+        body = bytearray()
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                line = await self._wait(reader.readline())
+                size = int(line.split(b";", 1)[0], 16)
+                if not size:
+                    break
+                await self._read_body(reader, body, size)
+                await self._wait(reader.readexactly(2))  # CRLF
+            while True:  # Trailer
+                line = await self._wait(reader.readline())
+                if line in (b"\r\n", b"\n", b""):
+                    break
+        elif "Content-Length" in headers:
+            await self._read_body(reader, body,
+                int(headers["Content-Length"]))
+        else:
+            while True:
+                data = await self._wait(reader.read(0x10000))
+                if not data:
+                    break
+                body.extend(data)
+            will_close = True
+        return Response(int(code), reason, headers, bytes(body), will_close)
+    
+    async def _read_body(self, reader, body, size):
+        while size:
+            data = await self._wait(reader.read(min(size, 0x10000)))
+            if not data:
+                raise http.client.IncompleteRead(bytes(body), size)
+            body.extend(data)
+            size -= len(data)
+    
+    def _wait(self, read):
+        return asyncio.wait_for(read, self.timeout)
+    
+    def close(self):
+        for idle in self.idle.values():
+            for (_, writer) in idle:
+                writer.close()
+        self.idle.clear()
+
+class Response:
+    def __init__(self, status, reason, headers, body, will_close):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.will_close = will_close
+        self.url = None
+
+DEFAULT_PORTS = dict(http=80, https=443)
+REDIRECT_CODES = {301, 302, 303, 307, 308}
@@ -7,8 +7,15 @@ from . import parser
 import gzip
 from urllib.parse import urljoin, urlsplit
 from urllib.parse import urlencode
-from .utils import http_get
+from .utils import http_get, shared_session
 from base64 import b64encode
+from .utils import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+import http.client
+import json
+from time import time
+from hashlib import sha256
 
 iview_config = None
 
@@ -23,19 +30,18 @@ def fetch_url(url, types=None, headers=()):
     # Not using plain urlopen() because the combination of
     # urlopen()'s "Connection: close" header and
     # a "gzip" encoded response
-    # sometimes seems to cause the server to truncate the HTTP response
-    from .utils import PersistentConnectionHandler
-    with PersistentConnectionHandler(timeout=30) as connection:
-        session = urllib.request.build_opener(connection)
-        try:
-            with http_get(session, url, types, headers=all_headers) as http:
-                headers = http.info()
-                if headers.get('content-encoding') == 'gzip':
-                    return gzip.GzipFile(fileobj=http).read()
-                else:
-                    return http.read()
-        except socket.timeout as error:
-            raise Error("Timeout accessing {!r}".format(url)) from error
+    # sometimes seems to cause the server to truncate the HTTP response.
+    # The shared pool also saves reconnecting for each request.
+    session = shared_session()
+    try:
+        with http_get(session, url, types, headers=all_headers) as http:
+            headers = http.info()
+            if headers.get('content-encoding') == 'gzip':
+                return gzip.GzipFile(fileobj=http).read()
+            else:
+                return http.read()
+    except socket.timeout as error:
+        raise Error("Timeout accessing {!r}".format(url)) from error
 
 def maybe_fetch(url, type=None, headers=()):
     """Only fetches a URL if it is not in the cache directory.
@@ -78,8 +84,12 @@ def get_config(headers=()):
     headers['Accept-Encoding'] = 'gzip'
     iview_config = dict(headers=headers)
     
-    xml = maybe_fetch(config.config_url, ("application/xml", "text/xml"))
-    parsed = parser.parse_config(xml)
+    key = urljoin(config.base_url, config.config_url)
+    parsed = cached_response('config', key, config.config_ttl, disk=True)
+    if parsed is None:
+        xml = maybe_fetch(config.config_url, ("application/xml", "text/xml"))
+        parsed = parser.parse_config(xml)
+        cache_response('config', key, parsed, disk=True)
     iview_config.update(parsed)
 
 def get_auth():
@@ -87,7 +97,14 @@ def get_auth():
     Among other things, it tells us if the connection is unmetered,
     and gives us a one-time token we need to use to speak RTSP with
     ABC's servers, and tells us what the RTMP URL is.
+    The result is reused for "config.auth_ttl" seconds; see forget_auth().
     """
+    key = auth_key()
+    auth = cached_response('auth', key, config.auth_ttl,
+        disk=config.cache_auth)
+    if auth is not None:
+        return dict(auth)
+    
     auth = iview_config['auth_url']
     if config.ip:
         query = urlsplit(auth).query
@@ -95,7 +112,176 @@ def get_auth():
         query += urlencode((("ip", config.ip),))
         auth = urljoin(auth, "?" + query)
     auth = fetch_url(auth, ("application/xml", "text/xml"))
-    return parser.parse_auth(auth, iview_config)
+    host = config.override_host
+    if host == 'fastest':
+        host = fastest_host(parser.parse_auth(auth, iview_config))
+    auth = parser.parse_auth(auth, iview_config, host)
+    cache_response('auth', key, auth, disk=config.cache_auth)
+    return dict(auth)
+
+def auth_key():
+    return json.dumps((iview_config['auth_url'], config.ip,
+        config.override_host))
+
+def forget_auth():
+    """Discard the cached auth responses, such as when the server has
+    rejected a token. This does not need the iView config loaded, so
+    works for a download resumed from a plan."""
+    forget_responses('auth')
+
+response_cache = dict()  # (name, key) -> dict(time=..., value=...)
+
+def cached_response(name, key, ttl, *, disk=False):
+    """Returns a cached value if it is less than "ttl" seconds old, or
+    None. With "disk", the value may also have been saved in
+    "config.response_cache_dir" by an earlier run. Nothing is reused if
+    "config.refresh" is set."""
+    if config.refresh:
+        return None
+    entry = response_cache.get((name, key))
+    if entry is None and disk and config.response_cache_dir:
+        try:
+            with open(response_file(name, key), encoding='utf-8') as file:
+                entry = json.load(file)
+        except (EnvironmentError, ValueError):
+            pass
+        else:
+            if entry.get('key') != key:
+                entry = None  # Hash collision
+    if entry is None or not 0 <= time() - entry['time'] < ttl:
+        return None
+    response_cache[(name, key)] = entry
+    return entry['value']
+
+def cache_response(name, key, value, *, disk=False):
+    """Save a value for cached_response(), which must be encodable as
+    JSON if saving to disk"""
+    entry = dict(key=key, time=time(), value=value)
+    response_cache[(name, key)] = entry
+    if not disk or not config.response_cache_dir:
+        return
+    path = response_file(name, key)
+    temp = path + '.{}.tmp'.format(os.getpid())
+    try:
+        os.makedirs(config.response_cache_dir, exist_ok=True)
+        with open(temp, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(temp, path)
+    except EnvironmentError as error:
+        print('Could not cache {} response: {}'.format(name, error),
+            file=sys.stderr)
+        try:
+            os.remove(temp)
+        except EnvironmentError:
+            pass
+
+def forget_responses(name):
+    """Discard all the cached values for "name", in memory and on disk"""
+    for key in list(response_cache):
+        if key[0] == name:
+            del response_cache[key]
+    if not config.response_cache_dir:
+        return
+    try:
+        files = os.listdir(config.response_cache_dir)
+    except EnvironmentError:
+        return
+    for file in files:
+        if file.startswith(name + '-') and file.endswith('.json'):
+            try:
+                os.remove(os.path.join(config.response_cache_dir, file))
+            except EnvironmentError:
+                pass
+
+def response_file(name, key):
+    digest = sha256(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(config.response_cache_dir,
+        '{}-{}.json'.format(name, digest))
+
+def fastest_host(auth):
+    """Name of the best streaming host found by probe_hosts() out of
+    those eligible for the "auth" response, or None if none of them could
+    be reached"""
+    for probe in probe_hosts(eligible_hosts(auth)):
+        if probe['latency'] is not None:
+            return probe['host']
+    return None
+
+def eligible_hosts(auth):
+    """Names of the hosts in "config.stream_hosts" that can be used with
+    an auth response: HDS hosts, and unmetered hosts only if the
+    connection is unmetered"""
+    return [name for (name, host) in config.stream_hosts.items()
+        if urlsplit(host['server']).scheme in {'http', 'https'} and
+        (auth['free'] or not host.get('unmetered'))]
+
+host_probes = dict()  # Most recent probe_host() result for each host
+
+def probe_hosts(hosts=None):
+    """Probe the "bwtest" URLs of the named hosts in "config.stream_hosts"
+    in parallel, and rank them
+    
+    Hosts with a throughput sample come first, fastest first, followed by
+    those that could only be connected to, by latency, and then those that
+    could not be reached. Results are reused for "config.host_probe_ttl"
+    seconds. By default, all the hosts are probed."""
+    if hosts is None:
+        hosts = config.stream_hosts
+    now = monotonic()
+    stale = [name for name in hosts
+        if name not in host_probes or
+        now - host_probes[name]['time'] >= config.host_probe_ttl]
+    if stale:
+        with ThreadPoolExecutor(len(stale)) as executor:
+            urls = (config.stream_hosts[name]['bwtest'] for name in stale)
+            for result in executor.map(probe_host, stale, urls):
+                host_probes[result['host']] = result
+    return sorted((host_probes[name] for name in hosts), key=host_rank)
+
+def host_rank(probe):
+    if probe['throughput'] is not None:
+        return (0, -probe['throughput'])
+    if probe['latency'] is not None:
+        return (1, probe['latency'])
+    return (2, 0)
+
+def probe_host(name, url):
+    """Measure the time to connect to a host, and for HTTP, the rate of
+    reading up to "config.host_probe_size" bytes of a response
+    
+    Returns a dict() with the "host" name, the connect "latency" in
+    seconds and "throughput" in kB/s, either of which may be None, and an
+    "error" message if the probe failed."""
+    result = dict(host=name, latency=None, throughput=None, error=None,
+        time=monotonic())
+    split = urlsplit(url)
+    port = split.port or PROBE_PORTS.get(split.scheme)
+    timeout = config.host_probe_timeout
+    try:
+        start = monotonic()
+        connection = socket.create_connection((split.hostname, port),
+            timeout)
+        result['latency'] = monotonic() - start
+        connection.close()
+        if split.scheme not in {'http', 'https'}:
+            return result
+        
+        start = monotonic()
+        try:
+            response = urllib.request.urlopen(url, timeout=timeout)
+        except HTTPError as error:
+            response = error  # The error page still gives a sample
+        with response:
+            size = len(response.read(config.host_probe_size))
+        if size:
+            seconds = max(monotonic() - start, 1e-6)
+            result['throughput'] = size / seconds / 1000
+    except (EnvironmentError, http.client.HTTPException) as error:
+        result['error'] = str(error) or type(error).__name__
+    return result
+
+PROBE_PORTS = dict(http=80, https=443, rtmp=1935, rtmpe=1935, rtmpt=80,
+    rtmpte=80)
 
 def get_categories():
     """Returns the list of categories
@@ -40,12 +40,94 @@ socks_proxy_port = 1080
 # Cache directory to use for debugging
 cache = None
 
+# The parsed iView config and auth responses are reused until they are
+# older than 'config_ttl' or 'auth_ttl' seconds, or not at all if 'refresh'
+# is set. They are kept in memory, and the config is also kept between runs
+# in 'response_cache_dir', or only in memory if that is 'None'. Auth
+# responses hold tokens, so are only kept there too if 'cache_auth' is set.
+response_cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'python-iview')
+cache_auth = False
+config_ttl = 24 * 60 * 60
+auth_ttl = 30 * 60
+refresh = False
+
+# Number of HDS fragments to download in parallel. Fragments are still
+# written out in order; a value of 1 downloads them one at a time.
+hds_prefetch = 1
+
+# Most bytes of an HDS fragment to hold in memory until the whole fragment
+# is downloaded. Larger fragments are written out as they are downloaded.
+hds_fragment_memory = 16 * 2**20
+
+# Bytes of HDS output to queue for a separate thread to write to the file,
+# or 0 to write from the download thread
+hds_write_behind = 32 * 2**20
+
+# When to flush HDS output to disk: after every "fragment", "periodic"ally
+# at fragment boundaries every 'hds_fsync_interval' seconds, or at the "end"
+hds_fsync = "end"
+hds_fsync_interval = 10
+
+# Seconds to wait for data on an HTTP connection before giving up on it
+http_timeout = 30
+
+# Number of times to retry a failed or stalled HDS fragment, and the delay
+# in seconds before the first retry, doubling after each one
+hds_retries = 5
+hds_retry_delay = 1
+
+# Percentile of recent HDS fragment response times after which a duplicate
+# request is sent on another connection, or 'None' to never send one
+hds_hedge = None
+
+# Which HDS rendition to download: "highest" or "lowest" bitrate, or
+# "adaptive" to switch between them depending on the download speed.
+# Renditions above 'hds_max_bitrate' (kb/s) are avoided, unless it is 'None'.
+hds_bitrate = "highest"
+hds_max_bitrate = None
+
+# Drop the video from HDS downloads. The output format may be "flv", "mp4"
+# for fragmented MP4, or "adts" for the raw AAC audio, which also implies
+# 'hds_audio_only'.
+hds_audio_only = False
+hds_format = "flv"
+
+# Add a keyframe index to the metadata of HDS downloads, for players to
+# seek without scanning the file
+hds_keyframes = False
+
+# Combined download rate limit in kB/s for all HDS downloads in the process,
+# or 'None' for no limit. If 'bandwidth_schedule' is set, it lists limits
+# for times of day instead, as ("HH:MM", limit) pairs in order of time, each
+# applying until the next one, such as
+# [("08:00", 500), ("18:00", 2000), ("23:00", None)].
+bandwidth_limit = None
+bandwidth_schedule = None
+
+# Share of the limit for each download, relative to the other downloads
+# running at the same time in the process
+bandwidth_weight = 1
+
+# Names of other hosts in 'stream_hosts' to spread HDS fragment requests
+# over, or 'None' to download from one host. The hosts should serve the same
+# paths as the streaming host; any that fail are avoided for a while.
+hds_stripe = None
+
 # Name of streaming host to override, or 'None' to use the host from the auth
 # response.  The host name should be one of the keys in 'stream_hosts', or
 # the special value 'default', which invokes a default server from the config
-# response, probably the same as the 'AkamaiRTMP' values.
+# response, probably the same as the 'AkamaiRTMP' values, or 'fastest', which
+# probes the 'bwtest' URL of each eligible HDS host and picks the best one.
 override_host = None
 
+# Seconds to wait for each host when probing, bytes of an HTTP response to
+# read as a throughput sample, and seconds before probing again
+host_probe_timeout = 5
+host_probe_size = 256 * 2**10
+host_probe_ttl = 10 * 60
+
 stream_hosts = {
     'AkamaiRTMP': dict(  # Made up name; used to be "Akamai"
         server='rtmp://cp53909.edgefcs.net/ondemand',
@@ -61,6 +143,7 @@ stream_hosts = {
         server='http://iviewum-vh.akamaihd.net/z/',
         bwtest='http://iviewum-vh.akamaihd.net/z/',
         path='playback/_definst_/',
+        unmetered=True,  # Only used by 'fastest' if the auth says "free"
     ),
     'Hostworks': dict(  # Probably not running any more
         server='rtmp://203.18.195.10/ondemand',
@@ -6,19 +6,23 @@ import threading
 import re
 from locale import getpreferredencoding
 from . import hds
+from .utils import WriteBehindFile
 from urllib.parse import urlsplit, urljoin
 import sys
 from stat import S_IRUSR, S_IWUSR, S_IRGRP, S_IWGRP, S_IROTH, S_IWOTH
+from contextlib import contextmanager
+from urllib.error import HTTPError
+import http.client
 
 def get_filename(url):
     """Generates a default file name from the media URL"""
-    return url.rsplit('/', 1)[-1].rsplit('.', 1)[0] + '.flv'
+    return url.rsplit('/', 1)[-1].rsplit('.', 1)[0] + '.' + file_extension()
 
 def descriptive_filename(series, title, urlpart):
     """Generates a more descriptive file name from the programme title"""
     # if title contains program, remove duplication
     title = title.replace(series + ' ', '')
-    ext = 'flv' # ABC always provides us with an FLV container
+    ext = file_extension()
 
     # for specials that title == program, just use program.ext
     if series == title:
@@ -36,6 +40,13 @@ def descriptive_filename(series, title, urlpart):
     filename = re.sub('[\<\>\:\"\/\\\|\?\*]', '-', filename)
     return filename
 
+def file_extension():
+    """ABC always provides us with an FLV container, but HDS downloads may
+    be converted to other formats"""
+    return EXTENSIONS[config.hds_format]
+
+EXTENSIONS = dict(flv='flv', mp4='mp4', adts='aac')
+
 def is_resumable(url):
     """The live News 24 RTMP stream is not resumable; everything else is a
     resumable VOD file name"""
@@ -48,7 +59,7 @@ frontend=None, **kw):
     Accepts the following extra keyword arguments, which map to the
     corresponding "rtmpdump" options:
     
-    rtmp, host, app, playpath, flv, swfVfy, resume, live"""
+    rtmp, host, app, playpath, flv, swfVfy, start, stop, resume, live"""
     
     executables = (
             'rtmpdump',
@@ -62,11 +73,12 @@ frontend=None, **kw):
         #    '-V', # verbose
         ]
     
-    for param in ("flv", "rtmp", "host", "app", "playpath", "swfVfy"):
+    for param in ("flv", "rtmp", "host", "app", "playpath", "swfVfy",
+    "start", "stop"):
         arg = kw.pop(param, None)
         if arg is None:
             continue
-        args.extend(("--" + param, arg))
+        args.extend(("--" + param, str(arg)))
 
     if live:
         args.append("--live")
@@ -166,7 +178,14 @@ class RtmpWorker(threading.Thread):
                 self.frontend.done(stopped=True)
 
 def fetch_program(url=None, *, item=dict(),
-execvp=False, dest_file=None, quiet=False, frontend=None):
+execvp=False, dest_file=None, quiet=False, frontend=None,
+start=None, end=None, weight=None):
+    """Download a programme, or only from "start" to "end" (seconds)
+    
+    HDS downloads get a share of the bandwidth limit in proportion to
+    "weight", which defaults to config.bandwidth_weight."""
+    if weight is None:
+        weight = config.bandwidth_weight
     if dest_file is None:
         dest_file = get_filename(item.get("url", url))
     
@@ -174,7 +193,61 @@ execvp=False, dest_file=None, quiet=False, frontend=None):
     if frontend:
         frontend.resumable = is_resumable(item.get("url", url))
     return fetcher.fetch(execvp=execvp, dest_file=dest_file,
-        quiet=quiet, frontend=frontend)
+        quiet=quiet, frontend=frontend, start=start, end=end,
+        weight=weight)
+
+def verify_program(url, dest_file, *, repair=True):
+    """Check a downloaded programme against its HDS stream, and repair it
+    by downloading only the broken fragments; see hds.verify()"""
+    fetcher = get_fetcher(url)
+    if not isinstance(fetcher, HdsFetcher):
+        raise ValueError("Only HDS downloads can be verified")
+    result = fetcher.verify(dest_file, repair=repair)
+    # The file may have been rewritten, so do not resume from the journal
+    journal = dest_file + ".journal"
+    if result["refetched"] and os.path.exists(journal):
+        os.remove(journal)
+    return result
+
+@contextmanager
+def auth_check():
+    """Forget the cached auth response if the server rejects its token,
+    so that the next programme gets a fresh one"""
+    try:
+        yield
+    except HTTPError as err:
+        if err.code == http.client.FORBIDDEN:
+            comm.forget_auth()
+        raise
+
+def plan_program(url):
+    """Resolve a programme into a download plan; see hds.plan()"""
+    fetcher = get_fetcher(url)
+    if not isinstance(fetcher, HdsFetcher):
+        raise ValueError("Only HDS downloads can be planned")
+    return fetcher.plan()
+
+@auth_check()
+def fetch_shard(plan, dest_file, first=None, last=None, *, frontend=None):
+    """Download a range of fragments from a plan; see hds.fetch_shard()
+    
+    The journal is kept alongside the file, named with a ".journal"
+    suffix, for resuming and for merge_shards()."""
+    with hds.Journal(dest_file + ".journal") as journal, \
+    open_resumable(dest_file) as dest_file:
+        hds.fetch_shard(plan, dest_file, first, last, journal=journal,
+            frontend=frontend, prefetch=config.hds_prefetch)
+
+def merge_shards(plan, parts, dest_file):
+    """Join the files from fetch_shard(), writing to "stdout" if
+    "dest_file" is "-"."""
+    if dest_file == "-":
+        output = sys.stdout.detach()
+        sys.stdout = None
+    else:
+        output = open(dest_file, "wb")
+    with output:
+        hds.merge_shards(plan, parts, output)
 
 def get_fetcher(url=None, *, item=dict()):
     url = item.get("url", url)
@@ -199,7 +272,7 @@ def get_fetcher(url=None, *, item=dict()):
         
         return RtmpFetcher(rtmp_url, playpath=url)
     else:
-        return HdsFetcher(url, auth)
+        return HdsFetcher(url, auth, size=item.get("size"))
 
 class RtmpFetcher:
     def __init__(self, url, **params):
@@ -207,9 +280,15 @@ class RtmpFetcher:
         params["swfVfy"] = urljoin(config.base_url, config.swf_url)
         self.params = params
     
-    def fetch(self, *, dest_file, **kw):
-        resume = (not self.params.get("live", False) and
-            dest_file != '-')
+    def fetch(self, *, dest_file, start=None, end=None, weight=None,
+    **kw):
+        # "rtmpdump" is not throttled, so the weight does not apply
+        live = self.params.get("live", False)
+        if live and (start is not None or end is not None):
+            raise ValueError("Time ranges of live streams are not supported")
+        # A partial file would not resume at the right position
+        resume = (not live and dest_file != '-' and
+            start is None and end is None)
         if resume:
             # "rtmpdump" can leave an empty file if it fails, and
             # then consistently fails to resume it
@@ -222,15 +301,17 @@ class RtmpFetcher:
                 # itself fail later on
                 pass
         kw.update(self.params)
-        return rtmpdump(flv=dest_file, resume=resume, **kw)
+        return rtmpdump(flv=dest_file, resume=resume, start=start, stop=end,
+            **kw)
 
 RTMP_PROTOCOLS = {'rtmp', 'rtmpt', 'rtmpe', 'rtmpte'}
 
 class HdsFetcher:
-    def __init__(self, file, auth):
+    def __init__(self, file, auth, size=None):
         base = urljoin(auth['server'], auth['path'])
         self.url = urljoin(base, file + '/manifest.f4m')
         self.tokenhd = auth.get('tokenhd')
+        self.size = size
     
     def fetch(self, *, frontend, execvp, quiet, **kw):
         if frontend is None:
@@ -240,7 +321,36 @@ class HdsFetcher:
         return call(self.url, self.tokenhd,
             frontend=frontend,
             player=config.akamaihd_player,
+            prefetch=config.hds_prefetch,
+            hedge=config.hds_hedge,
+            bitrate=config.hds_bitrate,
+            max_bitrate=config.hds_max_bitrate,
+            audio_only=config.hds_audio_only,
+            format=config.hds_format,
+            keyframes=config.hds_keyframes,
+            stripe=[config.stream_hosts[name]['server']
+                for name in config.hds_stripe or ()],
+            size=self.size,
         **kw)
+    
+    def plan(self):
+        with auth_check():
+            return hds.plan(self.url, self.tokenhd,
+                player=config.akamaihd_player,
+                bitrate=config.hds_bitrate,
+                max_bitrate=config.hds_max_bitrate,
+                audio_only=config.hds_audio_only,
+            )
+    
+    def verify(self, dest_file, **kw):
+        with auth_check():
+            return hds.verify(self.url, self.tokenhd,
+                dest_file=dest_file,
+                player=config.akamaihd_player,
+                prefetch=config.hds_prefetch,
+                bitrate=config.hds_bitrate,
+                max_bitrate=config.hds_max_bitrate,
+            **kw)
 
 class HdsThread(threading.Thread):
     def __init__(self, *pos, frontend, **kw):
@@ -266,19 +376,40 @@ class HdsThread(threading.Thread):
         else:
             self.frontend.done()
 
+@auth_check()
 def hds_open_file(*pos, dest_file, **kw):
-    '''Handle special file name "-" representing "stdout"'''
+    '''Handle special file name "-" representing "stdout"
+    
+    Regular files get a journal of committed fragments alongside, named
+    with a ".journal" suffix, which is removed once the download is
+    complete. They are written through a WriteBehindFile, unless
+    "config.hds_write_behind" is zero.'''
     if dest_file == "-":
         dest_file = sys.stdout.detach()
         sys.stdout = None
-    else:
-        flags = os.O_RDWR | os.O_CREAT  # Create but do not truncate
-        for flag in (
-        "O_BINARY", "O_CLOEXEC", "O_NOINHERIT", "O_SEQUENTIAL"):
-            flags |= getattr(os, flag, 0)
-        mode = (S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP |
-            S_IROTH | S_IWOTH)
-        fd = os.open(dest_file, flags, mode)
-        dest_file = os.fdopen(fd, "wb")
-    with dest_file:
-        return hds.fetch(*pos, dest_file=dest_file, **kw)
+        with dest_file:
+            return hds.fetch(*pos, dest_file=dest_file, **kw)
+    
+    journal_name = dest_file + ".journal"
+    # The journal is closed last, since the writer thread appends to it
+    with hds.Journal(journal_name) as journal, \
+    open_resumable(dest_file) as dest_file:
+        if config.hds_write_behind:
+            with WriteBehindFile(dest_file) as dest_file:
+                result = hds.fetch(*pos, dest_file=dest_file,
+                    journal=journal, **kw)
+        else:
+            result = hds.fetch(*pos, dest_file=dest_file, journal=journal,
+                **kw)
+    os.remove(journal_name)
+    return result
+
+def open_resumable(name):
+    """Open a file for writing without truncating it"""
+    flags = os.O_RDWR | os.O_CREAT  # Create but do not truncate
+    for flag in (
+    "O_BINARY", "O_CLOEXEC", "O_NOINHERIT", "O_SEQUENTIAL"):
+        flags |= getattr(os, flag, 0)
+    mode = (S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP |
+        S_IROTH | S_IWOTH)
+    return os.fdopen(os.open(name, flags, mode), "wb")
@@ -1,31 +1,67 @@
 from .utils import fastforward
-from struct import Struct
+from struct import Struct, error as StructError
 from .utils import read_int, read_strict
 from .utils import setitem
-from io import SEEK_CUR
+from io import SEEK_CUR, BufferedIOBase, BytesIO, UnsupportedOperation
+from datetime import datetime, timedelta, timezone
+from itertools import chain, repeat
+from array import array
+from mmap import mmap, ACCESS_READ
+from contextlib import contextmanager
+from abc import abstractmethod
 
 def main():
     from sys import stdin
+    from argparse import ArgumentParser
+    
+    params = ArgumentParser(description="Dump the tags of an FLV file "
+        "read from stdin")
+    params.add_argument("--analyse", action="store_true",
+        help="summarise bitrates, GOPs, timestamp gaps and A/V drift "
+            "instead (requires NumPy)")
+    params.add_argument("--json", action="store_true",
+        help="print the analysis as JSON (implies --analyse)")
+    params.add_argument("--interval", metavar="<seconds>", type=float,
+        default=10, help="period of each bitrate measurement (default: 10)")
+    params.add_argument("--gap", metavar="<seconds>", type=float, default=1,
+        help="report timestamp jumps longer than this (default: 1)")
+    args = params.parse_args()
+    if args.interval <= 0:
+        params.error("--interval must be positive")
     
     def dump(dict):
         items = ("{}: {!r}".format(n, v) for [n, v] in sorted(dict.items()))
         return "; ".join(items)
     
-    flv = stdin.buffer
-    print("header", dump(read_file_header(flv)))
-    
-    while True:
-        offset = flv.tell()
-        tag = read_tag_header(flv)
-        if tag is None:
-            break
-        print(offset, dump(tag))
+    with map_file(stdin.buffer) as flv:
+        [header, body] = unpack_file_header(flv)
+        [index, _] = scan_tags(flv, body)
+        if args.analyse or args.json:
+            try:
+                from . import flvstats
+            except ImportError as err:
+                params.error("--analyse requires NumPy ({})".format(err))
+            stats = flvstats.analyse(index, interval=args.interval,
+                gap=args.gap)
+            stats["header"] = header
+            if args.json:
+                import json
+                print(json.dumps(stats, indent=1, sort_keys=True))
+            else:
+                print("header", dump(header))
+                print(flvstats.format_report(stats))
+            return
         
-        parser = tag_parsers.get(tag["type"])
-        if parser:
-            parsed = parser(flv, tag)
-            print(" ", dump(parsed))
-        fastforward(flv, tag["length"] + 4)  # Including trailing tag size
+        print("header", dump(header))
+        for [offset, length] in zip(index["offset"], index["length"]):
+            tag = unpack_tag_header(flv, offset)
+            print(offset, dump(tag))
+            
+            parser = tag_parsers.get(tag["type"])
+            if parser:
+                data = offset + TAG_HEADER_LENGTH
+                parsed = parser(BytesIO(flv[data:data + length]), tag)
+                print(" ", dump(parsed))
 
 def write_file_header(flv, audio=True, video=True):
     flv.write(SIGNATURE)
@@ -36,22 +72,34 @@ def write_file_header(flv, audio=True, video=True):
     flv.write((0).to_bytes(4, "big"))  # Previous tag size field
 
 def read_file_header(flv):
-    signature = read_strict(flv, 3)
+    header = read_strict(flv, FILE_HEADER_LENGTH)
+    [header, body] = unpack_file_header(header)
+    fastforward(flv, body - FILE_HEADER_LENGTH)
+    return header
+
+def unpack_file_header(buffer):
+    """Decode the file header at the start of a buffer
+    
+    Returns (header, body), where "body" is the position of the first tag,
+    after the first previous tag size field."""
+    if len(buffer) < FILE_HEADER_LENGTH:
+        raise EOFError("Truncated FLV file header")
+    signature = bytes(buffer[:3])
     if signature != SIGNATURE:
         raise ValueError(repr(signature))
-    (version, flags) = read_strict(flv, 2)
+    [version, flags, body] = FILE_HEADER.unpack_from(buffer, 3)
     if version != FILE_VERSION:
         raise ValueError(version)
-    body = read_int(flv, 4)
-    fastforward(flv, body - FILE_HEADER_LENGTH + 4)  # Skip prev. tag size
-    return dict(
+    header = dict(
         audio=bool(flags & 1 << 2),
         video=bool(flags & 1 << 0),
     )
+    return (header, body + 4)  # Skip previous tag size
 
 SIGNATURE = b"FLV"
 FILE_VERSION = 1
 FILE_HEADER_LENGTH = len(SIGNATURE) + 2 + 4
+FILE_HEADER = Struct(">BBI")  # Version, flags, body offset
 
 def write_scriptdata(flv, metadata):
     flv.write(bytes((TAG_SCRIPTDATA,)))
@@ -66,19 +114,38 @@ def read_tag_header(flv):
     flags = flv.read(1)
     if not flags:
         return None
-    (flags,) = flags
-    length = read_int(flv, 3)
-    timestamp = read_int(flv, 3)
-    (extension,) = SBYTE.unpack(read_strict(flv, 1))
-    streamid = read_int(flv, 3)
+    header = flags + read_strict(flv, TAG_HEADER_LENGTH - 1)
+    return unpack_tag_header(header)
+
+def unpack_tag_header(buffer, offset=0):
+    """Decode a tag header from a buffer, like read_tag_header()"""
+    (flags, length_hi, length_lo, timestamp_hi, timestamp_lo, extension,
+        streamid_hi, streamid_lo) = TAG_HEADER.unpack_from(buffer, offset)
     return dict(
         filter=bool(flags >> 5 & 1),
         type=flags >> 0 & 0x1F,
-        length=length,
-        timestamp=timestamp | extension << 24,
-        streamid=streamid,
+        length=length_hi << 8 | length_lo,
+        timestamp=timestamp_hi << 8 | timestamp_lo | extension << 24,
+        streamid=streamid_hi << 16 | streamid_lo,
     )
-SBYTE = Struct("=b")
+# Flags, length (24 bits), timestamp (24 bits), signed timestamp extension,
+# stream id (24 bits)
+TAG_HEADER = Struct(">BHBHBbBH")
+
+def shift_timestamps(buffer, offset):
+    """Subtract "offset" from the timestamps of the whole tags in a
+    writable buffer, stopping at zero"""
+    pos = 0
+    while pos < len(buffer):
+        tag = unpack_tag_header(buffer, pos)
+        pack_timestamp(buffer, pos, max(tag["timestamp"] - offset, 0))
+        pos += TAG_HEADER_LENGTH + tag["length"] + 4
+
+def pack_timestamp(buffer, offset, timestamp):
+    """Set the timestamp in a tag header in a writable buffer"""
+    TIMESTAMP.pack_into(buffer, offset + 4,
+        timestamp >> 8 & 0xFFFF, timestamp & 0xFF, timestamp >> 24)
+TIMESTAMP = Struct(">HBB")
 
 TAG_HEADER_LENGTH = 1 + 3 + 3 + 1 + 3
 
@@ -90,6 +157,76 @@ def read_prev_tag(flv):
     flv.seek(-4 - length, SEEK_CUR)
     return read_tag_header(flv)
 
+def scan_tags(buffer, offset, end=None):
+    """Index the tags in a buffer, such as a mapped FLV file
+    
+    Returns (index, end), where "index" is a table of parallel arrays with
+    an item for each tag starting from "offset":
+    
+    "offset": Position of the tag header
+    "type": Tag type, such as TAG_VIDEO
+    "timestamp": Timestamp in milliseconds
+    "length": Length of the tag data
+    "keyframe": Whether the tag is a video keyframe, as in is_keyframe()
+    
+    Scanning stops at "end" (default: end of buffer), at an incomplete
+    tag, or at a zero byte, such as preallocated space. The returned
+    "end" is the position after the last complete tag."""
+    if end is None:
+        end = len(buffer)
+    index = dict(
+        offset=array("q"),
+        type=array("B"),
+        timestamp=array("q"),
+        length=array("L"),
+        keyframe=array("B"),
+    )
+    offsets = index["offset"].append
+    types = index["type"].append
+    timestamps = index["timestamp"].append
+    lengths = index["length"].append
+    keyframes = index["keyframe"].append
+    unpack = TAG_HEADER.unpack_from
+    while offset + TAG_HEADER_LENGTH <= end:
+        (flags, length_hi, length_lo, timestamp_hi, timestamp_lo, extension,
+            _, _) = unpack(buffer, offset)
+        type = flags & 0x1F
+        length = length_hi << 8 | length_lo
+        data = offset + TAG_HEADER_LENGTH
+        if not type or data + length + 4 > end:
+            break
+        keyframe = False
+        if type == TAG_VIDEO and length:
+            video = buffer[data]
+            keyframe = video >> 4 == KEY_FRAME and not (
+                video & 0xF == CODEC_AVC and length >= 2 and
+                buffer[data + 1] == AVC_HEADER)
+        offsets(offset)
+        types(type)
+        timestamps(timestamp_hi << 8 | timestamp_lo | extension << 24)
+        lengths(length)
+        keyframes(keyframe)
+        offset = data + length + 4  # Trailing tag size field
+    return (index, offset)
+
+@contextmanager
+def map_file(file):
+    """Map a whole file into memory for reading, for scan_tags()
+    
+    If the file cannot be mapped, such as a pipe, it is read instead, from
+    the start if it is seekable. The file position is not changed unless
+    it is read."""
+    try:
+        buffer = mmap(file.fileno(), 0, access=ACCESS_READ)
+    except (ValueError, EnvironmentError, UnsupportedOperation):
+        # Empty file, or not a regular file
+        if file.seekable():
+            file.seek(0)
+        yield file.read()
+        return
+    with buffer:
+        yield buffer
+
 tag_parsers = dict()
 
 TAG_AUDIO = 8
@@ -110,6 +247,121 @@ def parse_audio_tag(flv, tag):
 
 FORMAT_AAC = 10
 AAC_HEADER = 0
+AAC_RAW = 1
+
+class TagWriter(BufferedIOBase):
+    """Abstract base class for converting an FLV stream written to it
+    
+    The FLV file header is skipped, and tag() is called for each tag.
+    Tags may be written in pieces. Like CounterWriter, "length" and tell()
+    count the bytes written to "output", which tag() should update."""
+    
+    def __new__(cls, *pos, **kw):
+        # The "io" base classes do not check for abstract methods
+        if cls.__abstractmethods__:
+            msg = "Can't instantiate abstract class {} without tag()"
+            raise TypeError(msg.format(cls.__name__))
+        return BufferedIOBase.__new__(cls)
+    
+    def __init__(self, output):
+        self.output = output
+        self.length = 0
+        self.pending = bytearray()  # Incomplete tag
+        self.started = False  # FLV file header skipped
+    
+    def write(self, b):
+        pending = self.pending
+        pending.extend(b)
+        pos = 0
+        if not self.started:
+            if len(pending) < FILE_HEADER_LENGTH + 4:
+                return len(b)
+            if pending.startswith(SIGNATURE):
+                body = int.from_bytes(pending[5:FILE_HEADER_LENGTH], "big")
+                pos = body + 4  # Skip previous tag size field
+            self.started = True
+        while len(pending) - pos >= TAG_HEADER_LENGTH:
+            tag = unpack_tag_header(pending, pos)
+            data = pos + TAG_HEADER_LENGTH
+            end = data + tag["length"] + 4  # Trailing tag size field
+            if end > len(pending):
+                break
+            self.tag(tag, pending[data:end - 4])
+            pos = end
+        del pending[:pos]
+        return len(b)
+    
+    @abstractmethod
+    def tag(self, tag, data):
+        """Handle a tag, given its parsed header and its body"""
+    
+    def tell(self):
+        return self.length
+    
+    def writable(self):
+        return True
+
+class AdtsWriter(TagWriter):
+    """Converts an FLV stream written to it into raw AAC audio with ADTS
+    headers
+    
+    Video and script data tags are discarded. The AAC sequence header tag
+    supplies the ADTS header fields."""
+    
+    def __init__(self, output):
+        TagWriter.__init__(self, output)
+        self.config = None  # (Profile, sampling frequency index, channels)
+    
+    def tag(self, tag, data):
+        if tag["type"] == TAG_AUDIO:
+            self.audio(data)
+    
+    def audio(self, data):
+        if len(data) < 2 or data[0] >> 4 != FORMAT_AAC:
+            raise ValueError("Only AAC audio can be written as ADTS")
+        if data[1] == AAC_HEADER:
+            config = parse_aac_config(data[2:])
+            if not 1 <= config["object_type"] <= 4:
+                msg = "AAC object type {} not supported by ADTS"
+                raise ValueError(msg.format(config["object_type"]))
+            self.config = (config["object_type"] - 1, config["rate"],
+                config["channels"])
+            return
+        if data[1] != AAC_RAW:
+            return
+        if self.config is None:
+            raise ValueError("AAC frame before sequence header")
+        [profile, rate, channels] = self.config
+        length = ADTS_HEADER_LENGTH + len(data) - 2
+        header = bytes((
+            0xFF, 0xF1,  # Sync word, MPEG-4, no CRC
+            profile << 6 | rate << 2 | channels >> 2,
+            (channels & 3) << 6 | length >> 11,
+            length >> 3 & 0xFF,
+            (length & 7) << 5 | 0x1F,  # Buffer fullness 0x7FF (variable)
+            0xFC,  # One AAC frame per ADTS frame
+        ))
+        self.output.write(header)
+        self.output.write(data[2:])
+        self.length += length
+
+ADTS_HEADER_LENGTH = 7
+
+def parse_aac_config(config):
+    """Decode the start of an AAC AudioSpecificConfig structure, from an
+    AAC sequence header tag
+    
+    The "rate" is an index into AAC_RATES."""
+    if len(config) < 2:
+        raise EOFError("Truncated AAC sequence header")
+    return dict(
+        object_type=config[0] >> 3,
+        rate=(config[0] & 7) << 1 | config[1] >> 7,
+        channels=config[1] >> 3 & 0xF,
+    )
+
+AAC_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000,
+    12000, 11025, 8000, 7350)
 
 TAG_VIDEO = 9
 @setitem(tag_parsers, TAG_VIDEO)
@@ -127,60 +379,262 @@ def parse_video_tag(flv, tag):
 
 CODEC_AVC = 7
 AVC_HEADER = 0
+KEY_FRAME = 1
+
+def is_keyframe(tag, flags):
+    """Whether a tag, given its first two data bytes, is a video keyframe
+    other than an AVC sequence header"""
+    if tag["type"] != TAG_VIDEO or not flags or flags[0] >> 4 != KEY_FRAME:
+        return False
+    return not (flags[0] & 0xF == CODEC_AVC and
+        len(flags) >= 2 and flags[1] == AVC_HEADER)
+
+def keyframes_in(buffer, offset=0):
+    """Yields (timestamp, position) for each video keyframe in a buffer of
+    whole tags, adding "offset" to the positions"""
+    pos = 0
+    while pos < len(buffer):
+        tag = unpack_tag_header(buffer, pos)
+        data = pos + TAG_HEADER_LENGTH
+        if is_keyframe(tag, buffer[data:data + min(tag["length"], 2)]):
+            yield (tag["timestamp"], offset + pos)
+        pos = data + tag["length"] + 4
 
 TAG_SCRIPTDATA = 18
 @setitem(tag_parsers, TAG_SCRIPTDATA)
 def parse_scriptdata(stream, tag=None):
-    name = parse_scriptdatavalue(stream)
-    value = parse_scriptdatavalue(stream)
-    if tag is not None:
+    """Read and decode script tag data, such as "onMetaData"
+    
+    With "tag", the rest of the tag is read. Otherwise the stream should
+    be seekable; it is read to the end, and then positioned at the end of
+    the script data."""
+    if tag is None:
+        data = stream.read()
+        [result, end] = unpack_scriptdata(data)
+        stream.seek(end - len(data), SEEK_CUR)
+    else:
+        [result, _] = unpack_scriptdata(read_strict(stream, tag["length"]))
         tag["length"] = 0
-    return dict(name=name, value=value)
+    return result
+
+def unpack_scriptdata(buffer, offset=0):
+    """Decode script tag data from a buffer
+    
+    Returns (dict(name=..., value=...), end). Strings are decoded as
+    bytes, objects and ECMA arrays as dict(), strict arrays as tuples,
+    dates as UTC datetime objects, and null and undefined as None."""
+    buffer = memoryview(buffer)
+    try:
+        [name, offset] = unpack_scriptdatavalue(buffer, offset)
+        [value, offset] = unpack_scriptdatavalue(buffer, offset)
+    except (IndexError, StructError):
+        raise EOFError("Truncated script data")
+    return (dict(name=name, value=value), offset)
 
-def parse_scriptdatavalue(stream):
-    type = read_int(stream, 1)
-    return scriptdatavalue_parsers[type](stream)
+def unpack_scriptdatavalue(buffer, offset=0):
+    """Decode an AMF0 value from a buffer, returning (value, end)"""
+    type = buffer[offset]
+    try:
+        unpacker = scriptdatavalue_unpackers[type]
+    except KeyError:
+        raise ValueError("Unexpected script data type {}".format(type))
+    return unpacker(buffer, offset + 1)
 
-scriptdatavalue_parsers = dict()
+scriptdatavalue_unpackers = dict()
 
-@setitem(scriptdatavalue_parsers, 0)
-def parse_number(stream):
-    (number,) = DOUBLE_BE.unpack(read_strict(stream, DOUBLE_BE.size))
-    return number
+AMF_NUMBER = 0
+@setitem(scriptdatavalue_unpackers, AMF_NUMBER)
+def unpack_number(buffer, offset):
+    return (DOUBLE_BE.unpack_from(buffer, offset)[0], offset + 8)
 DOUBLE_BE = Struct(">d")
 
-@setitem(scriptdatavalue_parsers, 1)
-def parse_boolean(stream):
-    return bool(read_int(stream, 1))
+AMF_BOOLEAN = 1
+@setitem(scriptdatavalue_unpackers, AMF_BOOLEAN)
+def unpack_boolean(buffer, offset):
+    return (bool(buffer[offset]), offset + 1)
 
-@setitem(scriptdatavalue_parsers, 2)
-def parse_string(stream):
-    length = read_int(stream, 2)
-    return read_strict(stream, length)
+AMF_STRING = 2
+@setitem(scriptdatavalue_unpackers, AMF_STRING)
+def unpack_string(buffer, offset):
+    [length] = UINT16.unpack_from(buffer, offset)
+    return unpack_bytes(buffer, offset + 2, length)
 
-@setitem(scriptdatavalue_parsers, 3)
-def parse_object(stream):
-    array = dict()
+AMF_OBJECT = 3
+@setitem(scriptdatavalue_unpackers, AMF_OBJECT)
+def unpack_object(buffer, offset):
+    properties = dict()
     while True:
-        name = parse_string(stream)
-        value = parse_scriptdatavalue(stream)
-        if value is StopIteration:
-            return array
-        array[name.decode("ascii")] = value
-
-@setitem(scriptdatavalue_parsers, 8)
-def parse_ecma_array(stream):
-    fastforward(stream, 4)  # Approximate length
-    return parse_object(stream)
-
-@setitem(scriptdatavalue_parsers, 9)
-def parse_end(stream):
-    return StopIteration
-
-@setitem(scriptdatavalue_parsers, 10)
-def parse_array(stream):
-    length = read_int(stream, 4)
-    return tuple(parse_scriptdatavalue(stream) for _ in range(length))
+        [length] = UINT16.unpack_from(buffer, offset)
+        offset += 2
+        name = buffer[offset:offset + length]
+        offset += length
+        if buffer[offset] == AMF_OBJECT_END:
+            return (properties, offset + 1)
+        [value, offset] = unpack_scriptdatavalue(buffer, offset)
+        properties[str(name, "utf-8")] = value
+
+AMF_NULL = 5
+AMF_UNDEFINED = 6
+@setitem(scriptdatavalue_unpackers, AMF_NULL)
+@setitem(scriptdatavalue_unpackers, AMF_UNDEFINED)
+def unpack_null(buffer, offset):
+    return (None, offset)
+
+AMF_ECMA_ARRAY = 8
+@setitem(scriptdatavalue_unpackers, AMF_ECMA_ARRAY)
+def unpack_ecma_array(buffer, offset):
+    return unpack_object(buffer, offset + 4)  # Skip approximate length
+
+AMF_OBJECT_END = 9
+
+AMF_STRICT_ARRAY = 10
+@setitem(scriptdatavalue_unpackers, AMF_STRICT_ARRAY)
+def unpack_array(buffer, offset):
+    [length] = UINT32.unpack_from(buffer, offset)
+    offset += 4
+    # Arrays of numbers, such as keyframe indexes, are decoded in one go
+    end = offset + length * 9
+    types = buffer[offset:end:9]
+    if len(types) == length and not any(types):
+        numbers = Struct(">" + "xd" * length).unpack_from(buffer, offset)
+        return (numbers, end)
+    
+    items = list()
+    for _ in range(length):
+        [item, offset] = unpack_scriptdatavalue(buffer, offset)
+        items.append(item)
+    return (tuple(items), offset)
+
+AMF_DATE = 11
+@setitem(scriptdatavalue_unpackers, AMF_DATE)
+def unpack_date(buffer, offset):
+    [milliseconds, _] = DATE.unpack_from(buffer, offset)  # Ignore time zone
+    return (EPOCH + timedelta(milliseconds=milliseconds), offset + DATE.size)
+DATE = Struct(">dh")
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+AMF_LONG_STRING = 12
+@setitem(scriptdatavalue_unpackers, AMF_LONG_STRING)
+def unpack_long_string(buffer, offset):
+    [length] = UINT32.unpack_from(buffer, offset)
+    return unpack_bytes(buffer, offset + 4, length)
+
+def unpack_bytes(buffer, offset, length):
+    end = offset + length
+    if end > len(buffer):
+        raise EOFError("String extends past end of script data")
+    return (bytes(buffer[offset:end]), end)
+
+UINT16 = Struct(">H")
+UINT32 = Struct(">I")
+
+def update_number(metadata, name, value):
+    """Set a number property in "onMetaData" script data
+    
+    The property is added if it is missing. Returns (metadata, offset),
+    where "offset" is the position of the eight-byte number in the
+    returned data."""
+    buffer = memoryview(metadata)
+    [_, offset] = unpack_scriptdatavalue(buffer)  # Name
+    type = buffer[offset]
+    offset += 1
+    if type == AMF_ECMA_ARRAY:
+        count = offset
+        offset += 4
+    elif type == AMF_OBJECT:
+        count = None
+    else:
+        raise ValueError("Unexpected script data type {}".format(type))
+    
+    name = name.encode("ascii")
+    while True:
+        [key, start] = unpack_string(buffer, offset)
+        type = buffer[start]
+        if type == AMF_OBJECT_END:  # Insert the property before the end
+            entry = pack_name(name) + bytes((AMF_NUMBER,))
+            metadata = bytearray(metadata)
+            metadata[offset:offset] = entry + DOUBLE_BE.pack(value)
+            if count is not None:
+                [length] = UINT32.unpack_from(metadata, count)
+                UINT32.pack_into(metadata, count, length + 1)
+            return (bytes(metadata), offset + len(entry))
+        if key == name and type == AMF_NUMBER:
+            start += 1
+            end = start + DOUBLE_BE.size
+            number = DOUBLE_BE.pack(value)
+            metadata = metadata[:start] + number + metadata[end:]
+            return (metadata, start)
+        [_, offset] = unpack_scriptdatavalue(buffer, start)
+
+def encode_scriptdata(name, value):
+    """Encode script tag data, such as "onMetaData", with the "value"
+    dict() as an ECMA array; the reverse of unpack_scriptdata()"""
+    buffer = bytearray()
+    pack_scriptdatavalue(buffer, name)
+    buffer += TYPE_UINT32.pack(AMF_ECMA_ARRAY, len(value))
+    pack_properties(buffer, value)
+    return bytes(buffer)
+
+def pack_scriptdatavalue(buffer, value):
+    """Append a value to a bytearray in AMF0 format
+    
+    Numbers, booleans, None (null), strings (bytes or str), dict()
+    objects, lists or tuples and datetime objects are supported. Long
+    strings are encoded as such. Naive datetimes are taken to be UTC."""
+    cls = type(value)
+    if cls is float or cls is int:  # Most common, so checked first
+        buffer += NUMBER.pack(AMF_NUMBER, value)
+    elif isinstance(value, bool):
+        buffer += bytes((AMF_BOOLEAN, value))
+    elif isinstance(value, (int, float)):
+        buffer += NUMBER.pack(AMF_NUMBER, value)
+    elif value is None:
+        buffer.append(AMF_NULL)
+    elif isinstance(value, (bytes, str)):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) > 0xFFFF:
+            buffer += TYPE_UINT32.pack(AMF_LONG_STRING, len(value))
+        else:
+            buffer += TYPE_UINT16.pack(AMF_STRING, len(value))
+        buffer += value
+    elif isinstance(value, dict):
+        buffer.append(AMF_OBJECT)
+        pack_properties(buffer, value)
+    elif isinstance(value, (list, tuple)):
+        buffer += TYPE_UINT32.pack(AMF_STRICT_ARRAY, len(value))
+        if all(type(item) is float or type(item) is int for item in value):
+            format = Struct(">" + "Bd" * len(value))
+            buffer += format.pack(*chain.from_iterable(
+                zip(repeat(AMF_NUMBER), value)))
+        else:
+            for item in value:
+                pack_scriptdatavalue(buffer, item)
+    elif isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        milliseconds = (value - EPOCH) / timedelta(milliseconds=1)
+        buffer.append(AMF_DATE)
+        buffer += DATE.pack(milliseconds, 0)
+    else:
+        msg = "Cannot encode {} as script data"
+        raise TypeError(msg.format(type(value).__name__))
+
+NUMBER = Struct(">Bd")
+TYPE_UINT16 = Struct(">BH")
+TYPE_UINT32 = Struct(">BI")
+
+def pack_properties(buffer, properties):
+    for (name, value) in properties.items():
+        buffer += pack_name(name)
+        pack_scriptdatavalue(buffer, value)
+    buffer += pack_name(b"")
+    buffer.append(AMF_OBJECT_END)
+
+def pack_name(name):
+    if isinstance(name, str):
+        name = name.encode("utf-8")
+    return UINT16.pack(len(name)) + name
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,165 @@
+"""FLV stream analytics
+
+Summarises the tag index from flvlib.scan_tags() using NumPy array
+operations, so that a multi-hour recording with hundreds of thousands of
+tags is analysed in seconds. Run as "python3 -m iview.flvlib --analyse"."""
+
+import numpy
+from . import flvlib
+
+def analyse(index, *, interval=10, gap=1):
+    """Summarise a tag index as a dict() that can be encoded as JSON
+    
+    Times are in seconds and bitrates in kb/s. Bitrates are measured over
+    "interval" seconds of each track's timestamps, and jumps in timestamps
+    longer than "gap" seconds are reported."""
+    offset = numpy.asarray(index["offset"], dtype=numpy.int64)
+    type = numpy.asarray(index["type"], dtype=numpy.uint8)
+    timestamp = numpy.asarray(index["timestamp"], dtype=numpy.int64)
+    length = numpy.asarray(index["length"], dtype=numpy.int64)
+    keyframe = numpy.asarray(index["keyframe"], dtype=bool)
+    
+    result = dict(tags=len(offset), tracks=dict())
+    if len(offset):
+        result["duration"] = float(timestamp.max() - timestamp.min()) / 1000
+        result["bytes"] = int(offset[-1] + flvlib.TAG_HEADER_LENGTH +
+            length[-1] + 4 - offset[0])
+    masks = dict()
+    for [name, tag_type] in TRACKS:
+        mask = type == tag_type
+        if not mask.any():
+            continue
+        masks[name] = mask
+        result["tracks"][name] = track_stats(offset[mask], timestamp[mask],
+            length[mask], interval=interval, gap=gap)
+    
+    if "video" in masks:
+        keyframes = timestamp[masks["video"] & keyframe]
+        result["gop"] = gop_stats(keyframes)
+    if "audio" in masks and "video" in masks:
+        result["drift"] = drift_stats(timestamp,
+            masks["audio"], masks["video"])
+    return result
+
+TRACKS = (("audio", flvlib.TAG_AUDIO), ("video", flvlib.TAG_VIDEO),
+    ("script", flvlib.TAG_SCRIPTDATA))
+
+def track_stats(offset, timestamp, length, *, interval, gap):
+    size = length + flvlib.TAG_HEADER_LENGTH + 4  # Including tag overhead
+    start = int(timestamp.min())
+    bucket = (timestamp - start) // int(interval * 1000)
+    series = numpy.bincount(bucket, weights=size) * 8 / interval / 1000
+    duration = float(timestamp.max() - start) / 1000
+    
+    result = dict(tags=len(size), bytes=int(size.sum()), start=start / 1000,
+        duration=duration)
+    bitrate = dict(interval=interval, series=series.round(1).tolist())
+    if duration:
+        bitrate["mean"] = float(size.sum()) * 8 / duration / 1000
+    # The last interval is usually only partly covered
+    if len(series) > 1:
+        bitrate["min"] = float(series[:-1].min())
+        bitrate["max"] = float(series[:-1].max())
+    result["bitrate"] = bitrate
+    
+    delta = numpy.diff(timestamp)
+    result["gaps"] = events(numpy.flatnonzero(delta > gap * 1000),
+        offset, timestamp, delta)
+    result["regressions"] = events(numpy.flatnonzero(delta < 0),
+        offset, timestamp, delta)
+    return result
+
+def events(indices, offset, timestamp, delta, limit=20):
+    """Describe jumps in timestamps, listing up to "limit" of them
+    
+    Each index refers to the jump between that tag and the next."""
+    jumps = delta[indices]
+    result = dict(count=len(indices))
+    if len(indices):
+        result["largest"] = float(abs(jumps).max()) / 1000
+    result["first"] = [dict(
+        offset=int(offset[i + 1]),
+        timestamp=float(timestamp[i + 1]) / 1000,
+        jump=float(delta[i]) / 1000,
+    ) for i in indices[:limit]]
+    return result
+
+def gop_stats(keyframes):
+    """Statistics of the time between video keyframes"""
+    result = dict(keyframes=len(keyframes))
+    lengths = numpy.diff(keyframes) / 1000
+    if not len(lengths):
+        return result
+    result.update(
+        mean=float(lengths.mean()),
+        min=float(lengths.min()),
+        max=float(lengths.max()),
+        percentiles=dict((str(p), float(value)) for [p, value] in
+            zip(PERCENTILES, numpy.percentile(lengths, PERCENTILES))),
+        # Number of GOPs lasting 0 to 1 s, 1 to 2 s, etc
+        histogram=numpy.bincount(
+            numpy.floor(numpy.maximum(lengths, 0)).astype(numpy.int64)
+        ).tolist(),
+    )
+    return result
+
+PERCENTILES = (50, 90, 99)
+
+def drift_stats(timestamp, audio, video):
+    """Audio timestamp minus video timestamp through the file
+    
+    At each tag, the latest audio and video timestamps so far are
+    compared, once both tracks have started."""
+    positions = numpy.arange(len(timestamp))
+    last_audio = numpy.maximum.accumulate(numpy.where(audio, positions, -1))
+    last_video = numpy.maximum.accumulate(numpy.where(video, positions, -1))
+    started = (last_audio >= 0) & (last_video >= 0)
+    drift = (timestamp[last_audio[started]] -
+        timestamp[last_video[started]]) / 1000
+    return dict(
+        mean=float(drift.mean()),
+        min=float(drift.min()),
+        max=float(drift.max()),
+        final=float(drift[-1]),
+    )
+
+def format_report(stats):
+    """Plain text summary of the result of analyse()"""
+    lines = ["{} tags".format(stats["tags"])]
+    if "duration" in stats:
+        lines[0] += ", {:.3F} s, {} bytes".format(stats["duration"],
+            stats["bytes"])
+    for [name, _] in TRACKS:
+        track = stats["tracks"].get(name)
+        if track is None:
+            continue
+        bitrate = track["bitrate"]
+        line = "{}: {} tags from {:.3F} s for {:.3F} s".format(name,
+            track["tags"], track["start"], track["duration"])
+        if "mean" in bitrate:
+            line += ", {:.1F} kb/s".format(bitrate["mean"])
+        if "min" in bitrate:
+            line += " ({:.1F} to {:.1F} per {} s)".format(bitrate["min"],
+                bitrate["max"], bitrate["interval"])
+        lines.append(line)
+        for event in ("gaps", "regressions"):
+            if track[event]["count"]:
+                lines.append("  {} {}, largest {:.3F} s".format(
+                    track[event]["count"], event, track[event]["largest"]))
+                for jump in track[event]["first"]:
+                    lines.append("    {:.3F} s at offset {}: {:+.3F} s".format(
+                        jump["timestamp"], jump["offset"], jump["jump"]))
+    gop = stats.get("gop")
+    if gop is not None:
+        line = "keyframes: {}".format(gop["keyframes"])
+        if "mean" in gop:
+            line += "; GOP {:.3F} s mean, {:.3F} to {:.3F} s".format(
+                gop["mean"], gop["min"], gop["max"])
+            line += ", 90% within {:.3F} s".format(gop["percentiles"]["90"])
+        lines.append(line)
+    drift = stats.get("drift")
+    if drift is not None:
+        lines.append("A/V drift: {:+.3F} s mean, {:+.3F} to {:+.3F} s, "
+            "{:+.3F} s at end".format(drift["mean"], drift["min"],
+            drift["max"], drift["final"]))
+    return "\n".join(lines)
@@ -20,194 +20,1110 @@ from urllib.request import urlopen
 import hmac
 from hashlib import sha256
 from .utils import CounterWriter, ZlibDecompressorWriter, TeeWriter
-from .utils import streamcopy, fastforward
+from .utils import fastforward
 from shutil import copyfileobj
-import urllib.request
-from .utils import PersistentConnectionHandler, http_get
+from tempfile import SpooledTemporaryFile
+from .utils import shared_session, http_get, ContentTypeError
+from .utils import bandwidth
 from sys import stderr, stdout
 from urllib.parse import urljoin, urlencode, quote_plus, urlsplit
+from urllib.parse import urlunsplit
 import io
 from .utils import xml_text_elements
 from . import flvlib
+from . import mp4
 from .utils import read_int, read_string, read_strict
-from .utils import WritingReader
+from .utils import readinto_strict, WriteBehindFile
 from errno import ESPIPE, EBADF, EINVAL
 import os
-from itertools import chain
+from itertools import chain, takewhile
+from functools import partial
 from .config import akamaihd_key
+from . import config
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from concurrent.futures import Future
+import threading
+import json
+from collections import deque
+from struct import Struct
+from array import array
+from bisect import bisect_left, bisect_right
+from time import sleep
+from .utils import monotonic
+from io import BufferedIOBase
+import http.client
+from urllib.error import HTTPError
 
 def fetch(*pos, dest_file=stdout.buffer, frontend=None, abort=None,
-        player=None, **kw):
+        player=None, prefetch=1, hedge=None, journal=None,
+        bitrate="highest", max_bitrate=None, size=None,
+        start=None, end=None, audio_only=False, format="flv",
+        keyframes=False, stripe=None, weight=1, **kw):
+    """Download an HDS stream to an FLV file
+    
+    If the destination file is seekable and already contains part of the
+    stream, the download is resumed. The optional "journal" parameter is a
+    Journal object, used to record committed fragments and to find the
+    resume point without scanning the whole file. If "hedge" is a
+    percentile, fragment requests slower than that percentile of recent
+    requests are duplicated (see HedgePolicy). The "bitrate" and
+    "max_bitrate" parameters select the rendition; see choose_rendition().
+    With bitrate="adaptive", the rendition may change between fragments
+    depending on the measured throughput. If "dest_file" is a
+    WriteBehindFile, space is reserved for the expected "size" in bytes,
+    or else an estimate from the duration and bitrate. If "start" or "end"
+    (seconds) is given, only that part of the stream is downloaded; see
+    start_range(). With "audio_only", video tags are dropped. The output
+    "format" is "flv", "mp4" for fragmented MP4 (see mp4.Mp4Writer), or
+    "adts" for just the AAC audio (see flvlib.AdtsWriter), which is not
+    resumed. With "keyframes", a keyframe index is added to the FLV
+    metadata; see reserve_index(). If "stripe" lists the URLs of other
+    hosts serving the same paths, fragments are spread over them; see
+    HostStriper. The download gets a share of the process's bandwidth
+    limit in proportion to its "weight"; see utils.BandwidthScheduler."""
+    if format not in FORMATS:
+        raise ValueError("Unknown output format {!r}".format(format))
+    if format == "adts":
+        audio_only = True
+    if format == "mp4" and bitrate == "adaptive":
+        # The codec configuration would change between fragments
+        raise ValueError("Adaptive bitrate is not supported for MP4")
+    if stripe and bitrate == "adaptive":
+        raise ValueError("Adaptive bitrate cannot be striped over hosts")
     url = manifest_url(*pos, **kw)
     
-    with PersistentConnectionHandler() as connection:
-        session = urllib.request.build_opener(connection)
-        
-        manifest = get_manifest(url, session)
-        url = manifest["baseURL"]
-        player = player_verification(manifest, player)
-        
-        duration = manifest.get("duration")
-        if duration:
-            duration = float(duration) or None
-        else:
-            duration = None
-        
-        # TODO: determine preferred bitrate, max bitrate, etc
-        media = manifest["media"][-1]  # Assume last one is most desirable
-        href = media.get("href")
-        if href is not None:
-            href = urljoin(url, href)
-            bitrate = media.get("bitrate")  # Save this in case the child manifest does not specify a bitrate
-            raise NotImplementedError("/manifest/media/@href -> child manifest")
-        
-        bootstrap = get_bootstrap(media,
-            session=session, url=url, player=player)
-        
-        metadata = media.get("metadata")
-        
-        media_url = media["url"] + bootstrap["movie_identifier"]
-        if "highest_quality" in bootstrap:
-            media_url += bootstrap["highest_quality"]
-        if "server_base_url" in bootstrap:
-            media_url = urljoin(bootstrap["server_base_url"], media_url)
-        media_url = urljoin(url, media_url)
-        
-        if not duration:
-            if bootstrap["time"]:
-                duration = bootstrap["time"] / bootstrap["timescale"]
-            elif metadata:
-                scriptdata = flvlib.parse_scriptdata(io.BytesIO(metadata))
-                assert scriptdata["name"] == b"onMetaData"
-                duration = scriptdata["value"].get("duration")
-        
-        [flv, frags] = start_flv(dest_file,
+    session = shared_session()
+    
+    manifest = get_manifest(url, session)
+    renditions = get_renditions(manifest, session, player)
+    rendition = choose_rendition(renditions, bitrate, max_bitrate)
+    media = rendition["media"]
+    url = rendition["url"]
+    player = rendition["player"]
+    
+    bootstrap = get_bootstrap(media,
+        session=session, url=url, player=player)
+    
+    metadata = media.get("metadata")
+    media_url = get_media_url(url, media, bootstrap)
+    duration = stream_duration(rendition["manifest"], media, bootstrap)
+    if keyframes:
+        if format != "flv" or bootstrap["live"] or not duration:
+            msg = "Keyframe index needs FLV output and a known duration"
+            raise ValueError(msg)
+        stream_metadata = metadata
+        metadata = reserve_index(metadata, duration)
+        keyframe_index = list()  # (timestamp, position) of each keyframe
+    else:
+        keyframe_index = None
+    if bitrate == "adaptive":
+        selector = AdaptiveSelector(renditions_within(renditions, max_bitrate),
+            rendition, media_url, session=session, parallel=prefetch)
+    else:
+        selector = None
+    if stripe:
+        striper = HostStriper(media_url, stripe)
+    else:
+        striper = None
+    
+    if start is None and end is None:
+        [flv, frags, resumed] = start_flv(dest_file,
             metadata=metadata, bootstrap=bootstrap,
             session=session, url=media_url, player=player,
-            frontend=frontend, duration=duration,
+            frontend=frontend, duration=duration, journal=journal,
+            audio_only=audio_only, format=format, keyframes=keyframes,
+            rendition=renditions.index(rendition),
+            adaptive=selector is not None,
         )
-        
-        for (index, seg, frag) in frags:
-            if abort and abort.is_set():
-                raise SystemExit()
-            response = get_frag(session, media_url, seg, frag, player=player)
-            
-            if abort and abort.is_set():
-                raise SystemExit()
-            parser = frag_to_flv(response, flv, strip_headers=index,
-                frontend=frontend, duration=duration)
-            next(parser)  # Download up to first FLV tag
-            
-            if abort and abort.is_set():
-                raise SystemExit()
-            next(parser)  # Download rest of fragment
-            
+        if resumed is not None and keyframe_index is not None:
+            keyframe_index.extend(scan_keyframes(dest_file, metadata))
+        if resumed is not None and selector is not None:
+            # The manifest may have changed since
+            if resumed < len(renditions):
+                selector.resume(renditions[resumed])
+            else:
+                selector.resume(None)
+        shift = 0
+        duration_offset = None
+    else:
+        [flv, frags, duration, duration_offset] = start_range(dest_file,
+            metadata=metadata, bootstrap=bootstrap, start=start, end=end,
+            frontend=frontend, duration=duration, journal=journal,
+            audio_only=audio_only, format=format,
+        )
+        journal = None
+        resumed = None
+        # Rebase timestamps to the first tag downloaded
+        shift = None if start else 0
+    if isinstance(dest_file, WriteBehindFile):
+        # The rendition bitrate includes video, so would overestimate
+        # audio on its own
+        if not size and duration and not audio_only:
+            rate = rendition["bitrate"] or 0
+            size = duration * rate * 1000 / 8
+        if size:
+            dest_file.preallocate(int(size))
+    
+    if bootstrap["live"]:
+        frags = live_frags(frags, media, bootstrap,
+            session=session, url=url, player=player, abort=abort)
+        prefetch = 1  # New fragments only trickle in at the live edge
+    stats = dict(retries=0, saved=0)
+    if hedge:
+        hedge = HedgePolicy(hedge, parallel=prefetch)
+    else:
+        hedge = None
+    throttle = bandwidth.join(weight)
+    if selector is not None:
+        frags = fetch_frags(frags, session=session, url=selector.url,
+            player=player, prefetch=prefetch, stats=stats, hedge=hedge,
+            throttle=throttle, meter=selector)
+    elif striper is not None:
+        frags = fetch_frags(frags, session=session, url=striper.url,
+            player=player, prefetch=prefetch, stats=stats, hedge=hedge,
+            throttle=throttle, striper=striper)
+    else:
+        frags = fetch_frags(frags, session=session, url=media_url,
+            player=player, prefetch=prefetch, stats=stats, hedge=hedge,
+            throttle=throttle)
+    # Sequence headers are already in the file if resuming, unless it ends
+    # with another rendition. The selector tracks this for itself.
+    strip_headers = resumed is not None and (selector is not None or
+        resumed == renditions.index(rendition))
+    timestamp = None
+    try:
+        for (index, seg, frag, response) in frags:
             if abort and abort.is_set():
                 raise SystemExit()
-            [] = parser  # Write to FLV
+            if selector is not None and selector.switched(index):
+                # Keep the new rendition's sequence headers
+                strip_headers = False
+                if not frontend:
+                    msg = "\nSwitching to {} kb/s"
+                    print(msg.format(selector.bitrate()), file=stderr)
+            committed = flv.tell()
+            try:
+                parser = frag_to_flv(response, flv,
+                    strip_headers=strip_headers, shift=shift,
+                    audio_only=audio_only, keyframes=keyframe_index,
+                    frontend=frontend, duration=duration)
+                first = next(parser)  # Download up to first FLV tag
+                if shift is None:
+                    shift = first
+                
+                if abort and abort.is_set():
+                    raise SystemExit()
+                next(parser)  # Download rest of fragment
+                
+                if abort and abort.is_set():
+                    raise SystemExit()
+                timestamp = next(parser)  # Write to FLV
+                if format == "mp4":
+                    flv.end_fragment(index + 1)
+            except BaseException:
+                # Large fragments are partly written before they finish
+                rollback(dest_file, flv, committed)
+                raise
+            response.close()
             strip_headers = True
+            if journal is not None:
+                if selector is not None:
+                    written = renditions.index(selector.rendition())
+                else:
+                    written = renditions.index(rendition)
+                commit(dest_file, partial(journal.append,
+                    index, frag, flv.tell(), timestamp, written))
+            else:
+                commit(dest_file)
+            if bootstrap["live"]:
+                latency = live_latency(bootstrap, timestamp)
+                progress_update(frontend, flv, timestamp / 1000, duration,
+                    latency=latency)
+    finally:
+        frags.close()
+        throttle.close()
+        if stats["retries"]:
+            msg = "{} fragment retries; {:.1F} MB saved by resuming"
+            print(msg.format(stats["retries"], stats["saved"] / 1e6),
+                file=stderr)
+        if hedge is not None:
+            hedge.close()
+            print(hedge.report(), file=stderr)
+        if striper is not None:
+            print(striper.report(), file=stderr)
+    
+    if keyframe_index is not None:
+        if timestamp is not None:
+            duration = timestamp / 1000
+        data = index_metadata(stream_metadata, len(metadata),
+            keyframes=keyframe_index, duration=duration, filesize=flv.tell())
+        overwrite(dest_file, flv, METADATA_POSITION, data)
+    elif duration_offset is not None and timestamp is not None:
+        # Replace the estimated duration with the actual duration
+        overwrite(dest_file, flv, duration_offset,
+            flvlib.DOUBLE_BE.pack(timestamp / 1000))
+    if not frontend:
+        print(file=stderr)
+
+def verify(*pos, dest_file, player=None, prefetch=1, bitrate="highest",
+        max_bitrate=None, repair=True, **kw):
+    """Check a downloaded FLV file against the stream, and re-download
+    only the fragments that are broken
+    
+    The tag timestamps in the file are compared with the timeline of the
+    fragment run table; see check_flv(). Broken fragments are downloaded
+    and spliced into a copy of the file, without any repeated tags, which
+    then replaces "dest_file" (a file name), unless "repair" is false.
+    Returns the result of check_flv(), with "refetched" listing the
+    fragment numbers downloaded."""
+    url = manifest_url(*pos, **kw)
+    session = shared_session()
+    manifest = get_manifest(url, session)
+    renditions = get_renditions(manifest, session, player)
+    rendition = choose_rendition(renditions, bitrate, max_bitrate)
+    media = rendition["media"]
+    url = rendition["url"]
+    player = rendition["player"]
+    bootstrap = get_bootstrap(media,
+        session=session, url=url, player=player)
+    if bootstrap["live"]:
+        raise ValueError("Live streams cannot be verified")
+    media_url = get_media_url(url, media, bootstrap)
+    duration = stream_duration(rendition["manifest"], media, bootstrap)
+    
+    with open(dest_file, "rb") as file, flvlib.map_file(file) as buffer:
+        result = check_flv(buffer, bootstrap)
+        result["refetched"] = list()
+        if not (result["broken"] or result["duplicates"]) or not repair:
+            return result
         
-        if not frontend:
+        pieces = list()  # (first, last, data) for each fragment
+        frags = (frag for frag in timeline(bootstrap)[0]
+            if frag[0] in result["broken"])
+        frags = fetch_frags(frags, session=session, url=media_url,
+            player=player, prefetch=prefetch)
+        temp = dest_file + ".verify"
+        try:
+            for (index, seg, frag, response) in frags:
+                data = SpooledTemporaryFile(config.hds_fragment_memory)
+                try:
+                    with response:
+                        # Sequence headers are only kept at the start
+                        parser = frag_to_flv(response, data,
+                            strip_headers=index > 0, duration=duration,
+                            audio_only=not result["header"]["video"])
+                        first = next(parser)
+                        next(parser)
+                        last = next(parser)
+                except BaseException:
+                    data.close()
+                    raise
+                data.seek(0)
+                pieces.append((first, last, data))
+                result["refetched"].append(frag)
             print(file=stderr)
+            with open(temp, "w+b") as output:
+                splice_flv(buffer, result, pieces, output)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        finally:
+            frags.close()
+            for [_, _, data] in pieces:
+                data.close()
+    os.replace(temp, dest_file)
+    return result
+
+def timeline(bootstrap):
+    """List the fragments of a stream with their nominal start times
+    
+    Returns (frags, starts, ends), where "frags" lists (index, seg, frag)
+    tuples, and "starts" and "ends" are arrays of timestamps in ms."""
+    frags = list(iter_frags(iter_segs(bootstrap), iter_frag_runs(bootstrap)))
+    starts = array("q")
+    ends = array("q")
+    timescale = bootstrap["frag_timescale"]
+    for run in iter_frag_runs(bootstrap):
+        for i in range(run["span"]):
+            start = run["timestamp"] + i * run["duration"]
+            starts.append(start // timescale)
+            ends.append((start + run["duration"]) // timescale)
+    return (frags, starts, ends)
+
+def check_flv(buffer, bootstrap):
+    """Compare the tags in an FLV file with the fragment run table
+    
+    Tags that go back in time repeat an earlier part of the stream, so
+    they are skipped up to the timestamp before the regression. Jumps in
+    the remaining timestamps longer than half a fragment are gaps. A
+    fragment is broken if a gap covers the middle of it. If the
+    end of the stream is missing, or the file ends with an incomplete tag,
+    the last fragment in the file is also counted as broken, since it
+    may have been cut short. Returns a dict() with:
+    
+    "header": From flvlib.unpack_file_header()
+    "metadata": Data of the "onMetaData" tag, or None
+    "start": File position after the header and metadata
+    "tags": Table of the "offset", "end" and "timestamp" of tags kept
+    "duplicates": Number of tags skipped
+    "truncated": True if the file ends with an incomplete tag
+    "gaps": List of (start, end) timestamps around missing data
+    "broken": Set of the indexes of broken fragments"""
+    [header, start] = flvlib.unpack_file_header(buffer)
+    metadata = None
+    if len(buffer) >= start + flvlib.TAG_HEADER_LENGTH:
+        tag = flvlib.unpack_tag_header(buffer, start)
+        if tag["type"] == flvlib.TAG_SCRIPTDATA:
+            data = start + flvlib.TAG_HEADER_LENGTH
+            metadata = bytes(buffer[data:data + tag["length"]])
+            start = data + tag["length"] + 4
+    [index, end] = flvlib.scan_tags(buffer, start)
+    incomplete = buffer[end:end + flvlib.TAG_HEADER_LENGTH]
+    truncated = any(incomplete)  # Not just preallocated space
+    
+    tags = dict(offset=array("q"), end=array("q"), timestamp=array("q"))
+    duplicates = 0
+    latest = None
+    repeated = None  # Skipping tags up to this timestamp
+    for [offset, length, timestamp] in zip(index["offset"], index["length"],
+    index["timestamp"]):
+        if repeated is None and latest is not None and timestamp < latest:
+            repeated = latest
+        if repeated is not None:
+            if timestamp <= repeated:
+                duplicates += 1
+                continue
+            repeated = None
+        tags["offset"].append(offset)
+        tags["end"].append(offset + flvlib.TAG_HEADER_LENGTH + length + 4)
+        tags["timestamp"].append(timestamp)
+        latest = timestamp
+    
+    [_, starts, ends] = timeline(bootstrap)
+    threshold = min(e - s for [s, e] in zip(starts, ends)) / 2
+    timestamps = tags["timestamp"]
+    if timestamps:
+        gaps = [(a, b) for [a, b] in zip(timestamps, timestamps[1:])
+            if b - a > threshold]
+        if timestamps[0] - starts[0] > threshold:
+            gaps.insert(0, (None, timestamps[0]))
+        if ends[-1] - timestamps[-1] > threshold:
+            gaps.append((timestamps[-1], None))
+    else:
+        gaps = [(None, None)]
+    
+    broken = set()
+    for [a, b] in gaps:
+        for i in range(len(starts)):
+            middle = (starts[i] + ends[i]) / 2
+            if (a is None or a < middle) and (b is None or middle < b):
+                broken.add(i)
+    if timestamps and (truncated or gaps and gaps[-1][1] is None):
+        broken.add(max(bisect_right(starts, timestamps[-1]) - 1, 0))
+    return dict(header=header, metadata=metadata, start=start, tags=tags,
+        duplicates=duplicates, truncated=truncated, gaps=gaps,
+        broken=broken)
+
+def splice_flv(buffer, check, pieces, output):
+    """Write a repaired copy of an FLV file
+    
+    The "pieces" are (first, last, data) tuples, where "data" is a stream
+    of tags with timestamps from "first" to "last", replacing any tags
+    kept by check_flv() in that range. A keyframe index in the metadata
+    is rebuilt to match."""
+    pieces = sorted(pieces, key=lambda piece: piece[0])
+    output.write(buffer[:check["start"]])
+    run = None  # (start, end) of consecutive tags to copy
+    
+    def flush():
+        nonlocal run
+        if run is not None:
+            output.write(buffer[run[0]:run[1]])
+            run = None
+    
+    tags = check["tags"]
+    i = 0
+    for [offset, end, timestamp] in zip(tags["offset"], tags["end"],
+    tags["timestamp"]):
+        while i < len(pieces) and pieces[i][0] <= timestamp:
+            flush()
+            copyfileobj(pieces[i][2], output)
+            i += 1
+        if i and timestamp <= pieces[i - 1][1]:
+            flush()  # Tag replaced by the fragment just written
+            continue
+        if run is not None and run[1] != offset:
+            flush()
+        run = (offset if run is None else run[0], end)
+    flush()
+    for [_, _, data] in pieces[i:]:
+        copyfileobj(data, output)
+    
+    metadata = check["metadata"]
+    if metadata and check["start"] == METADATA_POSITION + len(metadata) + 4:
+        [value, _] = flvlib.unpack_scriptdata(metadata)
+        if "keyframes" in value["value"]:
+            keyframes = scan_keyframes(output, metadata)
+            data = index_metadata(metadata, len(metadata),
+                keyframes=keyframes, filesize=output.tell())
+            output.seek(METADATA_POSITION)
+            output.write(data)
+            output.seek(0, io.SEEK_END)
+
+def plan(*pos, player=None, bitrate="highest", max_bitrate=None,
+        audio_only=False, **kw):
+    """Resolve a stream into a plan of the fragments to download
+    
+    The plan is a dict() holding the base "url" of the fragments, the
+    "player" verification parameters, the stream "metadata" and
+    "duration", "audio_only", and the list of (index, seg, frag) "frags".
+    It can be saved with write_plan(), so that ranges of fragments can be
+    downloaded separately by fetch_shard(), such as on different hosts,
+    and then joined with merge_shards()."""
+    url = manifest_url(*pos, **kw)
+    session = shared_session()
+    manifest = get_manifest(url, session)
+    renditions = get_renditions(manifest, session, player)
+    rendition = choose_rendition(renditions, bitrate, max_bitrate)
+    media = rendition["media"]
+    url = rendition["url"]
+    player = rendition["player"]
+    bootstrap = get_bootstrap(media,
+        session=session, url=url, player=player)
+    if bootstrap["live"]:
+        raise ValueError("Live streams cannot be planned")
+    return dict(
+        url=get_media_url(url, media, bootstrap),
+        player=player,
+        metadata=media.get("metadata"),
+        duration=stream_duration(rendition["manifest"], media, bootstrap),
+        audio_only=audio_only,
+        frags=list(iter_frags(iter_segs(bootstrap),
+            iter_frag_runs(bootstrap))),
+    )
+
+def write_plan(plan, file):
+    """Save a plan from plan() as JSON to a text stream"""
+    plan = dict(plan, version=PLAN_VERSION)
+    if plan["metadata"] is not None:
+        plan["metadata"] = b64encode(plan["metadata"]).decode("ascii")
+    json.dump(plan, file, indent=1)
+    file.write("\n")
+
+def read_plan(file):
+    """Load a plan saved by write_plan()"""
+    plan = json.load(file)
+    if plan.pop("version", None) != PLAN_VERSION:
+        raise ValueError("Unsupported download plan version")
+    if plan["metadata"] is not None:
+        plan["metadata"] = b64decode(plan["metadata"])
+    plan["frags"] = list(map(tuple, plan["frags"]))
+    return plan
+
+PLAN_VERSION = 1
+
+def fetch_shard(plan, dest_file, first=None, last=None, *, journal,
+        frontend=None, abort=None, prefetch=1, weight=1):
+    """Download the fragments of a plan from index "first" to "last"
+    into a separate FLV file
+    
+    The file starts with its own header, metadata and sequence headers,
+    so it can be played by itself. The "journal" is a Journal object,
+    which is used to resume the download, and is needed by
+    merge_shards() afterwards. The "dest_file" must be seekable. The
+    "weight" is as for fetch()."""
+    frags = [frag for frag in plan["frags"]
+        if (first is None or frag[0] >= first) and
+        (last is None or frag[0] <= last)]
+    if not frags:
+        raise ValueError("No fragments in range")
+    duration = plan["duration"]
+    
+    done = 0  # Number of fragments already written
+    with os.fdopen(dest_file.fileno(), "rb", closefd=False) as reader:
+        record = journal.check(reader)
+    start = journal.first()
+    if start is None or start["index"] != frags[0][0]:
+        record = None  # Journal belongs to a different range
+    if record is not None:
+        for (i, [index, _, frag]) in enumerate(frags):
+            if index == record["index"] and frag == record["frag"]:
+                done = i + 1
+                break
+        else:
+            record = None
+    
+    if record is None:
+        journal.reset()
+        dest_file.seek(0)
+        possibly_trunc(dest_file)
+        flvlib.write_file_header(dest_file,
+            audio=True, video=not plan["audio_only"])
+        if plan["metadata"]:
+            flvlib.write_scriptdata(dest_file, plan["metadata"])
+        progress_update(frontend, dest_file, 0, duration)
+    else:
+        dest_file.seek(record["offset"])
+        possibly_trunc(dest_file)
+        progress_update(frontend, dest_file, record["timestamp"] / 1000,
+            duration)
+    
+    throttle = bandwidth.join(weight)
+    frags = fetch_frags(frags[done:], session=shared_session(),
+        url=plan["url"], player=plan["player"], prefetch=prefetch,
+        throttle=throttle)
+    # Sequence headers are kept at the start of each shard
+    strip_headers = record is not None
+    try:
+        for (index, seg, frag, response) in frags:
+            if abort and abort.is_set():
+                raise SystemExit()
+            committed = dest_file.tell()
+            try:
+                with response:
+                    parser = frag_to_flv(response, dest_file,
+                        strip_headers=strip_headers, frontend=frontend,
+                        duration=duration, audio_only=plan["audio_only"])
+                    next(parser)
+                    next(parser)
+                    timestamp = next(parser)
+            except BaseException:
+                rollback(dest_file, dest_file, committed)
+                raise
+            strip_headers = True
+            commit(dest_file, partial(journal.append,
+                index, frag, dest_file.tell(), timestamp))
+    finally:
+        frags.close()
+        throttle.close()
+    if not frontend:
+        print(file=stderr)
+
+def merge_shards(plan, parts, output):
+    """Join the FLV files written by fetch_shard() into one stream
+    
+    The "parts" are file names, in order. Their journals must show that
+    together they hold every fragment of the plan. The file header and
+    metadata of each part after the first are dropped, as are the AAC
+    and AVC sequence headers at its start, as frag_to_flv() does with
+    "strip_headers"."""
+    indexes = [index for [index, _, _] in plan["frags"]]
+    ends = list()  # Length of the committed data in each part
+    position = 0  # Of the next fragment expected in "indexes"
+    for part in parts:
+        name = part + ".journal"
+        if not os.path.exists(name):
+            raise ValueError("No journal for {}".format(part))
+        with open(part, "rb") as file, Journal(name) as journal:
+            first = journal.first()
+            last = journal.check(file)
+        expected = indexes[position] if position < len(indexes) else None
+        if last is None or first["index"] != expected:
+            msg = "{} does not continue from fragment index {}"
+            raise ValueError(msg.format(part, expected))
+        position = indexes.index(last["index"]) + 1
+        ends.append(last["offset"])
+    if position < len(indexes):
+        msg = "Fragments from index {} are missing"
+        raise ValueError(msg.format(indexes[position]))
+    
+    for (i, [part, end]) in enumerate(zip(parts, ends)):
+        with open(part, "rb") as file, flvlib.map_file(file) as buffer, \
+        memoryview(buffer) as view:
+            if i:
+                ranges = shard_ranges(buffer, end)
+            else:
+                ranges = ((0, end),)
+            for [start, end] in ranges:
+                output.write(view[start:end])
 
-def get_bootstrap(media, *, session, url, player=""):
-    bootstrap = media["bootstrapInfo"]
-    bsurl = bootstrap.get("url")
+def shard_ranges(buffer, end):
+    """Ranges of a file from fetch_shard() to append to the previous part,
+    leaving out the header, metadata and leading sequence headers"""
+    [header, offset] = flvlib.unpack_file_header(buffer)
+    types = {flvlib.TAG_AUDIO}  # First tags of each type not yet seen
+    if header["video"]:
+        types.add(flvlib.TAG_VIDEO)
+    ranges = list()
+    start = offset
+    while types and offset + flvlib.TAG_HEADER_LENGTH <= end:
+        tag = flvlib.unpack_tag_header(buffer, offset)
+        data = offset + flvlib.TAG_HEADER_LENGTH
+        tag_end = data + tag["length"] + 4
+        if tag["type"] == flvlib.TAG_SCRIPTDATA:
+            skip = offset == start  # Metadata
+        elif tag["type"] in types:
+            types.remove(tag["type"])
+            skip = is_sequence_header(tag,
+                buffer[data:data + min(tag["length"], 2)])
+        else:
+            skip = False
+        if skip:
+            ranges.append((start, offset))
+            start = tag_end
+        offset = tag_end
+    ranges.append((start, end))
+    return ranges
+
+def get_renditions(manifest, session, player=None, children=None):
+    """List the renditions in a manifest, sorted by increasing bitrate
+    
+    Media items referring to a child manifest ("href") are replaced by the
+    media items of that manifest. Child manifests that are already parsed
+    may be given in "children", keyed by child_manifest_url(). Returns
+    dict() objects with the keys:
+    
+    "media": The media item from the manifest
+    "manifest": The manifest the media item came from
+    "url": The base URL of that manifest
+    "player": Player verification parameters from player_verification()
+    "bitrate": The bitrate in kb/s, or None if not specified"""
+    
+    if children is None:
+        children = dict()
+    renditions = list()
+    for media in manifest["media"]:
+        href = media.get("href")
+        if href is None:
+            items = ((manifest, media),)
+        else:
+            url = child_manifest_url(manifest, media)
+            child = children.get(url)
+            if child is None:
+                child = get_manifest(url, session)
+            items = ((child, item) for item in child["media"])
+        for (source, item) in items:
+            bitrate = item.get("bitrate") or media.get("bitrate")
+            if bitrate:
+                bitrate = int(float(bitrate))
+            else:
+                bitrate = None
+            renditions.append(dict(
+                media=item,
+                manifest=source,
+                url=source["baseURL"],
+                player=player_verification(source, player),
+                bitrate=bitrate,
+            ))
+    
+    # Stable sort, so without bitrates the last item is still assumed to
+    # be the most desirable
+    renditions.sort(key=lambda rendition: rendition["bitrate"] or 0)
+    return renditions
+
+def child_manifest_url(manifest, media):
+    url = urljoin(manifest["baseURL"], media["href"])
+    if not urlsplit(url).query:
+        # Pass on authentication parameters
+        query = urlsplit(manifest["baseURL"]).query
+        if query:
+            url = urljoin(url, "?" + query)
+    return url
+
+def choose_rendition(renditions, bitrate="highest", max_bitrate=None):
+    """Pick a rendition from the list returned by get_renditions()
+    
+    The "bitrate" policy is "highest", "lowest", or "adaptive", which
+    starts with the lowest. Only renditions up to "max_bitrate" (kb/s)
+    are considered, unless none qualify, in which case the lowest is
+    used."""
+    renditions = renditions_within(renditions, max_bitrate)
+    if bitrate == "highest":
+        return renditions[-1]
+    if bitrate in {"lowest", "adaptive"}:
+        return renditions[0]
+    raise ValueError("Unknown bitrate policy {!r}".format(bitrate))
+
+def renditions_within(renditions, max_bitrate=None):
+    """Renditions up to "max_bitrate", or just the lowest if none are"""
+    if max_bitrate is None:
+        return renditions
+    allowed = [rendition for rendition in renditions
+        if rendition["bitrate"] is None or rendition["bitrate"] <= max_bitrate]
+    return allowed or renditions[:1]
+
+class AdaptiveSelector:
+    """Chooses a rendition for each fragment from the measured throughput
+    
+    The throughput is a moving average over recent fragments, multiplied
+    by the number of fragments downloaded in "parallel". Each fragment is
+    requested from the highest rendition whose bitrate fits within
+    "safety" times the throughput. All the renditions are assumed to share
+    the same fragment timeline; the bootstrap of each is only downloaded
+    the first time it is used, to find its fragment URL."""
+    
+    def __init__(self, renditions, start, media_url, *, session,
+    parallel=1, safety=0.8, weight=0.3):
+        self.renditions = renditions
+        self.current = renditions.index(start)
+        self.urls = {self.current: media_url}
+        self.session = session
+        self.parallel = max(parallel, 1)
+        self.safety = safety
+        self.weight = weight
+        self.throughput = None  # bits per second, per connection
+        self.chosen = dict()  # Fragment index -> rendition index
+        self.written = self.current  # Rendition of last fragment written
+        self.lock = threading.Lock()
+    
+    def url(self, index):
+        """Choose the rendition for a fragment, and return its base URL"""
+        with self.lock:
+            throughput = self.throughput
+        if throughput is not None:
+            budget = throughput * self.parallel * self.safety
+            choice = 0
+            for (i, rendition) in enumerate(self.renditions):
+                if (rendition["bitrate"] or 0) * 1000 <= budget:
+                    choice = i
+            self.current = choice
+        self.chosen[index] = self.current
+        return self.media_url(self.current)
+    
+    def media_url(self, i):
+        url = self.urls.get(i)
+        if url is None:
+            rendition = self.renditions[i]
+            bootstrap = get_bootstrap(rendition["media"],
+                session=self.session, url=rendition["url"],
+                player=rendition["player"])
+            url = get_media_url(rendition["url"], rendition["media"],
+                bootstrap)
+            self.urls[i] = url
+        return url
+    
+    def record(self, size, seconds):
+        """Add the download time of a fragment to the average"""
+        if seconds <= 0:
+            return
+        sample = size * 8 / seconds
+        with self.lock:
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput += self.weight * (sample - self.throughput)
+    
+    def switched(self, index):
+        """Whether a fragment about to be written is from a different
+        rendition to the previous fragment"""
+        rendition = self.chosen.pop(index, self.written)
+        switched = rendition != self.written
+        self.written = rendition
+        return switched
+    
+    def resume(self, rendition):
+        """Continue from a file ending with a fragment of "rendition",
+        until the throughput has been measured"""
+        if rendition in self.renditions:
+            self.current = self.renditions.index(rendition)
+            self.written = self.current
+        else:
+            self.written = None  # Keep the sequence headers when switching
+    
+    def rendition(self):
+        """The rendition of the last fragment written"""
+        return self.renditions[self.written]
+    
+    def bitrate(self):
+        """Bitrate of the rendition of the last fragment written"""
+        return self.rendition()["bitrate"]
+
+def get_media_url(url, media, bootstrap):
+    """Base URL of the fragments of a media item"""
+    media_url = media["url"] + bootstrap["movie_identifier"]
+    if "highest_quality" in bootstrap:
+        media_url += bootstrap["highest_quality"]
+    if "server_base_url" in bootstrap:
+        media_url = urljoin(bootstrap["server_base_url"], media_url)
+    return urljoin(url, media_url)
+
+def stream_duration(manifest, media, bootstrap):
+    """Duration in seconds, or None if unknown or live"""
+    if bootstrap["live"]:
+        return None
+    duration = manifest.get("duration")
+    if duration:
+        duration = float(duration) or None
+    else:
+        duration = None
+    if not duration:
+        metadata = media.get("metadata")
+        if bootstrap["time"]:
+            duration = bootstrap["time"] / bootstrap["timescale"]
+        elif metadata:
+            [scriptdata, _] = flvlib.unpack_scriptdata(metadata)
+            assert scriptdata["name"] == b"onMetaData"
+            duration = scriptdata["value"].get("duration")
+    return duration
+
+def get_bootstrap(media, *, session, url, player="", update=None):
+    """Download and parse the bootstrap information for a media item
+    
+    If "update" is a previously parsed bootstrap, it is updated in place
+    from a fresh copy, as is needed for live streams. Only runs after the
+    end of its run tables are added to them."""
+    bsurl = bootstrap_url(media, url, player)
     if bsurl is not None:
-        bsurl = urljoin(url, bsurl)
-        bsurl = urljoin(bsurl, player)
         bootstrap = http_get(session, bsurl, ("video/abst",))
     else:
-        bootstrap = io.BytesIO(bootstrap["data"])
-    
+        bootstrap = io.BytesIO(media["bootstrapInfo"]["data"])
     with bootstrap:
-        (type, _) = read_box_header(bootstrap)
-        assert type == b"abst"
-        
-        result = dict()
-        
-        fastforward(bootstrap, 1 + 3 + 4)  # Version, flags, bootstrap version
-        
-        flags = read_int(bootstrap, 1)
-        flags >> 6  # Profile
-        bool(flags & 0x20)  # Live flag
-        bool(flags & 0x10)  # Update flag
-        
-        result["timescale"] = read_int(bootstrap, 4)  # Time scale
-        result["time"] = read_int(bootstrap, 8)  # Media time at end of bootstrap
-        fastforward(bootstrap, 8)  # SMPTE timecode offset
-        
-        result["movie_identifier"] = read_string(bootstrap).decode("utf-8")
-        
-        count = read_int(bootstrap, 1)  # Server table
-        for _ in range(count):
-            entry = read_string(bootstrap)
-            if "server_base_url" not in result:
-                result["server_base_url"] = entry.decode("utf-8")
-        
-        count = read_int(bootstrap, 1)  # Quality table
-        for _ in range(count):
-            quality = read_string(bootstrap)
-            if "highest_quality" not in result:
-                result["highest_quality"] = quality.decode("utf-8")
-        
-        read_string(bootstrap)  # DRM data
-        read_string(bootstrap)  # Metadata
-        
-        # Read segment and fragment run tables. Read the first table of each type
-        # that is understood, and skip any subsequent ones.
-        count = read_int(bootstrap, 1)
-        for _ in range(count):
-            if "seg_runs" not in result:
-                (qualities, runs) = read_asrt(bootstrap)
-                if not qualities or result.get("highest_quality") in qualities:
-                    result["seg_runs"] = runs
-            else:
-                skip_box(bootstrap)
+        return parse_bootstrap(bootstrap, update)
+
+def bootstrap_url(media, url, player=""):
+    """URL to download the bootstrap from, or None if it is inline"""
+    bsurl = media["bootstrapInfo"].get("url")
+    if bsurl is not None:
+        bsurl = urljoin(url, bsurl)
+        bsurl = urljoin(bsurl, player)
+    return bsurl
+
+def parse_bootstrap(bootstrap, update=None):
+    """Parse an "abst" box from a byte stream; see get_bootstrap()"""
+    (type, _) = read_box_header(bootstrap)
+    assert type == b"abst"
+    
+    result = dict()
+    previous = update or dict()
+    
+    fastforward(bootstrap, 1 + 3 + 4)  # Version, flags, bootstrap version
+    
+    flags = read_int(bootstrap, 1)
+    flags >> 6  # Profile
+    result["live"] = bool(flags & 0x20)  # Live flag
+    bool(flags & 0x10)  # Update flag
+    
+    result["timescale"] = read_int(bootstrap, 4)  # Time scale
+    result["time"] = read_int(bootstrap, 8)  # Media time at end of bootstrap
+    result["received"] = monotonic()
+    fastforward(bootstrap, 8)  # SMPTE timecode offset
+    
+    result["movie_identifier"] = read_string(bootstrap).decode("utf-8")
+    
+    count = read_int(bootstrap, 1)  # Server table
+    for _ in range(count):
+        entry = read_string(bootstrap)
+        if "server_base_url" not in result:
+            result["server_base_url"] = entry.decode("utf-8")
+    
+    count = read_int(bootstrap, 1)  # Quality table
+    for _ in range(count):
+        quality = read_string(bootstrap)
+        if "highest_quality" not in result:
+            result["highest_quality"] = quality.decode("utf-8")
+    
+    read_string(bootstrap)  # DRM data
+    read_string(bootstrap)  # Metadata
+    
+    # Read segment and fragment run tables. Read the first table of each type
+    # that is understood, and skip any subsequent ones.
+    count = read_int(bootstrap, 1)
+    for _ in range(count):
         if "seg_runs" not in result:
-            fmt = "Segment run table not found (quality = {!r})"
-            raise LookupError(fmt.format(result.get("highest_quality")))
-        
-        count = read_int(bootstrap, 1)
-        for _ in range(count):
-            if "frag_runs" not in result:
-                (qualities, runs, timescale) = read_afrt(bootstrap)
-                if not qualities or result.get("highest_quality") in qualities:
-                    result["frag_runs"] = runs
-                    result["frag_timescale"] = timescale
-            else:
-                skip_box(bootstrap)
+            (qualities, runs) = read_asrt(bootstrap)
+            if not qualities or result.get("highest_quality") in qualities:
+                result["seg_runs"] = seg_run_table(runs,
+                    previous.get("seg_runs"))
+        else:
+            skip_box(bootstrap)
+    if "seg_runs" not in result:
+        fmt = "Segment run table not found (quality = {!r})"
+        raise LookupError(fmt.format(result.get("highest_quality")))
+    
+    count = read_int(bootstrap, 1)
+    for _ in range(count):
         if "frag_runs" not in result:
-            fmt = "Fragment run table not found (quality = {!r})"
-            raise LookupError(fmt.format(result.get("highest_quality")))
+            (qualities, runs, timescale) = read_afrt(bootstrap)
+            if not qualities or result.get("highest_quality") in qualities:
+                if result["live"]:
+                    # Last run extends up to the current media time
+                    end = result["time"] * 1000 * timescale
+                    end //= result["timescale"]
+                else:
+                    end = None
+                result["frag_runs"] = frag_run_table(runs,
+                    previous.get("frag_runs"), end)
+                result["frag_timescale"] = timescale
+        else:
+            skip_box(bootstrap)
+    if "frag_runs" not in result:
+        fmt = "Fragment run table not found (quality = {!r})"
+        raise LookupError(fmt.format(result.get("highest_quality")))
     
+    if update is not None:
+        update.update(result)
+        return update
     return result
 
-def start_flv(dest_file, *,
-metadata, bootstrap, session, url, player="", frontend=None, duration=None):
-    """Determine resume point, or write out start of FLV"""
-    frags = resume_point(dest_file,
-        metadata=metadata, bootstrap=bootstrap,
-        session=session, url=url, player=player,
-        frontend=frontend, duration=duration,
-    )
-    if frags is not None:
-        return (dest_file, frags)
+def live_frags(frags, media, bootstrap, *, session, url, player="",
+abort=None):
+    """Yields from "frags", then keeps polling a live bootstrap for more
+    
+    The bootstrap is refreshed about once every fragment duration until
+    new fragments appear, or until it is no longer marked as live."""
+    table = bootstrap["frag_runs"]
+    next_index = table["frag_index"][-1] + table["span"][-1]
+    for (index, seg, frag) in frags:
+        yield (index, seg, frag)
+        next_index = index + 1
+    
+    if media["bootstrapInfo"].get("url") is None:
+        return  # Nowhere to refresh from
+    while bootstrap["live"]:
+        interval = table["duration"][-1] / bootstrap["frag_timescale"] / 1000
+        if abort:
+            if abort.wait(interval):
+                raise SystemExit()
+        else:
+            sleep(interval)
+        
+        get_bootstrap(media, session=session, url=url, player=player,
+            update=bootstrap)
+        for (index, seg, frag) in frags_from(bootstrap, next_index):
+            yield (index, seg, frag)
+            next_index = index + 1
+
+def live_latency(bootstrap, timestamp):
+    """Estimate how far the timestamp (ms) is behind the live edge"""
+    edge = bootstrap["time"] / bootstrap["timescale"]
+    edge += monotonic() - bootstrap["received"]
+    return edge - timestamp / 1000
+
+def start_flv(dest_file, *, metadata, bootstrap, session, url, player="",
+frontend=None, duration=None, journal=None, audio_only=False, format="flv",
+keyframes=False, rendition=0, adaptive=False):
+    """Determine resume point, or write out start of FLV
+    
+    Returns (flv, frags, resumed), where "resumed" is None if starting
+    from the beginning, or else the index of the rendition of the last
+    fragment in the file. Live streams and ADTS output are not resumed,
+    and MP4 output is only resumed from the journal. Live streams start
+    at the live edge. The "rendition" and "adaptive" parameters are
+    passed to resume_point()."""
+    if not bootstrap["live"] and format == "flv":
+        resumed = resume_point(dest_file,
+            metadata=metadata, bootstrap=bootstrap,
+            session=session, url=url, player=player,
+            frontend=frontend, duration=duration, journal=journal,
+            audio_only=audio_only, keyframes=keyframes,
+            rendition=rendition, adaptive=adaptive,
+        )
+        if resumed is not None:
+            [frags, rendition] = resumed
+            return (dest_file, frags, rendition)
+    if not bootstrap["live"] and format == "mp4" and journal is not None:
+        resumed = resume_journal(dest_file, journal, bootstrap)
+        if resumed is not None:
+            [offset, last_ts, frags, rendition] = resumed
+            flv = mp4.Mp4Writer(dest_file, offset=offset)
+            progress_update(frontend, flv, last_ts / 1000, duration)
+            return (flv, frags, rendition)
     
-    flv = CounterWriter(dest_file)  # Track size even if piping to stdout
+    if journal is not None:
+        journal.reset()
+    flv = new_writer(dest_file, format)
     progress_update(frontend, flv, 0, duration)
     
     possibly_trunc(dest_file)
+    frags = new_flv(flv, metadata=metadata, bootstrap=bootstrap,
+        audio_only=audio_only)
+    return (flv, frags, None)
+
+def new_writer(dest_file, format="flv"):
+    """Wrap the destination file to track its size even if piping to
+    stdout, and to convert the FLV stream to other formats"""
+    if format == "adts":
+        return flvlib.AdtsWriter(dest_file)
+    if format == "mp4":
+        return mp4.Mp4Writer(dest_file)
+    return CounterWriter(dest_file)
+
+FORMATS = {"flv", "mp4", "adts"}
+
+def start_range(dest_file, *, metadata, bootstrap, start=None, end=None,
+frontend=None, duration=None, journal=None, audio_only=False, format="flv"):
+    """Write out the start of an FLV file for part of a stream
+    
+    Only the fragments covering "start" to "end" (seconds) are listed, so
+    the range is only as precise as the fragment boundaries. Ranges are
+    not resumed. The "duration" property of the metadata is set to the
+    length of the range. Returns (flv, frags, duration, duration_offset),
+    where "duration_offset" is the position of the duration number in the
+    file, or None if there is no metadata or the duration is unknown."""
+    if bootstrap["live"]:
+        raise ValueError("Time ranges of live streams are not supported")
+    if start is None:
+        start = 0
+    if end is not None and duration is not None and end >= duration:
+        end = None
+    if end is not None and end <= start:
+        raise ValueError("End of range is not after start")
+    
+    if start:
+        frags = frags_from(bootstrap, frag_index_at(bootstrap, start * 1000))
+    else:
+        frags = iter_frags(iter_segs(bootstrap), iter_frag_runs(bootstrap))
+    if end is not None:
+        try:
+            # Exclude a fragment starting exactly at the end
+            last = frag_index_at(bootstrap, max(end * 1000 - 1, start * 1000))
+        except ValueError:  # End is past the last fragment run
+            pass
+        else:
+            frags = takewhile(lambda frag: frag[0] <= last, frags)
+        duration = end - start
+    elif duration is not None:
+        duration -= start
+    
+    if journal is not None:
+        journal.reset()
+    flv = new_writer(dest_file, format)
+    progress_update(frontend, flv, 0, duration)
+    possibly_trunc(dest_file)
+    flvlib.write_file_header(flv, audio=True, video=not audio_only)
+    duration_offset = None
+    if metadata:
+        if duration is not None and format == "flv":
+            [metadata, duration_offset] = flvlib.update_number(metadata,
+                "duration", duration)
+            duration_offset += flv.tell() + flvlib.TAG_HEADER_LENGTH
+        flvlib.write_scriptdata(flv, metadata)
+    return (flv, frags, duration, duration_offset)
+
+def frag_index_at(bootstrap, timestamp):
+    """Estimate the index of the fragment containing a timestamp (ms)"""
+    [run, ts_offset, _] = find_frag_run(bootstrap, timestamp)
+    offset = ts_offset * run["span"] // run["run_duration"]
+    return run["frag_index"] + int(offset)
+
+def new_flv(flv, *, metadata, bootstrap, audio_only=False):
+    """Write the start of a new FLV file, and return the fragments to
+    download as (index, seg, frag) tuples"""
     # Assume audio and video tags will be present
-    flvlib.write_file_header(flv, audio=True, video=True)
+    flvlib.write_file_header(flv, audio=True, video=not audio_only)
     
     if metadata:
         flvlib.write_scriptdata(flv, metadata)
-    frags = iter_frags(iter_segs(bootstrap), iter_frag_runs(bootstrap))
-    return (flv, frags)
+    if bootstrap["live"]:
+        table = bootstrap["frag_runs"]
+        last = table["frag_index"][-1] + table["span"][-1] - 1
+        return frags_from(bootstrap, last)
+    else:
+        return iter_frags(iter_segs(bootstrap), iter_frag_runs(bootstrap))
 
-def resume_point(dest_file, *,
-metadata, bootstrap, session, url, player="", frontend=None, duration=None):
+def resume_point(dest_file, *, metadata, bootstrap, session, url, player="",
+frontend=None, duration=None, journal=None, audio_only=False,
+keyframes=False, rendition=0, adaptive=False):
+    """Find where to resume an FLV file
+    
+    Returns (frags, rendition) with the fragments left and the index of
+    the rendition the file ends with, or None. With "keyframes", the
+    metadata may already have been rewritten with a keyframe index of the
+    same length. Without a usable journal, the end of the file is assumed
+    to be from "rendition", which is where "url" is for; but if the
+    rendition is "adaptive", the file is not resumed, because it could
+    have been from any of them."""
     try:
         start = dest_file.tell()  # Ensures file is seekable
         fd = dest_file.fileno()
@@ -221,10 +1137,9 @@ metadata, bootstrap, session, url, player="", frontend=None, duration=None):
     with os.fdopen(fd, "rb", closefd=False) as reader:
         try:
             header = flvlib.read_file_header(reader)
-            if header != dict(audio=True, video=True):
+            if header != dict(audio=True, video=not audio_only):
                 raise ValueError(header)
             
-            print("Scanning existing FLV file", file=stderr)
             if metadata:
                 tag = flvlib.read_tag_header(reader)
                 if tag is None:
@@ -239,11 +1154,29 @@ metadata, bootstrap, session, url, player="", frontend=None, duration=None):
                 if tag != expected:
                     raise ValueError(tag)
                 data = read_strict(reader, tag["length"])
-                if data != metadata:
+                if data != metadata and not keyframes:
                     raise ValueError()
                 fastforward(reader, 4)
             
-            tag = scan_last_tag(reader)
+            if journal is not None:
+                body = reader.tell()
+                resumed = journal.resume(reader, bootstrap)
+                if resumed is not None:
+                    [offset, last_ts, frags, written] = resumed
+                    dest_file.seek(offset)
+                    possibly_trunc(dest_file)
+                    progress_update(frontend, dest_file, last_ts / 1000,
+                        duration)
+                    return (frags, written)
+                journal.reset()
+                reader.seek(body)
+            
+            if adaptive:
+                print("Cannot resume adaptive bitrate download without "
+                    "its journal; starting again", file=stderr)
+                raise EOFError()
+            print("Scanning existing FLV file", file=stderr)
+            [tag, index] = scan_last_tag(reader)
         except EOFError:
             pass
         except EnvironmentError as err:
@@ -270,7 +1203,7 @@ metadata, bootstrap, session, url, player="", frontend=None, duration=None):
                 response = get_frag(session, url, next(segs), frag,
                     player=player)
                 parser = frag_to_flv(response, dest_file,
-                    strip_headers=frag_index,
+                    strip_headers=frag_index, audio_only=audio_only,
                     frontend=frontend, duration=duration)
                 timestamp = next(parser)
                 if timestamp <= last_ts:
@@ -284,114 +1217,831 @@ metadata, bootstrap, session, url, player="", frontend=None, duration=None):
                 if not ref_offset:
                     # Fragment run starts too late; update timestamp in run
                     # table and find another run entry
-                    run["timestamp"] = ref_time
+                    retime_run(bootstrap, run, ref_time)
             else:
                 msg = "Failed estimating resume fragment after 3 tries"
                 raise OverflowError(msg)
             
-            # Assumes timestamps in different fragments are unequal
-            seek_backwards(reader, timestamp)
-            dest_file.seek(reader.tell())
-            next(parser)  # Finish downloading fragment
-            
-            possibly_trunc(dest_file)
-            [] = parser  # Write to FLV
+            with response:
+                # Assumes timestamps in different fragments are unequal
+                seek_backwards(reader, timestamp, index)
+                dest_file.seek(reader.tell())
+                next(parser)  # Finish downloading fragment
+                
+                possibly_trunc(dest_file)
+                last_ts = next(parser)  # Write to FLV
+            if journal is not None:
+                commit(dest_file, partial(journal.append,
+                    frag_index, frag, dest_file.tell(), last_ts, rendition))
             run["frag_index"] += offset + 1
             run["first"] += offset + 1
             run["span"] -= offset + 1
-            return iter_frags(segs, chain((run,), frag_runs))
+            return (iter_frags(segs, chain((run,), frag_runs)), rendition)
     
     # EOF before first tag, or file descriptor not readable
     dest_file.seek(start)
     return None
 
-def scan_last_tag(reader):
-    good_tag = None
-    timestamp = None
+def resume_journal(dest_file, journal, bootstrap):
+    """Find the resume point of a file other than FLV from its journal
+    
+    Returns (offset, timestamp, frags, rendition) like Journal.resume(),
+    after truncating the file at the offset, or None."""
     try:
-        while True:
-            tag_end = reader.tell()
-            tag = flvlib.read_tag_header(reader)
-            if tag is None:
-                raise EOFError()
-            
-            # Ensure timestamps are not out of order
-            if timestamp is not None and tag["timestamp"] < timestamp:
-                raise ValueError(tag["timestamp"])
-            timestamp = tag["timestamp"]
-            
-            fastforward(reader, tag["length"] + 4)
-            good_tag = tag
-    except EOFError:
-        if not good_tag:
-            raise
-    reader.seek(tag_end)
-    return good_tag
+        dest_file.tell()  # Ensures file is seekable
+        fd = dest_file.fileno()
+    except io.UnsupportedOperation:
+        return None
+    except EnvironmentError as err:
+        if err.errno == ESPIPE:
+            return None
+        raise
+    with os.fdopen(fd, "rb", closefd=False) as reader:
+        resumed = journal.resume(reader, bootstrap, check_tag=False)
+    if resumed is not None:
+        dest_file.seek(resumed[0])
+        possibly_trunc(dest_file)
+    return resumed
 
-def get_frag(session, url, seg, frag, player=""):
+class Journal:
+    """Append-only record of the fragments committed to an FLV file
+    
+    Each record holds the fragment index, the fragment number, the file
+    offset at the end of the fragment, the timestamp of its last tag, and
+    the index of the rendition it came from, in the list from
+    get_renditions(). Records have a fixed size, so the last one is found
+    without reading the rest of the journal."""
+    
+    RECORD = Struct(">QQQqI")
+    
+    def __init__(self, path):
+        self.file = open(path, "a+b")
+    
+    def append(self, index, frag, offset, timestamp, rendition=0):
+        self.file.write(self.RECORD.pack(index, frag, offset, timestamp,
+            rendition))
+        self.file.flush()
+    
+    def reset(self):
+        self.file.truncate(0)
+    
+    def last(self):
+        """Returns the last complete record as a dict(), or None"""
+        size = self.file.seek(0, io.SEEK_END)
+        size -= size % self.RECORD.size
+        self.file.truncate(size)  # Drop any partially written record
+        if not size:
+            return None
+        self.file.seek(size - self.RECORD.size)
+        return self.read_record()
+    
+    def first(self):
+        """Returns the first complete record as a dict(), or None"""
+        size = self.file.seek(0, io.SEEK_END)
+        if size < self.RECORD.size:
+            return None
+        self.file.seek(0)
+        return self.read_record()
+    
+    def read_record(self):
+        record = read_strict(self.file, self.RECORD.size)
+        [index, frag, offset, timestamp, rendition] = self.RECORD.unpack(
+            record)
+        return dict(index=index, frag=frag, offset=offset,
+            timestamp=timestamp, rendition=rendition)
+    
+    def check(self, reader, check_tag=True):
+        """Returns the last record if it is consistent with the file,
+        otherwise None; see resume()"""
+        record = self.last()
+        if record is None:
+            return None
+        
+        size = reader.seek(0, io.SEEK_END)
+        if record["offset"] > size:
+            return None
+        if check_tag:
+            reader.seek(record["offset"])
+            tag = flvlib.read_prev_tag(reader)
+            if tag is None or tag["timestamp"] != record["timestamp"]:
+                return None
+        return record
+    
+    def resume(self, reader, bootstrap, check_tag=True):
+        """Check the last record against the FLV file and bootstrap
+        
+        Returns (offset, timestamp, frags, rendition) if consistent, where
+        "frags" iterates over the remaining fragments, otherwise None. Unless
+        "check_tag" is true, the file is only checked to be long enough,
+        which allows for formats other than FLV."""
+        record = self.check(reader, check_tag)
+        if record is None:
+            return None
+        
+        frags = frags_from(bootstrap, record["index"])
+        if next(frags, (None, None, None))[2] != record["frag"]:
+            return None
+        return (record["offset"], record["timestamp"], frags,
+            record["rendition"])
+    
+    def close(self):
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def scan_last_tag(reader):
+    """Find the last complete tag from the reader's position
+    
+    Returns (tag, index), where "index" is from flvlib.scan_tags(), and
+    leaves the reader positioned after the tag."""
+    with flvlib.map_file(reader) as buffer:
+        [index, end] = flvlib.scan_tags(buffer, reader.tell())
+        if not index["offset"]:
+            raise EOFError()
+        
+        # Ensure timestamps are not out of order
+        timestamps = index["timestamp"]
+        for i in range(1, len(timestamps)):
+            if timestamps[i] < timestamps[i - 1]:
+                raise ValueError(timestamps[i])
+        tag = flvlib.unpack_tag_header(buffer, index["offset"][-1])
+    reader.seek(end)
+    return (tag, index)
+
+def get_frag(session, url, seg, frag, player="", stats=None, hedge=None,
+meter=None, striper=None, throttle=None):
     url = "{}Seg{}-Frag{}".format(url, seg, frag)
     url = urljoin(url, player)
-    return http_get(session, url, ("video/f4f",))
+    return FragmentReader(session, url, stats=stats, hedge=hedge,
+        meter=meter, striper=striper, throttle=throttle)
+
+class FragmentReader(BufferedIOBase):
+    """Reads a fragment over HTTP, retrying after errors and stalls
+    
+    A stall is when the connection times out waiting for data. Retries
+    are delayed with exponential backoff. Once part of the fragment has
+    been read, a retry requests the remainder with an HTTP Range header,
+    falling back to skipping over the data already read if the server
+    sends the whole fragment again. If "stats" is given, it should be a
+    dict() with "retries" and "saved" counters, which are incremented with
+    the number of retries and bytes not downloaded again. Requests for the
+    start of the fragment go through the "hedge" HedgePolicy if given.
+    When the end of the fragment is reached, "meter.record(size, seconds)"
+    is called if "meter" is given. With a HostStriper as "striper", the
+    download time is also recorded for the host, and after an error or
+    unexpected content type, the request is moved to another host
+    straight away when there is one. Reading waits as needed for the
+    "throttle" from utils.bandwidth, if given."""
+    
+    def __init__(self, session, url, *, stats=None, hedge=None, meter=None,
+    striper=None, throttle=None, retries=None, delay=None):
+        self.session = session
+        self.url = url
+        self.hedge = hedge
+        self.meter = meter
+        self.striper = striper
+        self.throttle = throttle
+        self.started = monotonic()
+        if stats is None:
+            stats = dict(retries=0, saved=0)
+        self.stats = stats
+        if retries is None:
+            retries = config.hds_retries
+        self.retries = retries
+        if delay is None:
+            delay = config.hds_retry_delay
+        self.delay = delay
+        self.position = 0
+        self.response = None
+        self._retry(lambda: None)  # Send initial request
+    
+    def readinto(self, b):
+        size = self._retry(lambda: self._readinto(b))
+        self.position += size
+        if size and self.throttle is not None:
+            self.throttle.consume(size)
+        if not size and len(b) and self.started is not None:
+            seconds = monotonic() - self.started
+            if self.meter is not None:
+                self.meter.record(self.position, seconds)
+            if self.striper is not None:
+                self.striper.record(self.url, self.position, seconds)
+            self.started = None
+        return size
+    
+    def _readinto(self, b):
+        size = self.response.readinto(b)
+        # "http.client" does not treat a short body as an error
+        remaining = getattr(self.response, "length", None)
+        if not size and len(b) and remaining:
+            raise http.client.IncompleteRead(b"", remaining)
+        return size
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = list()
+            while True:
+                chunk = self.read(0x10000)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        buffer = bytearray(size)
+        return bytes(memoryview(buffer)[:self.readinto(buffer)])
+    
+    def _retry(self, func):
+        attempt = 0
+        while True:
+            try:
+                if self.response is None:
+                    self._request()
+                return func()
+            except (EnvironmentError, http.client.HTTPException,
+            ContentTypeError) as err:
+                if attempt >= self.retries:
+                    raise
+                url = None
+                if self.striper is not None:
+                    url = self.striper.failed(self.url)
+                if url is not None:
+                    print("Moving fragment to {} after {!r}".format(
+                        urlsplit(url).netloc, err), file=stderr)
+                    self.url = url
+                else:
+                    # Retrying is not likely to help
+                    if isinstance(err, ContentTypeError):
+                        raise
+                    if isinstance(err, HTTPError) and err.code < 500:
+                        raise
+                    print("Retrying fragment after {!r}".format(err),
+                        file=stderr)
+            if self.response is not None:
+                self.response.close()
+                self.response = None
+            if url is None:
+                sleep(self.delay * 2 ** attempt)
+            attempt += 1
+            self.stats["retries"] += 1
+    
+    def _request(self):
+        headers = dict()
+        if self.position:
+            headers["Range"] = "bytes={}-".format(self.position)
+        def request():
+            return http_get(self.session, self.url, ("video/f4f",),
+                headers=headers)
+        if self.hedge is not None and not self.position:
+            self.response = self.hedge.open(request)
+        else:
+            self.response = request()
+        if self.position:
+            if self.response.status == http.client.PARTIAL_CONTENT:
+                self.stats["saved"] += self.position
+            else:
+                fastforward(self.response, self.position)
+    
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        BufferedIOBase.close(self)
+
+class HedgePolicy:
+    """Sends a duplicate request when the first is slow to respond
+    
+    Once enough requests have been timed, a request still waiting for a
+    response after the given percentile of recent response times is sent
+    again, on another connection from the session's pool, and whichever
+    response arrives first is used. The "requests", "hedged" and "won"
+    attributes count the requests, the duplicates sent, and the duplicates
+    that responded first. First requests share a pool of threads, sized
+    for "parallel" callers plus the slow requests they leave behind, but
+    each duplicate gets its own thread, so that it is never queued behind
+    the requests it is racing."""
+    
+    def __init__(self, percentile=95, *, samples=50, min_samples=10,
+    parallel=1):
+        self.percentile = percentile
+        self.times = deque(maxlen=samples)
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(2 * parallel)
+    
+    def open(self, request):
+        """Call "request()" and return its response"""
+        start = monotonic()
+        threshold = self.time_percentile(self.percentile)
+        with self.lock:
+            self.requests += 1
+        if threshold is None:
+            response = request()
+            self._record(start)
+            return response
+        
+        primary = self.executor.submit(request)
+        wait((primary,), threshold)
+        if primary.done():
+            response = primary.result()
+            self._record(start)
+            return response
+        
+        with self.lock:
+            self.hedged += 1
+        hedge = start_thread(request)
+        for future in as_completed((primary, hedge)):
+            try:
+                response = future.result()
+            except Exception as err:
+                error = err
+                continue
+            if future is hedge:
+                other = primary
+                with self.lock:
+                    self.won += 1
+            else:
+                other = hedge
+            other.add_done_callback(close_response)
+            self._record(start)
+            return response
+        raise error
+    
+    def _record(self, start):
+        with self.lock:
+            self.times.append(monotonic() - start)
+    
+    def time_percentile(self, percentile):
+        """Response time in seconds at the given percentile of recent
+        requests, or None if not enough have been timed"""
+        with self.lock:
+            if len(self.times) < self.min_samples:
+                return None
+            times = sorted(self.times)
+        return times[int((len(times) - 1) * percentile / 100)]
+    
+    def report(self):
+        if not self.requests:
+            return "No requests"
+        msg = ("Hedged {} of {} requests ({:.0%}), {} responded first; "
+            "response time median {:.2F} s, {}th percentile {:.2F} s")
+        median = self.time_percentile(50) or 0
+        threshold = self.time_percentile(self.percentile) or 0
+        return msg.format(self.hedged, self.requests,
+            self.hedged / self.requests, self.won,
+            median, self.percentile, threshold)
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def start_thread(call):
+    """Run "call()" in a new thread, returning a Future for its result"""
+    future = Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(call())
+        except BaseException as err:
+            future.set_exception(err)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+class HostStriper:
+    """Spreads fragment requests over hosts serving the same paths
+    
+    Each fragment is requested from one of the hosts, chosen by smooth
+    weighted round robin, with each host weighted by a moving average of
+    its throughput. Hosts that have not been measured yet get the average
+    weight, so that each one is tried. A host is demoted after an error,
+    and is not used again for "cooldown" seconds. The "hosts" are URLs, of
+    which only the scheme and host name are used."""
+    
+    def __init__(self, media_url, hosts, *, weight=0.3, cooldown=60):
+        self.media_url = media_url
+        self.hosts = list()  # (scheme, netloc) tuples
+        for url in chain((media_url,), hosts):
+            split = urlsplit(url)
+            if split.scheme not in {"http", "https"}:
+                raise ValueError("Cannot stripe over {}".format(url))
+            if split[:2] not in self.hosts:
+                self.hosts.append(split[:2])
+        self.weight = weight
+        self.cooldown = cooldown
+        self.throughput = dict()  # Bytes per second
+        self.demoted = dict()  # Time of the last error
+        self.credit = dict.fromkeys(self.hosts, 0)
+        self.requests = dict.fromkeys(self.hosts, 0)
+        self.failures = dict.fromkeys(self.hosts, 0)
+        self.lock = threading.Lock()
+    
+    def url(self, index):
+        """Choose the host for a fragment, and return its base URL"""
+        with self.lock:
+            active = self._active()
+            if not active:
+                # Fall back to the host that failed the longest time ago
+                active = [min(self.hosts, key=self.demoted.get)]
+            default = [self.throughput[host] for host in active
+                if host in self.throughput]
+            default = sum(default) / len(default) if default else 1
+            total = 0
+            for host in active:
+                weight = self.throughput.get(host, default)
+                self.credit[host] += weight
+                total += weight
+            host = max(active, key=self.credit.get)
+            self.credit[host] -= total
+            self.requests[host] += 1
+        return self.rehost(self.media_url, host)
+    
+    def _active(self):
+        """Hosts not demoted"""
+        now = monotonic()
+        return [host for host in self.hosts if host not in self.demoted or
+            now - self.demoted[host] >= self.cooldown]
+    
+    def record(self, url, size, seconds):
+        """Add the download time of a fragment to its host's average"""
+        if seconds <= 0:
+            return
+        host = urlsplit(url)[:2]
+        sample = size / seconds
+        with self.lock:
+            if host not in self.throughput:
+                self.throughput[host] = sample
+            else:
+                self.throughput[host] += self.weight * (sample -
+                    self.throughput[host])
+    
+    def failed(self, url):
+        """Demote the host of a failed request, and return the URL to try
+        on another host instead, or None if there is no other host"""
+        split = urlsplit(url)
+        host = split[:2]
+        with self.lock:
+            if host in self.failures:
+                self.failures[host] += 1
+                self.demoted[host] = monotonic()
+                # Measure it again once it is back
+                self.throughput.pop(host, None)
+            others = [other for other in self._active() if other != host]
+            if not others:
+                return None
+            other = max(others, key=lambda other:
+                self.throughput.get(other, 0))
+            self.requests[other] += 1
+        return self.rehost(url, other)
+    
+    @staticmethod
+    def rehost(url, host):
+        return urlunsplit(tuple(host) + tuple(urlsplit(url)[2:]))
+    
+    def report(self):
+        hosts = list()
+        for host in self.hosts:
+            line = "{}: {} requests".format(host[1], self.requests[host])
+            if self.failures[host]:
+                line += ", {} failed".format(self.failures[host])
+            if host in self.throughput:
+                line += ", {:.0F} kB/s".format(self.throughput[host] / 1000)
+            hosts.append(line)
+        return "Striped over " + "; ".join(hosts)
+
+def close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
 
-def frag_to_flv(frag, flv, *, strip_headers, frontend=None, duration=None):
-    """Yields two times:
+def fetch_frags(frags, *, session, url, player="", prefetch=1, **kw):
+    """Yields (index, seg, frag, response) for each fragment, in order
+    
+    If "prefetch" is more than one, up to that many fragments are
+    downloaded in parallel by worker threads, so the session should be
+    able to handle concurrent requests, such as one using a
+    ConnectionPoolHandler. The responses are then buffered, in memory or a
+    temporary file, until the caller is ready for them. Closing the
+    generator cancels any pending downloads. The "url" parameter may also
+    be a function, called with each fragment index, returning the base URL
+    for that fragment."""
+    
+    if callable(url):
+        frag_url = url
+    else:
+        frag_url = lambda index: url
+    
+    if prefetch <= 1:
+        for (index, seg, frag) in frags:
+            response = get_frag(session, frag_url(index), seg, frag,
+                player=player, **kw)
+            yield (index, seg, frag, response)
+        return
+    
+    def download(url, seg, frag):
+        # Fragments over the memory limit are buffered on disk
+        buffer = SpooledTemporaryFile(config.hds_fragment_memory)
+        try:
+            with get_frag(session, url, seg, frag, player=player,
+            **kw) as response:
+                copyfileobj(response, buffer)
+            buffer.seek(0)
+            return buffer
+        except:
+            buffer.close()
+            raise
+    
+    executor = ThreadPoolExecutor(prefetch)
+    pending = deque()
+    completed = False
+    try:
+        for (index, seg, frag) in frags:
+            future = executor.submit(download, frag_url(index), seg, frag)
+            pending.append((index, seg, frag, future))
+            # Keep every worker busy while the caller handles the oldest
+            if len(pending) > prefetch:
+                [index, seg, frag, future] = pending.popleft()
+                yield (index, seg, frag, future.result())
+        while pending:
+            [index, seg, frag, future] = pending.popleft()
+            yield (index, seg, frag, future.result())
+        completed = True
+    finally:
+        # Downloads already running are left to finish in the background,
+        # and their buffers closed when they do
+        for [_, _, _, future] in pending:
+            if not future.cancel():
+                future.add_done_callback(close_buffer)
+        executor.shutdown(wait=completed)
+
+def close_buffer(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def frag_to_flv(frag, flv, *, strip_headers, frontend=None, duration=None,
+memory_limit=None, shift=0, audio_only=False, keyframes=None):
+    """Yields three times:
     1. The timestamp of the first FLV tag when it is parsed
     2. After fully downloading the from HTTP, but before writing to FLV file
-    """
+    3. The timestamp of the last FLV tag, after writing to the FLV file
+    
+    Each "mdat" box is read once into its own buffer, and the ranges of it
+    that are kept are written out as memoryview slices, avoiding any
+    further copying.
+    
+    Once a fragment would hold more than "memory_limit" bytes (default
+    "config.hds_fragment_memory"), what is held is written out, and the
+    rest of the fragment is written one tag at a time as it is downloaded.
+    In that case data is written before the second yield, and if the
+    fragment fails, the caller should discard it with rollback().
+    
+    The timestamps written out are reduced by "shift" milliseconds, or by
+    the timestamp of the first tag if "shift" is None. The first yield is
+    the original timestamp; the last is the reduced timestamp.
+    
+    With "audio_only", video tags are dropped, which means scanning every
+    tag header instead of just the first few. If "keyframes" is a list,
+    the timestamp and file position of each video keyframe written out is
+    appended to it."""
+    if memory_limit is None:
+        memory_limit = config.hds_fragment_memory
     strip_audio = strip_headers
     strip_video = strip_headers
-    buffer = io.BytesIO()
+    
+    def sequence_header(tag, flags):
+        """Whether to strip the tag as an AAC or AVC sequence header"""
+        nonlocal strip_audio, strip_video
+        if strip_audio and tag["type"] == flvlib.TAG_AUDIO:
+            strip_audio = False
+            return is_sequence_header(tag, flags)
+        if strip_video and tag["type"] == flvlib.TAG_VIDEO:
+            strip_video = False
+            return is_sequence_header(tag, flags)
+        return False
+    
+    chunks = list()
+    held = 0  # Size of buffers referenced by chunks
+    spilled = False
+    timestamp = None  # Of last tag written out early, or else the first tag
     first = True
     for boxsize in mdat_boxes(frag):
+        if not spilled and held + boxsize > memory_limit:
+            if chunks:
+                timestamp = last_timestamp(chunks[-1])
+            write_chunks(flv, chunks, keyframes)
+            del chunks[:]
+            spilled = True
+        
+        if spilled:
+            offset = 0
+            while offset < boxsize:
+                if offset + flvlib.TAG_HEADER_LENGTH > boxsize:
+                    raise EOFError("Tag extends past end of box")
+                header = bytearray(flvlib.TAG_HEADER_LENGTH)
+                readinto_strict(frag, header)
+                tag = flvlib.unpack_tag_header(header)
+                length = tag["length"] + 4  # Trailing tag size field
+                offset += flvlib.TAG_HEADER_LENGTH + length
+                if offset > boxsize:
+                    raise EOFError("Tag extends past end of box")
+                
+                if first:
+                    yield tag["timestamp"]
+                    if shift is None:
+                        shift = tag["timestamp"]
+                    timestamp = max(tag["timestamp"] - shift, 0)
+                    progress_update(frontend, flv,
+                        (tag["timestamp"] - shift) / 1000, duration)
+                    first = False
+                
+                data = memoryview(bytearray(length))
+                readinto_strict(frag, data)
+                if audio_only and tag["type"] == flvlib.TAG_VIDEO:
+                    continue
+                flags = data[:min(tag["length"], 2)]
+                if not sequence_header(tag, flags):
+                    timestamp = max(tag["timestamp"] - shift, 0)
+                    if shift:
+                        flvlib.pack_timestamp(header, 0, timestamp)
+                    if (keyframes is not None and
+                    flvlib.is_keyframe(tag, flags)):
+                        keyframes.append((timestamp, flv.tell()))
+                    flv.write(header)
+                    flv.write(data)
+            continue
+        
+        box = memoryview(bytearray(boxsize))
+        held += boxsize
+        filled = 0  # Amount of box read so far
+        kept = 0  # Start of range not yet added to chunks
+        offset = 0
         # Strip AAC and AVC sequence headers from fragments other than the
         # first fragment. This assumes that the header tags only appear as
         # the first tag of their type in each fragment. This way the code
         # avoids unnecessarily scanning for them, which is much slower than
         # simply copying the stream.
-        while boxsize and (strip_audio or strip_video or first):
-            cache = io.BytesIO()
-            proxy = WritingReader(frag, cache)
-            tag = flvlib.read_tag_header(proxy)
+        if audio_only and not first:
+            # Every tag is scanned anyway, so read the box in one go
+            readinto_strict(frag, box)
+            filled = boxsize
+        while offset < boxsize and (
+        strip_audio or strip_video or first or audio_only):
+            data = offset + flvlib.TAG_HEADER_LENGTH
+            if data > boxsize:
+                raise EOFError("Tag extends past end of box")
+            # Read the tag header plus the audio or video flags
+            end = min(data + 2, boxsize)
+            if filled < end:
+                readinto_strict(frag, box[filled:end])
+                filled = end
+            tag = flvlib.unpack_tag_header(box, offset)
             
             if first:
-                timestamp = tag["timestamp"]
-                yield timestamp
-                progress_update(frontend, flv, timestamp / 1000, duration)
+                yield tag["timestamp"]
+                if shift is None:
+                    shift = tag["timestamp"]
+                timestamp = max(tag["timestamp"] - shift, 0)
+                progress_update(frontend, flv,
+                    (tag["timestamp"] - shift) / 1000, duration)
                 first = False
             
-            if strip_audio and tag["type"] == flvlib.TAG_AUDIO:
-                strip_audio = False
-                parsed = flvlib.parse_audio_tag(proxy, tag)
-                skip = parsed.get("aac_type") == flvlib.AAC_HEADER
-            elif strip_video and tag["type"] == flvlib.TAG_VIDEO:
-                strip_video = False
-                parsed = flvlib.parse_video_tag(proxy, tag)
-                skip = parsed.get("avc_type") == flvlib.AVC_HEADER
-            else:
-                skip = False
-            
-            boxsize -= cache.tell()
-            tag["length"] += 4  # Trailing tag size field
-            if skip:
-                fastforward(frag, tag["length"])
-            elif tag["length"] > 10e6:
-                raise OverflowError("FLV tag over 10 MB")
-            else:
-                buffer.write(cache.getvalue())
-                streamcopy(frag, buffer, tag["length"])
-            boxsize -= tag["length"]
-            if boxsize < 0:
+            flags = box[data:data + min(tag["length"], 2)]
+            skip = (audio_only and tag["type"] == flvlib.TAG_VIDEO or
+                sequence_header(tag, flags))
+            end = data + tag["length"] + 4  # Trailing tag size field
+            if end > boxsize:
                 raise EOFError("Tag extends past end of box")
+            if skip:
+                if kept < offset:
+                    chunks.append(box[kept:offset])
+                kept = end
+            offset = end
         
-        streamcopy(frag, buffer, boxsize)
+        readinto_strict(frag, box[filled:])
+        if shift:
+            flvlib.shift_timestamps(box, shift)
+        if kept < boxsize:
+            chunks.append(box[kept:])
     if first:
         raise ValueError("No FLV tags in fragment")
     yield
     
-    timestamp = flvlib.read_prev_tag(buffer)["timestamp"] / 1000
-    buffer.seek(0)
-    copyfileobj(buffer, flv)
-    progress_update(frontend, flv, timestamp, duration)
+    if chunks:
+        timestamp = last_timestamp(chunks[-1])
+    write_chunks(flv, chunks, keyframes)
+    progress_update(frontend, flv, timestamp / 1000, duration)
+    yield timestamp
+
+def is_sequence_header(tag, flags):
+    """Whether a tag is an AAC or AVC sequence header, given the first
+    two bytes of its data"""
+    if len(flags) < 2:
+        return False
+    if tag["type"] == flvlib.TAG_AUDIO:
+        return (flags[0] >> 4 == flvlib.FORMAT_AAC and
+            flags[1] == flvlib.AAC_HEADER)
+    if tag["type"] == flvlib.TAG_VIDEO:
+        return (flags[0] & 0xF == flvlib.CODEC_AVC and
+            flags[1] == flvlib.AVC_HEADER)
+    return False
+
+def write_chunks(flv, chunks, keyframes=None):
+    """Write out buffers of whole tags, recording any keyframes"""
+    for chunk in chunks:
+        if keyframes is not None:
+            keyframes.extend(flvlib.keyframes_in(chunk, flv.tell()))
+        flv.write(chunk)
+
+def reserve_index(metadata, duration):
+    """Metadata with space for a keyframe index
+    
+    Returns "onMetaData" script data with the properties from "metadata"
+    (if any), and with room to add the "keyframes" object later with
+    index_metadata(). Space is reserved for one keyframe per second of
+    "duration"; more frequent keyframes are thinned out to fit."""
+    properties = dict(duration=duration, filesize=0)
+    length = len(index_metadata(metadata, **properties))
+    length += KEYFRAMES_OVERHEAD + PADDING_OVERHEAD
+    length += (int(duration) + 1) * KEYFRAME_SIZE
+    return index_metadata(metadata, length, **properties)
+
+def index_metadata(metadata, length=None, *, keyframes=(), **properties):
+    """Encode "onMetaData" script data with a keyframe index
+    
+    The properties of the original "metadata" are updated from
+    "properties", and the keyframes, if any, are added as the "times" and
+    "filepositions" arrays. If "length" is given, the result is padded to
+    that length, and every second keyframe is dropped until it fits.
+    Padding too long for an AMF string is split into an array of them,
+    since a long string header would not match PADDING_OVERHEAD."""
+    value = dict()
+    if metadata:
+        original = flvlib.unpack_scriptdata(metadata)[0]["value"]
+        if isinstance(original, dict):
+            value.update(original)
+            value.pop("padding", None)  # Recalculated below
+    value.update(properties)
+    while True:
+        if keyframes:
+            value["keyframes"] = dict(
+                times=[timestamp / 1000 for [timestamp, _] in keyframes],
+                filepositions=[position for [_, position] in keyframes],
+            )
+        data = flvlib.encode_scriptdata("onMetaData", value)
+        if length is None:
+            return data
+        padding = length - len(data) - PADDING_OVERHEAD
+        if padding >= 0:
+            break
+        if not keyframes:
+            raise ValueError("Metadata does not fit in reserved space")
+        keyframes = keyframes[::2]
+    value["padding"] = padding_value(padding)
+    data = flvlib.encode_scriptdata("onMetaData", value)
+    if len(data) != length:
+        raise ValueError("Metadata does not match reserved space")
+    return data
+
+def padding_value(size):
+    """Value that encodes to the same length as a string of "size" bytes
+    with a two-byte length field"""
+    if size <= 0xFFFF:
+        return bytes(size)
+    # An array uses four bytes for its count, then each string has its
+    # own type and length fields
+    size -= 2
+    pieces = 1
+    while size - 3 * pieces > pieces * 0xFFFF:
+        pieces += 1
+    [piece, extra] = divmod(size - 3 * pieces, pieces)
+    return [bytes(piece + 1)] * extra + [bytes(piece)] * (pieces - extra)
+
+# Name and type of "keyframes" object, and names, types and lengths of its
+# two arrays
+KEYFRAMES_OVERHEAD = 64
+KEYFRAME_SIZE = 2 * (1 + flvlib.DOUBLE_BE.size)
+PADDING_OVERHEAD = 2 + len("padding") + 1 + 2  # Name, type, length
+METADATA_POSITION = (flvlib.FILE_HEADER_LENGTH + 4 +
+    flvlib.TAG_HEADER_LENGTH)
+
+def scan_keyframes(dest_file, metadata):
+    """List the keyframes in an FLV file up to the current position"""
+    dest_file.flush()
+    end = dest_file.tell()
+    body = METADATA_POSITION + len(metadata) + 4
+    with os.fdopen(dest_file.fileno(), "rb", closefd=False) as reader, \
+    flvlib.map_file(reader) as buffer:
+        [index, _] = flvlib.scan_tags(buffer, body, end)
+    return [(timestamp, offset) for [timestamp, offset, keyframe] in
+        zip(index["timestamp"], index["offset"], index["keyframe"])
+        if keyframe]
+
+def last_timestamp(chunk):
+    """Timestamp of the FLV tag at the end of a buffer"""
+    length = int.from_bytes(chunk[-4:], "big")
+    return flvlib.unpack_tag_header(chunk, len(chunk) - 4 - length)["timestamp"]
 
 def mdat_boxes(frag):
     for _ in range(100):
@@ -406,31 +2056,92 @@ def mdat_boxes(frag):
         raise OverflowError("100 or more boxes in fragment")
 
 def find_frag_run(bootstrap, timestamp):
-    """Find a fragment run that probably contains the timestamp"""
+    """Find a fragment run that probably contains the timestamp
+    
+    Returns (run, ts_offset, runs), where "runs" iterates over the
+    subsequent runs."""
     timestamp *= bootstrap["frag_timescale"]
-    runs = iter_frag_runs(bootstrap)
-    for run in runs:
-        ts_offset = timestamp - run["timestamp"]
-        if 0 <= ts_offset < run["run_duration"]:
-            return (run, ts_offset, runs)
+    table = bootstrap["frag_runs"]
+    found = bisect_right(table["timestamp"], timestamp) - 1
+    # Fall back to a linear search in case timestamps are out of order
+    for i in chain((found,), range(len(table["timestamp"]))):
+        if i < 0:
+            continue
+        ts_offset = timestamp - table["timestamp"][i]
+        if 0 <= ts_offset < table["run_duration"][i]:
+            runs = iter_frag_runs(bootstrap, i + 1)
+            return (frag_run(table, i), ts_offset, runs)
     else:
         raise ValueError("No fragment run found with timestamp")
 
-def seek_backwards(reader, timestamp):
-    while True:
-        tag = flvlib.read_prev_tag(reader)
-        if not tag:
-            break
-        if tag["timestamp"] < timestamp:
-            reader.seek(+tag["length"] + 4, io.SEEK_CUR)
-            break
-        reader.seek(-flvlib.TAG_HEADER_LENGTH, io.SEEK_CUR)
+def retime_run(bootstrap, run, timestamp):
+    """Correct the start time of a fragment run in the run table
+    
+    The durations of the run and the run before it are adjusted to
+    match, unless they are followed by a time discontinuity."""
+    table = bootstrap["frag_runs"]
+    i = bisect_right(table["frag_index"], run["frag_index"]) - 1
+    table["timestamp"][i] = timestamp
+    for j in (i - 1, i):
+        if j >= 0 and not table["flags"][j] & DISCONT_TIME:
+            duration = table["timestamp"][j + 1] - table["timestamp"][j]
+            table["run_duration"][j] = duration
+    run.update(timestamp=timestamp, run_duration=table["run_duration"][i])
 
-def iter_frag_runs(bootstrap):
-    runs = iter(bootstrap["frag_runs"])
-    flags = 0
+def seek_backwards(reader, timestamp, index):
+    """Seek to the first tag from scan_last_tag() at or after "timestamp"
+    
+    The metadata, which also has timestamp zero, is not indexed, so it is
+    never passed."""
+    i = bisect_left(index["timestamp"], timestamp)
+    if i < len(index["offset"]):
+        reader.seek(index["offset"][i])
+
+def iter_frag_runs(bootstrap, start=0):
+    """Yields a dict() for each fragment run, starting from the given
+    position in the run table"""
+    table = bootstrap["frag_runs"]
+    for i in range(start, len(table["first"])):
+        yield frag_run(table, i)
+
+def frag_run(table, i):
+    return dict((field, table[field][i]) for field in FRAG_RUN_FIELDS)
+
+FRAG_RUN_FIELDS = (
+    "first", "timestamp", "duration", "span", "run_duration", "frag_index")
+
+def frag_run_table(frag_runs, table=None, end=None):
+    """Resolve the runs from read_afrt() into a table of parallel arrays
+    
+    Discontinuity entries are folded into the runs before them. Each array
+    in the table has an item for each run:
+    
+    "first": Number of the first fragment in the run
+    "timestamp": Start timestamp, scaled as in read_afrt()
+    "duration": Duration of each fragment
+    "span": Number of fragments in the run
+    "run_duration": Duration of the whole run
+    "frag_index": Index of the first fragment counting from the start
+    "flags": DISCONT_FRAG and DISCONT_TIME flags following the run
+    
+    If an existing table is given, it is extended in place with any runs
+    starting after its last run, which is itself resolved again. The last
+    run normally spans a single fragment, but if "end" is given, it spans
+    the fragments completed by that timestamp instead."""
+    
     run = None
     frag_index = 0
+    if table is None:
+        table = dict((field, array("q")) for field in FRAG_RUN_FIELDS)
+        table["flags"] = array("q")
+    elif table["first"]:
+        # Drop the last run, which was resolved as the end of the table
+        run = dict((field, table[field].pop())
+            for field in FRAG_RUN_FIELDS + ("flags",))
+        frag_index = run["frag_index"]
+        frag_runs = appended_runs(frag_runs, run["first"])
+    runs = iter(frag_runs)
+    flags = 0
     while True:
         next_run = next(runs, dict(discontinuity=DISCONT_END))
         discontinuity = next_run.get("discontinuity")
@@ -442,66 +2153,138 @@ def iter_frag_runs(bootstrap):
             continue
         
         if run is not None:
-            if flags & DISCONT_FRAG:
-                run["span"] = 1
+            if discontinuity == DISCONT_END and end is not None:
+                span = max((end - run["timestamp"]) // run["duration"], 1)
+            elif flags & DISCONT_FRAG:
+                span = 1
             else:
-                run["span"] = next_run["first"] - run["first"]
+                span = next_run["first"] - run["first"]
             if flags & DISCONT_TIME:
-                run["run_duration"] = run["duration"] * run["span"]
+                run_duration = run["duration"] * span
             else:
-                run["run_duration"] = (
-                    next_run["timestamp"] - run["timestamp"])
-            run["frag_index"] = frag_index
-            frag_index += run["span"]
-            yield run
+                run_duration = next_run["timestamp"] - run["timestamp"]
+            table["first"].append(run["first"])
+            table["timestamp"].append(run["timestamp"])
+            table["duration"].append(run["duration"])
+            table["span"].append(span)
+            table["run_duration"].append(run_duration)
+            table["frag_index"].append(frag_index)
+            table["flags"].append(flags)
+            frag_index += span
         if discontinuity == DISCONT_END:
             break
         run = next_run
         flags = 0
+    return table
+
+def appended_runs(frag_runs, first):
+    """Yields the runs starting after fragment "first", along with any
+    discontinuities leading up to them"""
+    discontinuities = list()
+    runs = iter(frag_runs)
+    for run in runs:
+        if "discontinuity" in run:
+            discontinuities.append(run)
+        elif run["first"] <= first:
+            discontinuities = list()
+        else:
+            for discontinuity in discontinuities:
+                yield discontinuity
+            yield run
+            break
+    for run in runs:
+        yield run
+
+def seg_run_table(seg_runs, table=None):
+    """Convert the runs from read_asrt() into a table of parallel arrays
+    
+    "first": Number of the first segment in the run
+    "frags": Number of fragments in each segment
+    "frag_index": Index of the first fragment counting from the start
+    
+    If an existing table is given, it is extended in place with any runs
+    starting after its last run."""
+    if table is None:
+        table = dict(first=array("q"), frags=array("q"),
+            frag_index=array("q"))
+    elif table["first"]:
+        last = table["first"][-1]
+        seg_runs = (run for run in seg_runs if run["first"] > last)
+    frag_index = table["frag_index"][-1] if table["frag_index"] else 0
+    for run in seg_runs:
+        if table["first"]:
+            segs = run["first"] - table["first"][-1]
+            frag_index += segs * table["frags"][-1]
+        table["first"].append(run["first"])
+        table["frags"].append(run["frags"])
+        table["frag_index"].append(frag_index)
+    return table
 
 def iter_segs(bootstrap, start=0):
+    """Yields the segment number for each fragment, starting from the
+    given fragment index"""
+    table = bootstrap["seg_runs"]
+    count = len(table["first"])
+    i = bisect_right(table["frag_index"], start) - 1
+    [segs, start] = divmod(start - table["frag_index"][i], table["frags"][i])
+    seg = table["first"][i] + segs
     # For each run of segments
-    for (i, run) in enumerate(bootstrap["seg_runs"]):
-        # For each segment in the run
-        seg = run["first"]
-        if i + 1 < len(bootstrap["seg_runs"]):
-            end = bootstrap["seg_runs"][i + 1]["first"]
-            frags = (end - seg) * run["frags"]
-            if start >= frags:
-                start -= frags
-                continue
+    for i in range(i, count):
+        if i + 1 < count:
+            end = table["first"][i + 1]
         else:
             end = None
-        [segs, start] = divmod(start, run["frags"])
-        seg += segs
+        # For each segment in the run
         while end is None or seg < end:
             # For each fragment in the segment
-            for _ in range(start, run["frags"]):
+            for _ in range(start, table["frags"][i]):
                 yield seg
             start = 0
             seg += 1
 
+def frags_from(bootstrap, frag_index):
+    """Iterate over fragments, starting at the given fragment index"""
+    table = bootstrap["frag_runs"]
+    i = bisect_right(table["frag_index"], frag_index) - 1
+    if i < 0 or frag_index - table["frag_index"][i] >= table["span"][i]:
+        return iter(())
+    run = frag_run(table, i)
+    offset = frag_index - run["frag_index"]
+    run["frag_index"] += offset
+    run["first"] += offset
+    run["span"] -= offset
+    runs = chain((run,), iter_frag_runs(bootstrap, i + 1))
+    return iter_frags(iter_segs(bootstrap, frag_index), runs)
+
 def iter_frags(segs, runs):
     for run in runs:
         for i in range(run["span"]):
             yield (run["frag_index"] + i, next(segs), run["first"] + i)
 
-def progress_update(frontend, flv, time, duration):
+def progress_update(frontend, flv, time, duration, latency=None):
+    """Report progress, and for live streams the latency in seconds behind
+    the live edge"""
     size = flv.tell()
     
     if frontend:
         if duration:
             frontend.set_fraction(time / duration)
         frontend.set_size(size)
+        if latency is not None:
+            frontend.set_latency(latency)
     
     else:
         if duration:
             duration = "/{:.1F}".format(duration)
         else:
             duration = ""
+        if latency is not None:
+            latency = "; {:.1F} s behind live".format(latency)
+        else:
+            latency = ""
         
-        stderr.write("\r{:.1F}{} s; {:.1F} MB".format(
-            time, duration, size / 1e6))
+        stderr.write("\r{:.1F}{} s; {:.1F} MB{}".format(
+            time, duration, size / 1e6, latency))
         stderr.flush()
 
 def manifest_url(url, hdnea=None):
@@ -532,7 +2315,11 @@ def get_manifest(url, session):
     key "data", which holds the associated bootstrap data."""
     
     with http_get(session, url, ("video/f4m",)) as response:
-        manifest = ElementTree.parse(response).getroot()
+        return parse_manifest(response, url)
+
+def parse_manifest(stream, url):
+    """Parse a manifest from a byte stream; see get_manifest()"""
+    manifest = ElementTree.parse(stream).getroot()
     
     parsed = xml_text_elements(manifest, F4M_NAMESPACE)
     parsed.setdefault("baseURL", url)
@@ -671,6 +2458,53 @@ def read_box_header(stream):
     assert boxsize >= 0
     return (boxtype, boxsize)
 
+def commit(dest_file, action=None):
+    """Mark the end of a fragment, and call "action()" once it has been
+    written out"""
+    if isinstance(dest_file, WriteBehindFile):
+        dest_file.commit(action)
+    elif action is not None:
+        action()
+
+def rollback(dest_file, flv, offset):
+    """Discard what was written to "flv" after "offset"
+    
+    The "flv" object is either "dest_file" itself or a CounterWriter
+    wrapping it. Returns False if the file is not seekable."""
+    extra = flv.tell() - offset
+    if not extra:
+        return True
+    try:
+        dest_file.seek(-extra, io.SEEK_CUR)
+    except io.UnsupportedOperation:
+        return False
+    except EnvironmentError as err:
+        if err.errno == ESPIPE:
+            return False
+        raise
+    possibly_trunc(dest_file)
+    if flv is not dest_file:
+        flv.length = offset
+    return True
+
+def overwrite(dest_file, flv, offset, data):
+    """Replace data written to "flv" at "offset", if the file is seekable
+    
+    The file position is restored afterwards. Returns False if the file
+    is not seekable."""
+    back = flv.tell() - offset
+    try:
+        dest_file.seek(-back, io.SEEK_CUR)
+    except io.UnsupportedOperation:
+        return False
+    except EnvironmentError as err:
+        if err.errno == ESPIPE:
+            return False
+        raise
+    dest_file.write(data)
+    dest_file.seek(back - len(data), io.SEEK_CUR)
+    return True
+
 def possibly_trunc(file):
     """Truncate a file if supported by the file type"""
     try:
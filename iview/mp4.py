@@ -0,0 +1,267 @@
+"""Fragmented MP4 output
+
+Mp4Writer converts the FLV stream produced by hds.frag_to_flv() into a
+fragmented MP4 file in a single pass: the "moov" box is made from the AVC
+and AAC sequence headers, followed by a "moof" and "mdat" box for each
+HDS fragment.
+
+ISO/IEC 14496-12 (ISO base media file format) and 14496-15 (AVC file
+format)"""
+
+from . import flvlib
+from . import config
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+from struct import Struct
+
+class Mp4Writer(flvlib.TagWriter):
+    """Converts an FLV stream written to it into fragmented MP4
+    
+    Only AVC video and AAC audio are supported. Samples are held until
+    end_fragment() is called, which writes them out as a movie fragment.
+    Sample data beyond "config.hds_fragment_memory" is held in temporary
+    files. The "ftyp" and "moov" boxes are written before the first
+    fragment, unless "offset" is given, meaning that the output already
+    holds the start of the file up to that position."""
+    
+    def __init__(self, output, *, offset=None):
+        flvlib.TagWriter.__init__(self, output)
+        self.resumed = offset is not None
+        self.header = self.resumed  # "moov" box written
+        if self.resumed:
+            self.length = offset
+        self.tracks = dict()  # Track ID -> Track
+        self.metadata = dict()
+    
+    def tag(self, tag, data):
+        if tag["type"] == flvlib.TAG_VIDEO:
+            self.video(tag, data)
+        elif tag["type"] == flvlib.TAG_AUDIO:
+            self.audio(tag, data)
+        elif tag["type"] == flvlib.TAG_SCRIPTDATA:
+            [script, _] = flvlib.unpack_scriptdata(data)
+            if (script["name"] == b"onMetaData" and
+            isinstance(script["value"], dict)):
+                self.metadata = script["value"]
+    
+    def video(self, tag, data):
+        if len(data) < 5 or data[0] & 0xF != flvlib.CODEC_AVC:
+            raise ValueError("Only AVC video can be written as MP4")
+        if data[1] == flvlib.AVC_HEADER:
+            self.configure(VIDEO, data[5:])
+        elif data[1] == AVC_NALU:
+            # Composition time offset is signed 24 bits
+            offset = int.from_bytes(data[2:5], "big", signed=True)
+            sync = data[0] >> 4 == flvlib.KEY_FRAME
+            self.sample(VIDEO, tag["timestamp"], data[5:], sync, offset)
+    
+    def audio(self, tag, data):
+        if len(data) < 2 or data[0] >> 4 != flvlib.FORMAT_AAC:
+            raise ValueError("Only AAC audio can be written as MP4")
+        if data[1] == flvlib.AAC_HEADER:
+            self.configure(AUDIO, data[2:])
+        elif data[1] == flvlib.AAC_RAW:
+            self.sample(AUDIO, tag["timestamp"], data[2:], True, 0)
+    
+    def track(self, id):
+        track = self.tracks.get(id)
+        if track is None:
+            # When resuming, the tracks in the "moov" box are not known
+            if self.header and not self.resumed:
+                raise ValueError("Track started after the first fragment")
+            track = Track(id)
+            self.tracks[id] = track
+        return track
+    
+    def configure(self, id, config):
+        track = self.track(id)
+        config = bytes(config)
+        if track.config is not None and track.config != config:
+            raise ValueError("Codec configuration changed")
+        track.config = config
+    
+    def sample(self, id, timestamp, data, sync, offset):
+        track = self.track(id)
+        if not self.header and track.config is None:
+            raise ValueError("Sample before sequence header")
+        if track.data is None:
+            track.data = SpooledTemporaryFile(config.hds_fragment_memory)
+        track.data.write(data)
+        track.samples.append((timestamp, len(data), sync, offset))
+    
+    def end_fragment(self, sequence):
+        """Write out the samples so far as a movie fragment
+        
+        The "sequence" number should increase with each fragment."""
+        if not self.header:
+            header = ftyp_box() + self.moov_box()
+            self.output.write(header)
+            self.length += len(header)
+            self.header = True
+        
+        tracks = [self.tracks[id] for id in sorted(self.tracks)
+            if self.tracks[id].samples]
+        if not tracks:
+            return
+        # Boxes are the same size whatever the data offsets
+        size = len(moof_box(sequence, tracks, 0))
+        moof = moof_box(sequence, tracks, size + 8)
+        mdat = sum(track.data.tell() for track in tracks)
+        self.output.write(moof)
+        self.output.write((8 + mdat).to_bytes(4, "big") + b"mdat")
+        for track in tracks:
+            track.data.seek(0)
+            copyfileobj(track.data, self.output)
+            track.data.close()
+            track.data = None
+            del track.samples[:]
+        self.length += len(moof) + 8 + mdat
+    
+    def moov_box(self):
+        traks = list()
+        for id in sorted(self.tracks):
+            track = self.tracks[id]
+            if id == VIDEO:
+                width = int(self.metadata.get("width") or 0)
+                height = int(self.metadata.get("height") or 0)
+                volume = 0
+                entry = avc1_box(track.config, width, height)
+                header = full_box(b"vmhd", 0, 1, bytes(8))
+                handler = hdlr_box(b"vide", b"VideoHandler")
+            else:
+                width = 0
+                height = 0
+                volume = 0x0100
+                entry = mp4a_box(track.config)
+                header = full_box(b"smhd", 0, 0, bytes(4))
+                handler = hdlr_box(b"soun", b"SoundHandler")
+            
+            tkhd = full_box(b"tkhd", 0, TRACK_ENABLED | TRACK_IN_MOVIE,
+                Struct(">IIII4x8xhhh2x").pack(0, 0, id, 0, 0, 0, volume),
+                MATRIX, Struct(">II").pack(width << 16, height << 16))
+            mdhd = full_box(b"mdhd", 0, 0,
+                Struct(">IIIIHH").pack(0, 0, TIMESCALE, 0, UNDETERMINED, 0))
+            dref = full_box(b"dref", 0, 0, (1).to_bytes(4, "big"),
+                full_box(b"url ", 0, SELF_CONTAINED))
+            dinf = box(b"dinf", dref)
+            stbl = box(b"stbl",
+                full_box(b"stsd", 0, 0, (1).to_bytes(4, "big"), entry),
+                full_box(b"stts", 0, 0, bytes(4)),
+                full_box(b"stsc", 0, 0, bytes(4)),
+                full_box(b"stsz", 0, 0, bytes(4 + 4)),
+                full_box(b"stco", 0, 0, bytes(4)),
+            )
+            minf = box(b"minf", header, dinf, stbl)
+            mdia = box(b"mdia", mdhd, handler, minf)
+            traks.append(box(b"trak", tkhd, mdia))
+        
+        mvhd = full_box(b"mvhd", 0, 0,
+            Struct(">IIIIIH10x").pack(0, 0, TIMESCALE, 0,
+                0x00010000, 0x0100),  # Rate 1.0, volume 1.0
+            MATRIX, bytes(24), (max(self.tracks) + 1).to_bytes(4, "big"))
+        trexs = (full_box(b"trex", 0, 0, Struct(">IIIII").pack(id, 1, 0, 0, 0))
+            for id in sorted(self.tracks))
+        mvex = box(b"mvex", *trexs)
+        return box(b"moov", mvhd, *(traks + [mvex]))
+
+class Track:
+    def __init__(self, id):
+        self.id = id
+        self.config = None  # AVCDecoderConfigurationRecord or AAC config
+        self.samples = list()  # (timestamp, size, sync, offset) tuples
+        self.data = None  # Sample data for the current fragment
+        self.duration = 0  # Of the last sample, guessing the next one
+
+VIDEO = 1  # Track IDs
+AUDIO = 2
+AVC_NALU = 1
+TIMESCALE = 1000  # Same as FLV timestamps
+UNDETERMINED = 0x55C4  # Language code "und"
+TRACK_ENABLED = 1 << 0
+TRACK_IN_MOVIE = 1 << 1
+SELF_CONTAINED = 1 << 0
+MATRIX = Struct(">9I").pack(0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0,
+    0x40000000)
+
+def ftyp_box():
+    return box(b"ftyp", b"isom", (0x200).to_bytes(4, "big"),
+        b"isom", b"iso6", b"avc1", b"mp41")
+
+def hdlr_box(handler, name):
+    return full_box(b"hdlr", 0, 0, bytes(4), handler, bytes(12),
+        name + bytes(1))
+
+def avc1_box(config, width, height):
+    return box(b"avc1",
+        bytes(6), (1).to_bytes(2, "big"),  # Data reference index
+        bytes(2 + 2 + 12), Struct(">HHII4xH").pack(width, height,
+            0x00480000, 0x00480000, 1),  # 72 DPI, one frame per sample
+        bytes(32), Struct(">Hh").pack(0x18, -1),  # Compressor name, depth
+        box(b"avcC", config),
+    )
+
+def mp4a_box(config):
+    aac = flvlib.parse_aac_config(config)
+    rate = 0
+    if aac["rate"] < len(flvlib.AAC_RATES):
+        rate = flvlib.AAC_RATES[aac["rate"]]
+    if rate > 0xFFFF:
+        rate = 0
+    es = descriptor(3, bytes(2 + 1),  # ES ID and flags
+        descriptor(4, bytes((0x40, 0x15)),  # MPEG-4 audio stream
+            bytes(3 + 4 + 4),  # Buffer size and bitrates
+            descriptor(5, config),
+        ),
+        descriptor(6, bytes((2,))),  # Predefined SL configuration
+    )
+    return box(b"mp4a",
+        bytes(6), (1).to_bytes(2, "big"),  # Data reference index
+        bytes(8), Struct(">HH4xI").pack(aac["channels"], 16, rate << 16),
+        full_box(b"esds", 0, 0, es),
+    )
+
+def descriptor(tag, *parts):
+    data = b"".join(parts)
+    size = bytearray((len(data) & 0x7F,))
+    length = len(data) >> 7
+    while length:
+        size.insert(0, 0x80 | length & 0x7F)
+        length >>= 7
+    return bytes((tag,)) + size + data
+
+def moof_box(sequence, tracks, data_offset):
+    """Movie fragment box, with "data_offset" being the position of the
+    sample data relative to the start of the box"""
+    trafs = list()
+    for track in tracks:
+        samples = track.samples
+        trun = bytearray(TRUN_HEADER.pack(len(samples), data_offset))
+        for (i, [timestamp, size, sync, offset]) in enumerate(samples):
+            if i + 1 < len(samples):
+                track.duration = max(samples[i + 1][0] - timestamp, 0)
+            flags = SYNC_SAMPLE if sync else NON_SYNC_SAMPLE
+            trun.extend(TRUN_SAMPLE.pack(track.duration, size, flags, offset))
+            data_offset += size
+        trafs.append(box(b"traf",
+            full_box(b"tfhd", 0, DEFAULT_BASE_IS_MOOF,
+                track.id.to_bytes(4, "big")),
+            full_box(b"tfdt", 1, 0, samples[0][0].to_bytes(8, "big")),
+            full_box(b"trun", 1, TRUN_FLAGS, trun),
+        ))
+    mfhd = full_box(b"mfhd", 0, 0, sequence.to_bytes(4, "big"))
+    return box(b"moof", mfhd, *trafs)
+
+DEFAULT_BASE_IS_MOOF = 0x020000
+# Data offset, and sample duration, size, flags and composition offset
+TRUN_FLAGS = 0x000001 | 0x000100 | 0x000200 | 0x000400 | 0x000800
+TRUN_HEADER = Struct(">Ii")
+TRUN_SAMPLE = Struct(">IIIi")
+SYNC_SAMPLE = 2 << 24  # Depends on no other samples
+NON_SYNC_SAMPLE = 1 << 24 | 1 << 16  # Depends on others; not a sync sample
+
+def box(type, *parts):
+    data = b"".join(parts)
+    return (8 + len(data)).to_bytes(4, "big") + type + data
+
+def full_box(type, version, flags, *parts):
+    return box(type, bytes((version,)), flags.to_bytes(3, "big"), *parts)
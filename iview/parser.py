@@ -36,24 +36,25 @@ def parse_config(soup):
     })
     return params
 
-def parse_auth(soup, iview_config):
+def parse_auth(soup, iview_config, override_host=None):
     """There are lots of goodies in the auth handshake we get back,
     including the streaming server URL, auth tokens,
     and whether the connection is unmetered.
+    The streaming host may be overridden; see "config.override_host".
     """
 
     xml = XML(soup)
     xmlns = "{http://www.abc.net.au/iView/Services/iViewHandshaker}"
     auth = xml_text_elements(xml, xmlns)
 
-    if config.override_host == 'default':
+    if override_host == 'default':
         auth['host'] = None
         auth['path'] = config.akamai_playpath_prefix
-    elif config.override_host:
-        auth.update(config.stream_hosts[config.override_host])
-        auth['host'] = config.override_host
+    elif override_host:
+        auth.update(config.stream_hosts[override_host])
+        auth['host'] = override_host
 
-    if config.override_host == 'default' or not auth.get('server'):
+    if override_host == 'default' or not auth.get('server'):
         # We are a bland generic ISP using Akamai, or we are iiNet.
         auth['server'] = iview_config['server_streaming']
         auth['bwtest'] = iview_config['server_fallback']
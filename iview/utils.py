@@ -1,11 +1,22 @@
 import zlib
 from io import BufferedIOBase
-from io import SEEK_CUR, SEEK_END
+from io import SEEK_SET, SEEK_CUR, SEEK_END
 import urllib.request
 import http.client
 from errno import EPIPE, ESHUTDOWN, ENOTCONN, ECONNRESET
 import builtins
 from urllib.parse import urlsplit
+import threading
+from . import config
+import os
+from collections import deque
+
+from time import sleep, localtime
+
+try:  # Python 3.3
+    from time import monotonic
+except ImportError:  # Python < 3.3
+    from time import time as monotonic
 
 py3p3_exceptions = ("ConnectionError", "ConnectionRefusedError",
     "ConnectionAbortedError")
@@ -51,6 +62,15 @@ def read_strict(stream, size):
         raise EOFError()
     return data
 
+def readinto_strict(stream, buffer):
+    """Fill a writable buffer, such as a memoryview slice, from a stream"""
+    view = memoryview(buffer)
+    while view:
+        size = stream.readinto(view)
+        if not size:
+            raise EOFError()
+        view = view[size:]
+
 class CounterWriter(BufferedIOBase):
     def __init__(self, output):
         self.length = 0
@@ -111,6 +131,184 @@ class WritingReader(BufferedIOBase):
         self.writer.write(data)
         return data
 
+class WriteBehindFile(BufferedIOBase):
+    """Writes to a file from a separate thread, so a slow disk does not
+    hold up the caller
+    
+    Up to "limit" bytes of writes are queued. Buffers passed to write()
+    are queued without copying, so they must not be modified afterwards.
+    Other operations, such as seek() and fileno(), wait for the queue to
+    drain first. An error in the writer thread is raised by the next call.
+    The underlying file is not closed by close().
+    
+    The "fsync" policy is one of "fragment", to sync at each commit(),
+    "periodic", to sync at commits at least "interval" seconds apart, or
+    "end", to only sync when closed. After each commit(), the committed
+    range is dropped from the page cache where supported, although pages
+    still waiting to be written to disk are not dropped."""
+    
+    def __init__(self, file, *, limit=None, fsync=None, interval=None):
+        if limit is None:
+            limit = config.hds_write_behind
+        if fsync is None:
+            fsync = config.hds_fsync
+        if fsync not in {"fragment", "periodic", "end"}:
+            raise ValueError("Unknown fsync policy {!r}".format(fsync))
+        if interval is None:
+            interval = config.hds_fsync_interval
+        self.file = file
+        self.limit = limit
+        self.fsync = fsync
+        self.interval = interval
+        self.position = file.tell()
+        self.end = self.position  # End of data written, to trim preallocation
+        self.allocated = None
+        self.synced = monotonic()
+        self.advised = 0  # Start of range not yet dropped from the cache
+        
+        self.queue = deque()
+        self.queued = 0  # Bytes in queue
+        self.error = None
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def write(self, b):
+        size = memoryview(b).nbytes
+        with self.lock:
+            while self.queued >= self.limit and not self.error:
+                self.lock.wait()
+            self._check()
+            self.queue.append(b)
+            self.queued += size
+            self.lock.notify_all()
+        self.position += size
+        self.end = max(self.end, self.position)
+        return size
+    
+    def commit(self, action=None):
+        """Mark the end of a fragment. Once everything written so far is
+        in the file, it is synced depending on the policy, and then
+        "action()" is called, if given, from the writer thread."""
+        self._put(lambda: self._commit(action))
+    
+    def _commit(self, action):
+        self.file.flush()
+        now = monotonic()
+        if (self.fsync == "fragment" or
+        self.fsync == "periodic" and now - self.synced >= self.interval):
+            os.fsync(self.file.fileno())
+            self.synced = now
+        position = self.file.tell()
+        if position > self.advised and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.file.fileno(), self.advised,
+                position - self.advised, os.POSIX_FADV_DONTNEED)
+        self.advised = position
+        if action is not None:
+            action()
+    
+    def preallocate(self, size):
+        """Reserve disk space for the expected size of the file, where
+        supported. Unused space is trimmed off by close()."""
+        self._drain()
+        if not hasattr(os, "posix_fallocate") or size <= self.end:
+            return
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except EnvironmentError:
+            return  # Not supported by the file system, or no space
+        self.allocated = size
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=SEEK_SET):
+        self._drain()
+        self.position = self.file.seek(offset, whence)
+        self.advised = min(self.advised, self.position)
+        return self.position
+    
+    def truncate(self, size=None):
+        self._drain()
+        size = self.file.truncate(size)
+        self.end = size
+        return size
+    
+    def seekable(self):
+        return self.file.seekable()
+    
+    def writable(self):
+        return True
+    
+    def fileno(self):
+        self._drain()
+        return self.file.fileno()
+    
+    def flush(self):
+        self._drain()
+    
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._drain()
+            if self.allocated is not None and self.allocated > self.end:
+                self.file.truncate(self.end)
+            os.fsync(self.file.fileno())
+        finally:
+            with self.lock:
+                self.queue.append(None)  # Stop the writer thread
+                self.lock.notify_all()
+            self.thread.join()
+            BufferedIOBase.close(self)
+    
+    def _put(self, item):
+        with self.lock:
+            self._check()
+            self.queue.append(item)
+            self.lock.notify_all()
+    
+    def _drain(self):
+        with self.lock:
+            while self.queue and not self.error:
+                self.lock.wait()
+            self._check()
+        self.file.flush()
+    
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+    
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                item = self.queue[0]
+            if item is None:
+                with self.lock:
+                    self.queue.popleft()
+                    self.lock.notify_all()
+                return
+            try:
+                if callable(item):
+                    item()
+                else:
+                    self.file.write(item)
+            except BaseException as err:
+                with self.lock:
+                    self.error = err
+                    self.queue.clear()
+                    self.queued = 0
+                    self.lock.notify_all()
+                continue
+            with self.lock:
+                self.queue.popleft()
+                if not callable(item):
+                    self.queued -= memoryview(item).nbytes
+                self.lock.notify_all()
+
 def setitem(dict, key):
     """Decorator that adds the definition to a dictionary with a given key"""
     def decorator(func):
@@ -166,11 +364,16 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
             self._type = req.type
             self._host = req.host
         
+        return self._open(self._connection, req)
+    
+    def _open(self, connection, req):
+        """Send request on the connection, retrying idempotent requests
+        if the connection turns out to have been closed"""
         headers = dict(req.header_items())
-        self._attempt_request(req, headers)
+        self._attempt_request(connection, req, headers)
         try:
             try:
-                response = self._connection.getresponse()
+                response = connection.getresponse()
             except EnvironmentError as err:  # Python < 3.3 compatibility
                 if err.errno not in DISCONNECTION_ERRNOS:
                     raise
@@ -181,7 +384,7 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
             if req.get_method() not in idempotents:
                 raise
             # Retry requests whose method indicates they are idempotent
-            self._connection.close()
+            connection.close()
             response = None
         else:
             if response.status == http.client.REQUEST_TIMEOUT:
@@ -189,8 +392,8 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
                 response = None
         if not response:
             # Retry request
-            self._attempt_request(req, headers)
-            response = self._connection.getresponse()
+            self._attempt_request(connection, req, headers)
+            response = connection.getresponse()
         
         # Odd impedance mismatch between "http.client" and "urllib.request"
         response.msg = response.reason
@@ -199,10 +402,10 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
         response.url = "{}://{}{}".format(req.type, req.host, req.selector)
         return response
     
-    def _attempt_request(self, req, headers):
+    def _attempt_request(self, connection, req, headers):
         """Send HTTP request, ignoring broken pipe and similar errors"""
         try:
-            self._connection.request(req.get_method(), req.selector,
+            connection.request(req.get_method(), req.selector,
                 req.data, headers)
         except (ConnectionRefusedError, ConnectionAbortedError):
             raise  # Assume connection was not established
@@ -221,6 +424,212 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
     def __exit__(self, *exc):
         self.close()
 
+class ConnectionPoolHandler(PersistentConnectionHandler):
+    """URL handler keeping a thread-safe pool of persistent connections
+    
+    pool = ConnectionPoolHandler(per_host=4, timeout=30)
+    session = urllib.request.build_opener(pool)
+    
+    Connections are keyed by (scheme, host, port), so requests to different
+    hosts do not close each other's connections, and concurrent requests to
+    the same host each get their own connection, up to "per_host" of them.
+    Further requests wait for a connection to become free. A connection is
+    returned to the pool when its response is closed.
+    Idle connections are closed after "idle_timeout" seconds. Failed
+    idempotent requests are retried as for PersistentConnectionHandler.
+    Other arguments are passed to the connection class.
+    """
+    
+    def __init__(self, *pos, per_host=8, idle_timeout=60, **kw):
+        PersistentConnectionHandler.__init__(self, *pos, **kw)
+        self.per_host = per_host
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        self._pool = dict()  # List of connection entries for each key
+    
+    def default_open(self, req):
+        if req.type not in self.conn_classes:
+            return None
+        conn_class = self.conn_classes[req.type]
+        split = urlsplit("//" + req.host)
+        key = (req.type, split.hostname, split.port or conn_class.default_port)
+        
+        entry = self._acquire(key, conn_class, req.host)
+        try:
+            response = self._open(entry["connection"], req)
+        except:
+            self._discard(key, entry)
+            raise
+        entry["response"] = response
+        
+        close = response.close
+        def release():
+            clean = response.isclosed()  # Body already read to the end
+            close()
+            self._release(entry, response, clean)
+        response.close = release
+        
+        response.msg = response.reason
+        response.url = "{}://{}{}".format(req.type, req.host, req.selector)
+        return response
+    
+    def _acquire(self, key, conn_class, host):
+        with self._lock:
+            while True:
+                now = monotonic()
+                self._expire(now)
+                entries = self._pool.setdefault(key, list())
+                idle = [entry for entry in entries if not entry["busy"]]
+                if idle:
+                    # Most recently used is least likely to have timed out
+                    entry = max(idle, key=lambda entry: entry["used"])
+                    break
+                if len(entries) < self.per_host:
+                    connection = conn_class(host, *self._pos, **self._kw)
+                    entry = dict(connection=connection, used=now)
+                    entries.append(entry)
+                    break
+                self._lock.wait()
+            entry.update(busy=True, response=None)
+            return entry
+    
+    def _release(self, entry, response, clean):
+        with self._lock:
+            # Closing a response again, or after its connection has been
+            # given to another request, must not release the connection
+            if not entry["busy"] or entry["response"] is not response:
+                return
+            if not clean:
+                # Unread data would corrupt the next response
+                entry["connection"].close()
+            entry.update(busy=False, response=None, used=monotonic())
+            self._lock.notify_all()
+    
+    def _discard(self, key, entry):
+        entry["connection"].close()
+        with self._lock:
+            self._pool[key].remove(entry)
+            self._lock.notify_all()
+    
+    def _expire(self, now):
+        for entries in self._pool.values():
+            for entry in list(entries):
+                idle = now - entry["used"]
+                if not entry["busy"] and idle > self.idle_timeout:
+                    entry["connection"].close()
+                    entries.remove(entry)
+    
+    def close(self):
+        """Close idle connections"""
+        with self._lock:
+            for entries in self._pool.values():
+                for entry in list(entries):
+                    if not entry["busy"]:
+                        entry["connection"].close()
+                        entries.remove(entry)
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+def shared_session():
+    """Returns a URL opener backed by a connection pool shared by the
+    whole process"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            pool = ConnectionPoolHandler(timeout=config.http_timeout)
+            _shared_session = urllib.request.build_opener(pool)
+        return _shared_session
+
+class BandwidthScheduler:
+    """Limits the combined download rate of a process
+    
+    The limit comes from bandwidth_limit(), so it may change with the time
+    of day. Each download joins with a weight, and gets a share of the
+    limit in proportion to the weights of the downloads in progress. Up to
+    "burst" seconds of a share can be read without waiting after being
+    idle."""
+    
+    def __init__(self, *, burst=1):
+        self.burst = burst
+        self.total = 0  # Sum of the weights of the downloads joined
+        self.lock = threading.Lock()
+    
+    def join(self, weight=1):
+        """Returns a Throttle for a new download, which should be closed
+        when the download finishes"""
+        if weight <= 0:
+            raise ValueError("Download weight must be positive")
+        with self.lock:
+            self.total += weight
+        return Throttle(self, weight)
+    
+    def leave(self, throttle):
+        with self.lock:
+            self.total -= throttle.weight
+    
+    def reserve(self, throttle, size):
+        """Account for "size" bytes read, and return the number of seconds
+        to wait before reading more"""
+        limit = bandwidth_limit()
+        if limit is None:
+            throttle.next = None
+            return 0
+        now = monotonic()
+        with self.lock:
+            share = limit * throttle.weight / self.total
+            # Sequence of reads is spaced out as if at the shared rate
+            start = now - self.burst
+            if throttle.next is not None:
+                start = max(start, throttle.next)
+            throttle.next = start + size / share
+            return throttle.next - now
+
+class Throttle:
+    """A download's share of a BandwidthScheduler"""
+    
+    def __init__(self, scheduler, weight):
+        self.scheduler = scheduler
+        self.weight = weight
+        self.next = None  # Time until which the bandwidth is used up
+    
+    def consume(self, size):
+        """Wait as long as needed after reading "size" bytes"""
+        delay = self.scheduler.reserve(self, size)
+        if delay > 0:
+            sleep(delay)
+    
+    def close(self):
+        self.scheduler.leave(self)
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+bandwidth = BandwidthScheduler()  # Shared by all downloads in the process
+
+def bandwidth_limit(now=None):
+    """Download rate limit in bytes per second, or None if unlimited
+    
+    Uses the entry of "config.bandwidth_schedule" in effect at the time of
+    day, or else "config.bandwidth_limit". Before the first entry of the
+    day, the last entry of the previous day applies."""
+    limit = config.bandwidth_limit
+    schedule = config.bandwidth_schedule
+    if schedule:
+        if now is None:
+            now = localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        limit = schedule[-1][1]
+        for [time, value] in schedule:
+            [hour, minutes] = time.split(":")
+            if int(hour) * 60 + int(minutes) <= minute:
+                limit = value
+    if limit is None:
+        return None
+    return limit * 1000
+
 def http_get(session, url, types=None, *, headers=dict(), **kw):
     headers = dict(headers)
     if types is not None:
@@ -235,12 +644,15 @@ def http_get(session, url, types=None, *, headers=dict(), **kw):
             type = headers.get_content_type()
             if types is not None and type not in types:
                 msg = "Unexpected content type {}"
-                raise TypeError(msg.format(type))
+                raise ContentTypeError(msg.format(type))
         return response
     except:
         response.close()
         raise
 
+class ContentTypeError(TypeError):
+    pass
+
 def encodeerrors(text, textio, errors="replace"):
     """Prepare a string with a fallback encoding error handler
     
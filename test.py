@@ -73,8 +73,143 @@ class TestCli(TestCase):
                 fetched = None
                 self.iview_cli.batch(batch)
                 self.assertIsNone(fetched, "Programme downloaded twice")
+    
+    def test_bandwidth(self):
+        """Bandwidth settings are read from a batch file"""
+        import iview.config
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            batch = os.path.join(dir, "batch.cfg")
+            with open(batch, "w", encoding="ascii") as file:
+                file.write(
+                    "[batch]\n"
+                    "destination: {}\n"
+                    "bandwidth: 1000\n"
+                    "bandwidth_schedule: 18:00 unlimited, 8:30 200\n"
+                    "weight: 2.5\n"
+                    .format(dir)
+                )
+            class comm:
+                def get_config():
+                    pass
+            self.addCleanup(os.chdir, os.getcwd())
+            with substattr(self.iview_cli.iview, comm), \
+            substattr(iview.config, "bandwidth_limit", None), \
+            substattr(iview.config, "bandwidth_schedule", None), \
+            substattr(iview.config, "bandwidth_weight", 1):
+                self.iview_cli.batch(batch)
+                self.assertEqual(1000, iview.config.bandwidth_limit)
+                self.assertEqual([("08:30", 200), ("18:00", None)],
+                    iview.config.bandwidth_schedule)
+                self.assertEqual(2.5, iview.config.bandwidth_weight)
+
+class TestBandwidth(TestCase):
+    def test_schedule(self):
+        """The limit depends on the time of day"""
+        import iview.utils
+        import iview.config
+        from time import struct_time
+        
+        def at(hour, minute):
+            return struct_time((2014, 1, 1, hour, minute, 0, 2, 1, -1))
+        schedule = [("08:30", 200), ("18:00", None)]
+        with substattr(iview.config, "bandwidth_limit", 1000), \
+        substattr(iview.config, "bandwidth_schedule", None):
+            self.assertEqual(1000e3, iview.utils.bandwidth_limit(at(9, 0)))
+            iview.config.bandwidth_schedule = schedule
+            self.assertEqual(200e3, iview.utils.bandwidth_limit(at(8, 30)))
+            self.assertEqual(200e3, iview.utils.bandwidth_limit(at(17, 59)))
+            self.assertIsNone(iview.utils.bandwidth_limit(at(18, 0)))
+            self.assertIsNone(iview.utils.bandwidth_limit(at(2, 0)))
+    
+    def test_shares(self):
+        """Downloads share the limit by weight"""
+        import iview.utils
+        import iview.config
+        
+        now = 100
+        scheduler = iview.utils.BandwidthScheduler(burst=0)
+        with substattr(iview.utils, "monotonic", lambda: now), \
+        substattr(iview.config, "bandwidth_limit", 4), \
+        substattr(iview.config, "bandwidth_schedule", None), \
+        scheduler.join(1) as light:
+            with scheduler.join(3) as heavy:
+                self.assertEqual(1, scheduler.reserve(light, 1000))
+                self.assertEqual(2, scheduler.reserve(light, 1000))
+                self.assertEqual(1, scheduler.reserve(heavy, 3000))
+            now = 102
+            self.assertEqual(0.25, scheduler.reserve(light, 1000))
+            
+            iview.config.bandwidth_limit = None
+            self.assertEqual(0, scheduler.reserve(light, 10**9))
+            self.assertIsNone(light.next)
+        self.assertEqual(0, scheduler.total)
+    
+    def test_program_weight(self):
+        """The weight is passed through to HDS downloads only"""
+        import iview.fetch
+        import iview.config
+        
+        calls = list()
+        def hds_open_file(url, tokenhd, *, weight, **kw):
+            calls.append(weight)
+        def rtmpdump(**kw):
+            calls.append(kw)
+        auth = dict(server="http://example/", path="path/")
+        with substattr(iview.fetch, hds_open_file), \
+        substattr(iview.fetch, rtmpdump), \
+        substattr(iview.config, "bandwidth_weight", 2):
+            fetcher = iview.fetch.HdsFetcher("file", auth)
+            with substattr(iview.fetch, "get_fetcher",
+            lambda url, item: fetcher):
+                iview.fetch.fetch_program("file", dest_file="out")
+                iview.fetch.fetch_program("file", dest_file="out",
+                    weight=3)
+            self.assertEqual([2, 3], calls)
+            
+            del calls[:]
+            iview.fetch.fetch_program("rtmp://example/live",
+                dest_file="-", weight=3)
+            [kw] = calls
+            self.assertNotIn("weight", kw)
 
 class TestF4v(TestCase):
+    def test_run_lookup(self):
+        """Test looking up fragments part way through the run tables"""
+        import iview.hds
+        from itertools import islice
+        bootstrap = dict(
+            seg_runs=iview.hds.seg_run_table([
+                dict(first=1, frags=2),
+                dict(first=3, frags=3),
+            ]),
+            frag_runs=iview.hds.frag_run_table([
+                dict(first=1, timestamp=0, duration=4000),
+                dict(discontinuity=iview.hds.DISCONT_TIME),
+                dict(first=5, timestamp=100000, duration=2000),
+                dict(first=8, timestamp=106000, duration=3000),
+            ]),
+            frag_timescale=1,
+        )
+        segs = list(islice(iview.hds.iter_segs(bootstrap), 10))
+        self.assertEqual([1, 1, 2, 2, 3, 3, 3, 4, 4, 4], segs)
+        for start in range(10):
+            self.assertEqual(segs[start:],
+                list(islice(iview.hds.iter_segs(bootstrap, start), 10 - start)))
+        
+        frags = iview.hds.iter_frags(iview.hds.iter_segs(bootstrap),
+            iview.hds.iter_frag_runs(bootstrap))
+        self.assertEqual([
+            (0, 1, 1), (1, 1, 2), (2, 2, 3), (3, 2, 4),
+            (4, 3, 5), (5, 3, 6), (6, 3, 7), (7, 4, 8),
+        ], list(frags))
+        
+        [run, ts_offset, runs] = iview.hds.find_frag_run(bootstrap, 103000)
+        self.assertEqual((5, 3000), (run["first"], ts_offset))
+        self.assertEqual([8], [run["first"] for run in runs])
+        self.assertEqual(1, iview.hds.find_frag_run(bootstrap, 15000)[0]["first"])
+        with self.assertRaises(ValueError):
+            iview.hds.find_frag_run(bootstrap, 20000)
+    
     def test_read_box(self):
         import iview.hds
         stream = BytesIO(bytes.fromhex("0000 000E") + b"mdat")
@@ -84,6 +219,1177 @@ class TestF4v(TestCase):
         self.assertEqual((b"mdat", 6), iview.hds.read_box_header(stream))
         self.assertEqual((None, None), iview.hds.read_box_header(BytesIO()))
 
+class TestScriptData(TestCase):
+    def test_round_trip(self):
+        """Encoded script data is decoded back to the same values"""
+        from iview import flvlib
+        value = dict(duration=12.5, stereo=True, encoder=b"Lavf",
+            keyframes=dict(times=(0.0, 2.0), filepositions=(13.0, 200.0)))
+        data = flvlib.encode_scriptdata("onMetaData", value)
+        self.assertEqual(dict(name=b"onMetaData", value=value),
+            flvlib.parse_scriptdata(BytesIO(data)))
+    
+    def test_types(self):
+        """Every supported AMF0 type survives encoding and decoding"""
+        from iview import flvlib
+        from datetime import datetime, timezone
+        value = dict(
+            number=-1.5, integer=3, true=True, false=False, null=None,
+            string=b"text", long=bytes(0x10000), unicode="\u00e9",
+            object=dict(nested=dict()), empty=(), mixed=(1, b"two", None),
+            date=datetime(2015, 6, 1, 12, 30, 0, 250000, timezone.utc),
+        )
+        data = flvlib.encode_scriptdata("onMetaData", value)
+        [result, end] = flvlib.unpack_scriptdata(data + b"extra")
+        self.assertEqual(len(data), end)
+        expected = dict(value, unicode="\u00e9".encode("utf-8"),
+            integer=3.0, object=dict(nested=dict()))
+        self.assertEqual(dict(name=b"onMetaData", value=expected), result)
+        # Long strings are marked with type 12
+        marker = flvlib.TYPE_UINT32.pack(flvlib.AMF_LONG_STRING, 0x10000)
+        self.assertIn(marker, data)
+    
+    def test_truncated(self):
+        from iview import flvlib
+        data = flvlib.encode_scriptdata("onMetaData",
+            dict(times=(1, 2), name=b"name"))
+        for end in (0, 5, len(data) - 12, len(data) - 1):
+            with self.assertRaises(EOFError):
+                flvlib.unpack_scriptdata(data[:end])
+    
+    def test_update_number(self):
+        from iview import flvlib
+        data = flvlib.encode_scriptdata("onMetaData", dict(width=640))
+        [data, offset] = flvlib.update_number(data, "width", 720)
+        self.assertEqual(flvlib.DOUBLE_BE.pack(720), data[offset:offset + 8])
+        [data, offset] = flvlib.update_number(data, "duration", 5)
+        self.assertEqual(flvlib.DOUBLE_BE.pack(5), data[offset:offset + 8])
+        [result, _] = flvlib.unpack_scriptdata(data)
+        self.assertEqual(dict(width=720, duration=5), result["value"])
+        self.assertEqual(b"\x00\x00\x00\x02", data[14:18])  # Array length
+
+def benchmark_scriptdata(keyframes=100000, repeat=5):
+    """Time encoding and decoding a large "onMetaData" keyframe index"""
+    from iview import flvlib
+    from timeit import timeit
+    value = dict(duration=keyframes * 2.0, width=1280, encoder=b"Lavf",
+        keyframes=dict(times=[i * 2.0 for i in range(keyframes)],
+            filepositions=[i * 100000.0 for i in range(keyframes)]))
+    data = flvlib.encode_scriptdata("onMetaData", value)
+    for [name, function] in (
+        ("encode", lambda: flvlib.encode_scriptdata("onMetaData", value)),
+        ("decode", lambda: flvlib.unpack_scriptdata(data)),
+    ):
+        seconds = min(timeit(function, number=1) for _ in range(repeat))
+        print("{}: {} bytes in {:.1F} ms ({:.0F} MB/s)".format(name,
+            len(data), seconds * 1e3, len(data) / seconds / 1e6))
+
+class TestFlvIndex(TestCase):
+    def setUp(self):
+        from iview import flvlib
+        flv = BytesIO()
+        flvlib.write_file_header(flv)
+        metadata = flvlib.encode_scriptdata("onMetaData", dict(duration=1))
+        flvlib.write_scriptdata(flv, metadata)
+        self.body = flv.tell()
+        for [type, timestamp, data] in (
+            (8, 0, b"\xAF\x00config"),  # AAC sequence header
+            (9, 0, b"\x17\x00config"),  # AVC sequence header
+            (9, 0, b"\x17\x01key"),
+            (8, 20, b"\xAF\x01audio"),
+            (9, 40, b"\x27\x01inter"),
+            (9, 80, b"\x17\x01key"),
+        ):
+            flv.write(flv_tag(type, timestamp, data))
+        self.end = flv.tell()
+        self.data = flv.getvalue() + bytes(100)  # Preallocated space
+    
+    def test_scan(self):
+        from iview import flvlib
+        [index, end] = flvlib.scan_tags(self.data, self.body)
+        self.assertEqual(self.end, end)
+        self.assertEqual([8, 9, 9, 8, 9, 9], list(index["type"]))
+        self.assertEqual([0, 0, 0, 20, 40, 80], list(index["timestamp"]))
+        self.assertEqual([0, 0, 1, 0, 0, 1], list(index["keyframe"]))
+        self.assertEqual(self.body, index["offset"][0])
+        for [offset, length] in zip(index["offset"], index["length"]):
+            tag = flvlib.unpack_tag_header(self.data, offset)
+            self.assertEqual(length, tag["length"])
+        
+        partial = self.data[:self.end] + flv_tag(9, 120, b"\x27\x01")[:15]
+        [index, end] = flvlib.scan_tags(partial, self.body)
+        self.assertEqual(self.end, end)
+        self.assertEqual(6, len(index["offset"]))
+    
+    def test_resume_scan(self):
+        """The last tag is found, and can be sought back from"""
+        import iview.hds
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file:
+                file.write(self.data)
+            with open(path, "rb") as file:
+                file.seek(self.body)
+                [tag, index] = iview.hds.scan_last_tag(file)
+                self.assertEqual(80, tag["timestamp"])
+                self.assertEqual(self.end, file.tell())
+                iview.hds.seek_backwards(file, 20, index)
+                self.assertEqual(index["offset"][3], file.tell())
+                iview.hds.seek_backwards(file, 0, index)
+                self.assertEqual(self.body, file.tell())
+    
+    def run_main(self, *args):
+        from iview import flvlib
+        stdin = TextIOWrapper(BufferedReader(BytesIO(self.data)))
+        with substattr(sys, "stdin", stdin), \
+        substattr(sys, "argv", ["flvlib"] + list(args)), \
+        substattr(sys, "stdout", TextIOWrapper(BytesIO())) as stdout:
+            flvlib.main()
+            stdout.seek(0)
+            return stdout.read()
+    
+    def test_dump(self):
+        lines = self.run_main().splitlines()
+        self.assertTrue(lines[0].startswith("header "))
+        self.assertEqual(1 + 7 * 2, len(lines))  # Each tag is parsed
+    
+    def test_analyse(self):
+        try:
+            from iview import flvstats
+        except ImportError as err:
+            self.skipTest(err)
+        from iview import flvlib
+        import json
+        
+        [index, _] = flvlib.scan_tags(self.data, self.body)
+        # Add a regression and a gap to the audio
+        for [timestamp, keyframe] in ((10, False), (3000, False)):
+            index["offset"].append(index["offset"][-1] + 100)
+            index["type"].append(flvlib.TAG_AUDIO)
+            index["timestamp"].append(timestamp)
+            index["length"].append(85)
+            index["keyframe"].append(keyframe)
+        stats = flvstats.analyse(index, interval=1, gap=2)
+        audio = stats["tracks"]["audio"]
+        self.assertEqual(4, audio["tags"])
+        self.assertEqual(15 + 8 + 15 + 7 + 2 * 100, audio["bytes"])
+        self.assertEqual([1.2, 0, 0, 0.8], audio["bitrate"]["series"])
+        self.assertEqual(1, audio["regressions"]["count"])
+        self.assertEqual(dict(offset=index["offset"][-2], timestamp=0.01,
+            jump=-0.01), audio["regressions"]["first"][0])
+        self.assertEqual(1, audio["gaps"]["count"])
+        self.assertEqual(2.99, audio["gaps"]["largest"])
+        self.assertEqual(0, stats["tracks"]["video"]["gaps"]["count"])
+        
+        self.assertEqual(2, stats["gop"]["keyframes"])
+        self.assertEqual(0.08, stats["gop"]["mean"])
+        self.assertEqual([1], stats["gop"]["histogram"])
+        self.assertEqual(3.0 - 0.08, stats["drift"]["final"])
+        self.assertEqual(0.01 - 0.08, stats["drift"]["min"])
+        
+        report = json.loads(self.run_main("--json", "--interval", "0.05"))
+        self.assertEqual(7, report["tags"])  # Including the metadata
+        self.assertEqual(dict(audio=True, video=True), report["header"])
+        self.assertEqual(2, len(report["tracks"]["video"]["bitrate"]
+            ["series"]))
+        self.assertIn("A/V drift", self.run_main("--analyse"))
+
+class TestHdsPipeline(TestCase):
+    def test_prefetch_order(self):
+        """Fragments finishing out of order are still yielded in order"""
+        import iview.hds
+        from time import sleep
+        def get_frag(session, url, seg, frag, player="", **kw):
+            sleep((5 - frag) / 100)  # Later fragments arrive first
+            return BytesIO("{}{}".format(url, frag).encode("ascii"))
+        
+        frags = ((frag - 1, 1, frag) for frag in range(1, 5))
+        with substattr(iview.hds, get_frag):
+            fetched = iview.hds.fetch_frags(frags,
+                session=None, url="frag", prefetch=3)
+            fetched = [(index, seg, frag, response.read())
+                for (index, seg, frag, response) in fetched]
+        expected = [(frag - 1, 1, frag, "frag{}".format(frag).encode("ascii"))
+            for frag in range(1, 5)]
+        self.assertEqual(expected, fetched)
+    
+    def test_prefetch_abort(self):
+        """Closing the generator does not wait for running downloads"""
+        import iview.hds
+        from threading import Event
+        from time import monotonic, sleep
+        from tempfile import SpooledTemporaryFile
+        
+        release = Event()
+        self.addCleanup(release.set)
+        def get_frag(session, url, seg, frag, player="", **kw):
+            if frag > 1:
+                release.wait(10)
+            return BytesIO(b"frag")
+        buffers = list()
+        class Buffer(SpooledTemporaryFile):
+            def __init__(self, *pos, **kw):
+                SpooledTemporaryFile.__init__(self, *pos, **kw)
+                buffers.append(self)
+        
+        frags = ((frag - 1, 1, frag) for frag in range(1, 6))
+        with substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "SpooledTemporaryFile", Buffer):
+            fetched = iview.hds.fetch_frags(frags,
+                session=None, url="frag", prefetch=2)
+            [_, _, _, response] = next(fetched)
+            response.close()
+            start = monotonic()
+            fetched.close()
+            self.assertLess(monotonic() - start, 5)
+            release.set()
+            for buffer in buffers:
+                for _ in range(100):
+                    if buffer.closed:
+                        break
+                    sleep(0.01)
+                self.assertTrue(buffer.closed)
+    
+    def test_strip_headers(self):
+        """AAC and AVC sequence headers are only kept in the first fragment"""
+        import iview.hds
+        aac_header = flv_tag(8, 0, bytes((0xAF, 0)) + b"config")
+        avc_header = flv_tag(9, 0, bytes((0x17, 0)) + b"config")
+        body = flv_tag(9, 40, bytes((0x27, 1)) + b"frame")
+        frag = mdat_box(aac_header + avc_header + body)
+        
+        for (strip, expected) in (
+            (False, aac_header + avc_header + body),
+            (True, body),
+        ):
+            flv = BytesIO()
+            parser = iview.hds.frag_to_flv(BytesIO(frag), flv,
+                strip_headers=strip, frontend=DummyFrontend())
+            self.assertEqual(0, next(parser))
+            next(parser)
+            self.assertEqual(b"", flv.getvalue(), "Written before end")
+            self.assertEqual(40, next(parser))
+            self.assertEqual(expected, flv.getvalue())
+    
+    def test_spill(self):
+        """Fragments over the memory limit are written out early"""
+        import iview.hds
+        aac_header = flv_tag(8, 0, bytes((0xAF, 0)) + b"config")
+        tags = [flv_tag(9, timestamp, bytes((0x27, 1)) + b"frame")
+            for timestamp in (40, 80, 120)]
+        frag = mdat_box(aac_header + tags[0]) + mdat_box(tags[1] + tags[2])
+        
+        for (limit, early) in ((len(frag), b""), (30, b"".join(tags))):
+            flv = BytesIO()
+            parser = iview.hds.frag_to_flv(BytesIO(frag), flv,
+                strip_headers=True, frontend=DummyFrontend(),
+                memory_limit=limit)
+            self.assertEqual(0, next(parser))
+            next(parser)
+            self.assertEqual(early, flv.getvalue())
+            self.assertEqual(120, next(parser))
+            self.assertEqual(b"".join(tags), flv.getvalue())
+    
+    def test_rollback(self):
+        """A failed fragment that was written out early is removed"""
+        import iview.hds
+        import iview.config
+        def get_frag(session, url, seg, frag, player="", **kw):
+            data = mdat_box(flv_tag(9, frag * 1000, b"\x27\x01frame"))
+            if frag == 2:
+                data = mdat_box(flv_tag(9, 2000, b"\x27\x01") * 2)
+                return BrokenReader(data, len(data) - 5)
+            return BytesIO(data)
+        class BrokenReader(BufferedReader):
+            def __init__(self, data, size):
+                BufferedReader.__init__(self, BytesIO(data[:size]))
+            def readinto(self, b):
+                size = BufferedReader.readinto(self, b)
+                if not size:
+                    raise ConnectionResetError()
+                return size
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "get_manifest", dummy_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap), \
+        substattr(iview.config, "hds_fragment_memory", 0):
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file, \
+            self.assertRaises(ConnectionResetError):
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend())
+            with open(path, "rb") as file:
+                expected = bytes.fromhex("464C5601 05 00000009 00000000")
+                expected += flv_tag(9, 1000, b"\x27\x01frame")
+                self.assertEqual(expected, file.read())
+    
+    def test_preallocate(self):
+        """Space is reserved for the chosen rendition's bitrate"""
+        import iview.hds
+        from iview.utils import WriteBehindFile
+        
+        def get_manifest(url, session):
+            return dict(baseURL=url, media=[
+                dict(url="low", bitrate="100"),
+                dict(url="high", bitrate="800"),
+            ])
+        def get_frag(session, url, seg, frag, player="", **kw):
+            data = flv_tag(9, (frag - 1) * 1000, b"\x27\x01frame")
+            return BytesIO(mdat_box(data))
+        sizes = list()
+        class Writer(WriteBehindFile):
+            def preallocate(self, size):
+                sizes.append(size)
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.flv")
+            for (options, expected) in (
+                (dict(bitrate="lowest"), [3 * 100 * 1000 // 8]),
+                (dict(bitrate="highest"), [3 * 800 * 1000 // 8]),
+                (dict(bitrate="highest", audio_only=True), []),
+            ):
+                del sizes[:]
+                with open(path, "wb") as file, Writer(file) as writer:
+                    iview.hds.fetch("http://localhost/manifest.f4m",
+                        dest_file=writer, frontend=DummyFrontend(),
+                        **options)
+                self.assertEqual(expected, sizes)
+    
+    def test_journal_resume(self):
+        """Resuming with a journal continues after the last fragment"""
+        import iview.hds
+        import iview.fetch
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 3:
+                abort.set()
+            return BytesIO(mdat_box(frag_data(frag)))
+        def frag_data(frag):
+            start = (frag - 1) * 1000
+            return (flv_tag(9, start, bytes((0x27, 1)) + b"frame") +
+                flv_tag(9, start + 500, bytes((0x27, 1)) + b"frame"))
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "get_manifest", dummy_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.flv")
+            with self.assertRaises(SystemExit):
+                iview.fetch.hds_open_file("http://localhost/manifest.f4m",
+                    dest_file=path, frontend=DummyFrontend(), abort=abort)
+            self.assertEqual([1, 2, 3], requested)
+            
+            del requested[:]
+            iview.fetch.hds_open_file("http://localhost/manifest.f4m",
+                dest_file=path, frontend=DummyFrontend())
+            self.assertEqual([3], requested, "Fragments downloaded twice")
+            
+            with open(path, "rb") as file:
+                expected = bytes.fromhex("464C5601 05 00000009 00000000")
+                expected += b"".join(map(frag_data, range(1, 4)))
+                self.assertEqual(expected, file.read())
+            self.assertFalse(os.path.exists(path + ".journal"))
+
+    def test_rendition_resume(self):
+        """Resuming keeps to the rendition the file ends with, or keeps the
+        sequence headers of a different one"""
+        import iview.hds
+        import iview.fetch
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_manifest(url, session):
+            return dict(baseURL=url, media=[
+                dict(url="low", bitrate="100"),
+                dict(url="high", bitrate="800"),
+            ])
+        def get_frag(session, url, seg, frag, player="", **kw):
+            name = url.rsplit("/", 1)[-1]
+            requested.append((name, frag))
+            if frag == 3:
+                abort.set()
+            return BytesIO(mdat_box(headers(name) + frame(frag)))
+        def headers(name):
+            return (flv_tag(8, 0, bytes((0xAF, 0)) + name.encode()) +
+                flv_tag(9, 0, bytes((0x17, 0)) + name.encode()))
+        def frame(frag):
+            return flv_tag(9, (frag - 1) * 1000, bytes((0x27, 1)) + b"frame")
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.flv")
+            for (bitrate, resumed, end) in (
+                # Adaptive starts with the lowest, but continues the file
+                ("adaptive", [("high", 3)], frame(3)),
+                ("lowest", [("low", 3)], headers("low") + frame(3)),
+            ):
+                if os.path.exists(path):
+                    os.remove(path)
+                abort.clear()
+                with self.assertRaises(SystemExit):
+                    iview.fetch.hds_open_file(
+                        "http://localhost/manifest.f4m", dest_file=path,
+                        frontend=DummyFrontend(), abort=abort,
+                        bitrate="highest")
+                
+                del requested[:]
+                iview.fetch.hds_open_file("http://localhost/manifest.f4m",
+                    dest_file=path, frontend=DummyFrontend(),
+                    bitrate=bitrate)
+                self.assertEqual(resumed, requested)
+                with open(path, "rb") as file:
+                    data = file.read()
+                start = bytes.fromhex("464C5601 05 00000009 00000000")
+                start += headers("high") + frame(1) + frame(2)
+                self.assertEqual(start + end, data)
+    
+    def test_range(self):
+        """Only fragments in a time range are downloaded, and rebased"""
+        import iview.hds
+        from iview import flvlib
+        
+        requested = list()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            return BytesIO(mdat_box(frag_data(frag)))
+        def frag_data(frag, shift=0):
+            start = (frag - 1) * 1000 - shift
+            return (flv_tag(9, start, bytes((0x27, 1)) + b"frame") +
+                flv_tag(9, start + 500, bytes((0x27, 1)) + b"frame"))
+        
+        name = b"\x02" + len(b"onMetaData").to_bytes(2, "big") + b"onMetaData"
+        for (properties, count) in (
+            (b"\x00\x08duration\x00" + flvlib.DOUBLE_BE.pack(3), 1),
+            (b"", 0),  # Duration property added
+        ):
+            metadata = name + b"\x08" + count.to_bytes(4, "big")
+            metadata += properties + b"\x00\x00\x09"
+            def get_manifest(url, session):
+                return dict(baseURL=url,
+                    media=[dict(url="media", metadata=metadata)])
+            
+            for (start, end, frags, duration) in (
+                (1, 2, [2], 0.5),
+                (None, 1.5, [1, 2], 1.5),
+                (2.5, None, [3], 0.5),
+            ):
+                del requested[:]
+                flv = BytesIO()
+                with substattr(iview.hds, get_frag), \
+                substattr(iview.hds, get_manifest), \
+                substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+                    iview.hds.fetch("http://localhost/manifest.f4m",
+                        dest_file=flv, frontend=DummyFrontend(),
+                        start=start, end=end)
+                self.assertEqual(frags, requested)
+                
+                flv.seek(0)
+                flvlib.read_file_header(flv)
+                flvlib.read_tag_header(flv)
+                written = flvlib.parse_scriptdata(flv)
+                self.assertEqual(duration, written["value"]["duration"])
+                fastforward(flv, 4)
+                shift = (frags[0] - 1) * 1000 if start else 0
+                expected = b"".join(frag_data(frag, shift) for frag in frags)
+                self.assertEqual(expected, flv.read())
+    
+    def test_audio_only(self):
+        """Video tags are dropped, and audio-only files are resumed"""
+        import iview.hds
+        from threading import Event
+        
+        aac_header = flv_tag(8, 0, bytes((0xAF, 0)) + b"config")
+        avc_header = flv_tag(9, 0, bytes((0x17, 0)) + b"config")
+        def frag_data(frag):
+            start = (frag - 1) * 1000
+            return (flv_tag(9, start, bytes((0x27, 1)) + b"frame") +
+                flv_tag(8, start, bytes((0xAF, 1)) + b"audio"))
+        
+        frag = mdat_box(aac_header + avc_header + frag_data(1))
+        for limit in (len(frag), 0):
+            flv = BytesIO()
+            parser = iview.hds.frag_to_flv(BytesIO(frag), flv,
+                strip_headers=False, audio_only=True, memory_limit=limit,
+                frontend=DummyFrontend())
+            next(parser)
+            next(parser)
+            self.assertEqual(0, next(parser))
+            expected = aac_header + flv_tag(8, 0, bytes((0xAF, 1)) + b"audio")
+            self.assertEqual(expected, flv.getvalue())
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 2:
+                abort.set()
+            data = frag_data(frag)
+            if frag == 1:
+                data = aac_header + avc_header + data
+            return BytesIO(mdat_box(data))
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "get_manifest", dummy_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file, self.assertRaises(SystemExit):
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend(), abort=abort,
+                    audio_only=True)
+            self.assertEqual([1, 2], requested)
+            
+            del requested[:]
+            with open(path, "r+b") as file:
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend(),
+                    audio_only=True)
+            # Without a journal, the last fragment is downloaded again
+            self.assertEqual([1, 2, 3], requested)
+            
+            with open(path, "rb") as file:
+                expected = bytes.fromhex("464C5601 04 00000009 00000000")
+                expected += aac_header
+                for frag in range(1, 4):
+                    expected += flv_tag(8, (frag - 1) * 1000,
+                        bytes((0xAF, 1)) + b"audio")
+                self.assertEqual(expected, file.read())
+    
+    def test_mp4_resume(self):
+        """Fragmented MP4 output is resumed from the journal"""
+        import iview.hds
+        import iview.fetch
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 3:
+                abort.set()
+            start = (frag - 1) * 1000
+            data = flv_tag(9, 0, bytes.fromhex("1700 000000") + b"avcC")
+            data += flv_tag(8, 0, bytes.fromhex("AF00 1210"))
+            data += flv_tag(9, start, bytes.fromhex("1701 000000") + b"key")
+            data += flv_tag(8, start, bytes.fromhex("AF01") + b"aac")
+            return BytesIO(mdat_box(data))
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "get_manifest", dummy_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.mp4")
+            with self.assertRaises(SystemExit):
+                iview.fetch.hds_open_file("http://localhost/manifest.f4m",
+                    dest_file=path, frontend=DummyFrontend(), abort=abort,
+                    format="mp4")
+            del requested[:]
+            iview.fetch.hds_open_file("http://localhost/manifest.f4m",
+                dest_file=path, frontend=DummyFrontend(), format="mp4")
+            self.assertEqual([3], requested)
+            
+            expected = BytesIO()
+            iview.hds.fetch("http://localhost/manifest.f4m",
+                dest_file=expected, frontend=DummyFrontend(), format="mp4")
+            with open(path, "rb") as file:
+                self.assertEqual(expected.getvalue(), file.read())
+    
+    def test_shards(self):
+        """Shards of a plan are resumed separately, then merged"""
+        import iview.hds
+        import iview.fetch
+        from iview import flvlib
+        from io import StringIO
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 3:
+                abort.set()
+            return BytesIO(mdat_box(frag_data(frag)))
+        def frag_data(frag):
+            start = (frag - 1) * 1000
+            return (flv_tag(8, start, bytes((0xAF, 0)) + b"config") +
+                flv_tag(9, start, bytes((0x17, 0)) + b"config") +
+                flv_tag(9, start, bytes((0x17, 1)) + b"key") +
+                flv_tag(8, start + 250, bytes((0xAF, 1)) + b"audio"))
+        metadata = flvlib.encode_scriptdata("onMetaData", dict(duration=3))
+        def get_manifest(url, session):
+            return dict(baseURL=url,
+                media=[dict(url="media", metadata=metadata)])
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap), \
+        substattr(sys, "stderr", TextIOWrapper(BytesIO())):
+            file = StringIO()
+            iview.hds.write_plan(iview.hds.plan(
+                "http://localhost/manifest.f4m"), file)
+            file.seek(0)
+            plan = iview.hds.read_plan(file)
+            self.assertEqual([(0, 1, 1), (1, 1, 2), (2, 1, 3)],
+                plan["frags"])
+            self.assertEqual(metadata, plan["metadata"])
+            
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file:
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend())
+            with open(path, "rb") as file:
+                complete = file.read()
+            
+            first = os.path.join(dir, "first.flv")
+            second = os.path.join(dir, "second.flv")
+            iview.fetch.fetch_shard(plan, first, 0, 0)
+            abort.clear()
+            del requested[:]
+            with self.assertRaises(SystemExit), \
+            iview.hds.Journal(second + ".journal") as journal, \
+            iview.fetch.open_resumable(second) as file:
+                iview.hds.fetch_shard(plan, file, 1, 2, journal=journal,
+                    abort=abort)
+            self.assertEqual([2, 3], requested)
+            with self.assertRaises(ValueError):
+                iview.fetch.merge_shards(plan, [first, second], path)
+            
+            del requested[:]
+            iview.fetch.fetch_shard(plan, second, 1, 2)
+            self.assertEqual([3], requested, "Fragments downloaded twice")
+            with open(second, "rb") as file:
+                data = file.read()
+            self.assertTrue(data.startswith(complete[:len(metadata) + 28]))
+            self.assertIn(frag_data(2), data)
+            
+            os.remove(path)
+            iview.fetch.merge_shards(plan, [first, second], path)
+            with open(path, "rb") as file:
+                self.assertEqual(complete, file.read())
+    
+    def test_verify(self):
+        """Only missing and truncated fragments are downloaded again"""
+        import iview.hds
+        from iview import flvlib
+        
+        requested = list()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            return BytesIO(mdat_box(frag_data(frag)))
+        def frag_data(frag):
+            start = (frag - 1) * 1000
+            return (flv_tag(9, start, bytes((0x17, 1)) + b"key") +
+                flv_tag(8, start + 250, bytes((0xAF, 1)) + b"audio") +
+                flv_tag(9, start + 500, bytes((0x27, 1)) + b"inter"))
+        
+        flv = BytesIO()
+        flvlib.write_file_header(flv)
+        flvlib.write_scriptdata(flv,
+            flvlib.encode_scriptdata("onMetaData", dict(duration=3)))
+        header = flv.getvalue()
+        [frag1, frag2, frag3] = (frag_data(frag) for frag in (1, 2, 3))
+        complete = header + frag1 + frag2 + frag3
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, "get_manifest", dummy_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap), \
+        substattr(sys, "stderr", TextIOWrapper(BytesIO())):
+            path = os.path.join(dir, "programme.flv")
+            for (data, frags) in (
+                (complete, []),
+                (header + frag1 + frag3, [2]),
+                (header + frag2 + frag3, [1]),
+                (header + frag1 + frag2 + frag3[:-5], [3]),
+                (header + frag1 + frag2 + frag2[20:] + frag3, []),
+                # Preallocated space; the last fragment may be incomplete
+                (header + frag1 + frag2 + bytes(100), [2, 3]),
+                (header + frag1 + frag3[:-20] + bytes(100), [2, 3]),
+            ):
+                with open(path, "wb") as file:
+                    file.write(data)
+                del requested[:]
+                result = iview.hds.verify("http://localhost/manifest.f4m",
+                    dest_file=path)
+                self.assertEqual(frags, requested)
+                self.assertEqual(frags, result["refetched"])
+                with open(path, "rb") as file:
+                    repaired = file.read()
+                self.assertEqual(complete, repaired)
+                self.assertFalse(os.path.exists(path + ".verify"))
+    
+    def test_verify_index(self):
+        """A keyframe index is rebuilt after splicing in a fragment"""
+        import iview.hds
+        from iview import flvlib
+        
+        def get_frag(session, url, seg, frag, player="", **kw):
+            return BytesIO(mdat_box(frag_data(frag)))
+        def frag_data(frag):
+            start = (frag - 1) * 1000
+            return (flv_tag(9, start, bytes((0x17, 1)) + b"key") +
+                flv_tag(9, start + 500, bytes((0x27, 1)) + b"inter"))
+        metadata = flvlib.encode_scriptdata("onMetaData", dict())
+        def get_manifest(url, session):
+            return dict(baseURL=url,
+                media=[dict(url="media", metadata=metadata)])
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap), \
+        substattr(sys, "stderr", TextIOWrapper(BytesIO())):
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file:
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend(),
+                    keyframes=True)
+            with open(path, "rb") as file:
+                complete = file.read()
+            start = complete.index(frag_data(2))
+            with open(path, "wb") as file:
+                file.write(complete[:start])
+                file.write(complete[start + len(frag_data(2)):])
+            result = iview.hds.verify("http://localhost/manifest.f4m",
+                dest_file=path)
+            self.assertEqual([2], result["refetched"])
+            with open(path, "rb") as file:
+                self.assertEqual(complete, file.read())
+    
+    def test_keyframes(self):
+        """A keyframe index is written, including after resuming"""
+        import iview.hds
+        from iview import flvlib
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 2:
+                abort.set()
+            start = (frag - 1) * 1000
+            data = flv_tag(9, start, bytes((0x17, 1)) + b"key")
+            data += flv_tag(9, start + 500, bytes((0x27, 1)) + b"inter")
+            return BytesIO(mdat_box(data))
+        
+        name = b"\x02" + len(b"onMetaData").to_bytes(2, "big") + b"onMetaData"
+        metadata = name + b"\x08" + (1).to_bytes(4, "big")
+        metadata += b"\x00\x05width\x00" + flvlib.DOUBLE_BE.pack(640)
+        metadata += b"\x00\x00\x09"
+        def get_manifest(url, session):
+            return dict(baseURL=url,
+                media=[dict(url="media", metadata=metadata)])
+        
+        with TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            path = os.path.join(dir, "programme.flv")
+            with open(path, "wb") as file, self.assertRaises(SystemExit):
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend(), abort=abort,
+                    keyframes=True)
+            with open(path, "r+b") as file:
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=file, frontend=DummyFrontend(),
+                    keyframes=True)
+            with open(path, "rb") as file:
+                data = file.read()
+        
+        flv = BytesIO(data)
+        flvlib.read_file_header(flv)
+        flvlib.read_tag_header(flv)
+        value = flvlib.parse_scriptdata(flv)["value"]
+        self.assertEqual(640, value["width"])
+        self.assertEqual(2.5, value["duration"])
+        self.assertEqual(len(data), value["filesize"])
+        index = value["keyframes"]
+        self.assertEqual((0, 1, 2), index["times"])
+        for (time, position) in zip(index["times"], index["filepositions"]):
+            tag = flvlib.unpack_tag_header(data, int(position))
+            self.assertEqual(time * 1000, tag["timestamp"])
+            flags = position + flvlib.TAG_HEADER_LENGTH
+            self.assertEqual(b"\x17\x01", data[int(flags):int(flags) + 2])
+    
+    def test_long_index(self):
+        """Index padding over 64 KiB still fits the reserved space"""
+        import iview.hds
+        from iview import flvlib
+        
+        for duration in (3600, 3641, 7200):
+            metadata = iview.hds.reserve_index(None, duration)
+            keyframes = [(i * 4000, i * 1000) for i in range(duration // 4)]
+            data = iview.hds.index_metadata(metadata, len(metadata),
+                keyframes=keyframes, duration=duration, filesize=0)
+            self.assertEqual(len(metadata), len(data))
+            [value, _] = flvlib.unpack_scriptdata(data)
+            self.assertEqual(duration // 4,
+                len(value["value"]["keyframes"]["times"]))
+    
+    def test_live(self):
+        """Live streams start at the edge and pick up new fragments"""
+        import iview.hds
+        from threading import Event
+        
+        requested = list()
+        abort = Event()
+        def get_frag(session, url, seg, frag, player="", **kw):
+            requested.append(frag)
+            if frag == 7:
+                abort.set()
+            return BytesIO(mdat_box(flv_tag(9, frag * 10, b"\x27\x01")))
+        
+        refreshes = 0
+        def get_bootstrap(media, *, session, url, player="", update=None):
+            """Ten-millisecond fragments, one more each refresh"""
+            nonlocal refreshes
+            refreshes += 1
+            bootstrap = update or dict(movie_identifier="", live=True,
+                timescale=1000, frag_timescale=1000, seg_runs=None,
+                frag_runs=None)
+            bootstrap["time"] = (4 + refreshes) * 10
+            bootstrap["received"] = iview.utils.monotonic()
+            bootstrap["seg_runs"] = iview.hds.seg_run_table(
+                [dict(first=1, frags=1000)], bootstrap["seg_runs"])
+            bootstrap["frag_runs"] = iview.hds.frag_run_table(
+                [dict(first=1, timestamp=0, duration=10 * 1000)],
+                bootstrap["frag_runs"], end=bootstrap["time"] * 1000)
+            return bootstrap
+        def get_manifest(url, session):
+            bootstrap = dict(url="bootstrap")
+            return dict(baseURL=url,
+                media=[dict(url="media", bootstrapInfo=bootstrap)])
+        
+        class frontend(DummyFrontend):
+            latencies = list()
+            def set_latency(self, latency):
+                self.latencies.append(latency)
+        
+        flv = BytesIO()
+        with substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, get_bootstrap), \
+        self.assertRaises(SystemExit):
+            iview.hds.fetch("http://localhost/manifest.f4m", dest_file=flv,
+                frontend=frontend(), abort=abort)
+        self.assertEqual([5, 6, 7], requested)
+        self.assertEqual(2, len(frontend.latencies))
+        
+        expected = bytes.fromhex("464C5601 05 00000009 00000000")
+        for frag in (5, 6):
+            expected += flv_tag(9, frag * 10, b"\x27\x01")
+        self.assertEqual(expected, flv.getvalue())
+
+class TestAdts(TestCase):
+    def test_writer(self):
+        """AAC frames from an FLV stream get ADTS headers"""
+        from iview.flvlib import AdtsWriter
+        stream = bytes.fromhex("464C5601 05 00000009 00000000")
+        stream += flv_tag(18, 0, b"metadata")
+        stream += flv_tag(8, 0, bytes.fromhex("AF00 1210"))  # LC, 44.1 kHz
+        stream += flv_tag(9, 0, bytes((0x17, 0)) + b"config")
+        stream += flv_tag(8, 0, bytes((0xAF, 1)) + b"frame")
+        
+        output = BytesIO()
+        writer = AdtsWriter(output)
+        for i in range(0, len(stream), 7):  # Write in small pieces
+            writer.write(stream[i:i + 7])
+        expected = bytes.fromhex("FFF15080 019FFC") + b"frame"
+        self.assertEqual(expected, output.getvalue())
+        self.assertEqual(len(expected), writer.tell())
+        
+        with self.assertRaises(ValueError):
+            AdtsWriter(BytesIO()).write(stream[:13] +
+                flv_tag(8, 0, bytes((0xAF, 1)) + b"frame"))
+    
+    def test_abstract(self):
+        """The base TagWriter class needs tag() implemented"""
+        from iview.flvlib import TagWriter
+        with self.assertRaises(TypeError):
+            TagWriter(BytesIO())
+
+class TestMp4(TestCase):
+    def test_writer(self):
+        """FLV tags are converted to an MP4 fragment"""
+        from iview.mp4 import Mp4Writer
+        stream = bytes.fromhex("464C5601 05 00000009 00000000")
+        stream += flv_tag(9, 0, bytes.fromhex("1700 000000") + b"avcC")
+        stream += flv_tag(8, 0, bytes.fromhex("AF00 1210"))
+        stream += flv_tag(9, 0, bytes.fromhex("1701 000028") + b"key")
+        stream += flv_tag(8, 0, bytes.fromhex("AF01") + b"aac1")
+        stream += flv_tag(9, 40, bytes.fromhex("2701 000000") + b"inter")
+        stream += flv_tag(8, 23, bytes.fromhex("AF01") + b"aac2")
+        
+        output = BytesIO()
+        writer = Mp4Writer(output)
+        writer.write(stream)
+        writer.end_fragment(1)
+        output = output.getvalue()
+        self.assertEqual(len(output), writer.tell())
+        
+        top = mp4_boxes(output)
+        self.assertEqual([b"ftyp", b"moov", b"moof", b"mdat"],
+            [type for (type, _, _) in top])
+        [_, moof_start, moof] = top[2]
+        self.assertEqual(b"keyinteraac1aac2", top[3][2])
+        
+        trafs = [mp4_boxes(payload)
+            for (type, _, payload) in mp4_boxes(moof) if type == b"traf"]
+        self.assertEqual(2, len(trafs))
+        for (traf, track, base, samples) in (
+            (trafs[0], 1, 0, [(40, 3, 40, b"key"), (40, 5, 0, b"inter")]),
+            (trafs[1], 2, 0, [(23, 4, 0, b"aac1"), (23, 4, 0, b"aac2")]),
+        ):
+            [tfhd, tfdt, trun] = [payload for (_, _, payload) in traf]
+            self.assertEqual(track, int.from_bytes(tfhd[4:8], "big"))
+            self.assertEqual(base, int.from_bytes(tfdt[4:12], "big"))
+            count = int.from_bytes(trun[4:8], "big")
+            offset = moof_start + int.from_bytes(trun[8:12], "big")
+            found = list()
+            for i in range(count):
+                sample = trun[12 + i * 16:12 + i * 16 + 16]
+                duration = int.from_bytes(sample[0:4], "big")
+                size = int.from_bytes(sample[4:8], "big")
+                cts = int.from_bytes(sample[12:16], "big", signed=True)
+                data = output[offset:offset + size]
+                found.append((duration, size, cts, data))
+                offset += size
+            self.assertEqual(samples, found)
+
+def mp4_boxes(data):
+    """List (type, start, payload) for each box in a buffer"""
+    boxes = list()
+    pos = 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos:pos + 4], "big")
+        boxes.append((data[pos + 4:pos + 8], pos, data[pos + 8:pos + size]))
+        pos += size
+    return boxes
+
+class TestRenditions(TestCase):
+    def test_choose(self):
+        """Child manifests are resolved and renditions sorted by bitrate"""
+        import iview.hds
+        manifest = dict(baseURL="http://localhost/set.f4m?hdnea=token",
+            media=[
+                dict(href="child.f4m", bitrate="1500"),
+                dict(url="low", bitrate="500"),
+                dict(url="medium", bitrate="1000"),
+            ],
+        )
+        requested = list()
+        def get_manifest(url, session):
+            requested.append(url)
+            return dict(baseURL="http://localhost/child/",
+                media=[dict(url="high")])
+        
+        with substattr(iview.hds, get_manifest):
+            renditions = iview.hds.get_renditions(manifest, None)
+        self.assertEqual(["http://localhost/child.f4m?hdnea=token"],
+            requested)
+        self.assertEqual([500, 1000, 1500],
+            [rendition["bitrate"] for rendition in renditions])
+        self.assertEqual("http://localhost/child/", renditions[-1]["url"])
+        
+        for (bitrate, max_bitrate, expected) in (
+            ("highest", None, "high"),
+            ("lowest", None, "low"),
+            ("highest", 1200, "medium"),
+            ("highest", 100, "low"),
+            ("adaptive", None, "low"),
+        ):
+            rendition = iview.hds.choose_rendition(renditions,
+                bitrate, max_bitrate)
+            self.assertEqual(expected, rendition["media"]["url"])
+    
+    def test_adaptive(self):
+        """Switching rendition keeps the new sequence headers"""
+        import iview.hds
+        def get_manifest(url, session):
+            return dict(baseURL=url, media=[
+                dict(url="high", bitrate="1000"),
+                dict(url="low", bitrate="100"),
+            ])
+        
+        def get_frag(session, url, seg, frag, player="", meter=None, **kw):
+            requested.append((url, frag))
+            # Report 8 Mb/s, enough for the high bitrate
+            meter.record(1000000, 1)
+            return BytesIO(mdat_box(frag_data(frag, url)))
+        requested = list()
+        aac_header = flv_tag(8, 0, bytes((0xAF, 0)) + b"config")
+        def frag_data(frag, url):
+            return aac_header + flv_tag(9, frag * 1000, url.encode("ascii"))
+        
+        flv = BytesIO()
+        with substattr(iview.hds, get_frag), \
+        substattr(iview.hds, get_manifest), \
+        substattr(iview.hds, "get_bootstrap", dummy_bootstrap):
+            iview.hds.fetch("http://localhost/manifest.f4m", dest_file=flv,
+                frontend=DummyFrontend(), bitrate="adaptive")
+        low = "http://localhost/low"
+        high = "http://localhost/high"
+        self.assertEqual([(low, 1), (high, 2), (high, 3)], requested)
+        
+        expected = bytes.fromhex("464C5601 05 00000009 00000000")
+        expected += frag_data(1, low) + frag_data(2, high)
+        expected += flv_tag(9, 3000, high.encode("ascii"))
+        self.assertEqual(expected, flv.getvalue())
+
+class TestAsyncHds(TestCase):
+    def test_fetch(self):
+        """Several downloads share one event loop and HTTP session"""
+        import asyncio
+        import iview.aiohds
+        from iview import flvlib
+        from base64 import b64encode
+        
+        aac_header = flv_tag(8, 0, bytes((0xAF, 0)) + b"config")
+        files = {
+            "/bootstrap": ("video/abst", abst_box(frags=4, duration=1000)),
+            "/manifest.f4m": ("video/f4m", """\
+<manifest xmlns="http://ns.adobe.com/f4m/1.0">
+  <bootstrapInfo id="bootstrap" url="bootstrap" />
+  <media url="media" bootstrapInfoId="bootstrap">
+    <metadata>{}</metadata>
+  </media>
+</manifest>
+""".format(b64encode(b"metadata").decode("ascii")).encode("ascii")),
+        }
+        expected = BytesIO()
+        flvlib.write_file_header(expected, audio=True, video=True)
+        flvlib.write_scriptdata(expected, b"metadata")
+        expected.write(aac_header)
+        for frag in range(1, 5):
+            tag = flv_tag(9, frag * 1000, bytes((0x27, 1)) + b"frame")
+            data = mdat_box(aac_header + tag)
+            files["/mediaSeg1-Frag{}".format(frag)] = ("video/f4f", data)
+            expected.write(tag)
+        
+        requests = list()
+        connections = list()  # Server handler tasks
+        # Python < 3.7 only has the Task class method
+        current_task = (getattr(asyncio, "current_task", None) or
+            asyncio.Task.current_task)
+        async def handle(reader, writer):
+            try:
+                connections.append(current_task())
+                while True:
+                    request = await reader.readline()
+                    if not request:
+                        break
+                    while await reader.readline() not in (b"\r\n", b""):
+                        pass
+                    path = request.split()[1].decode("ascii").split("?")[0]
+                    requests.append(path)
+                    (type, body) = files[path]
+                    writer.write(b"HTTP/1.1 200 OK\r\n")
+                    writer.write("Content-Type: {}\r\n".format(
+                        type).encode())
+                    writer.write("Content-Length: {}\r\n\r\n".format(
+                        len(body)).encode("ascii"))
+                    writer.write(body)
+            finally:
+                writer.close()
+        
+        async def main():
+            server = await asyncio.start_server(handle, "localhost", 0)
+            port = server.sockets[0].getsockname()[1]
+            url = "http://localhost:{}/manifest.f4m".format(port)
+            session = iview.aiohds.HttpSession()
+            try:
+                # Fail rather than wait for the HTTP timeout
+                await asyncio.wait_for(asyncio.gather(*(iview.aiohds.fetch(
+                    url, dest_file=dest_file, session=session,
+                    frontend=DummyFrontend(), prefetch=2)
+                    for dest_file in outputs)), 10)
+            finally:
+                session.close()
+                server.close()
+                await server.wait_closed()
+                for task in connections:
+                    task.cancel()
+                await asyncio.gather(*connections, return_exceptions=True)
+        
+        outputs = [BytesIO() for _ in range(3)]
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(main())
+        for output in outputs:
+            self.assertEqual(expected.getvalue(), output.getvalue())
+        self.assertEqual(3 * (2 + 4), len(requests))
+        self.assertLess(len(connections), len(requests))
+
+def abst_box(*, frags, duration):
+    """Bootstrap with one segment of fragments of "duration" ms, the last
+    in its own run"""
+    asrt = bytes(4 + 1) + (1).to_bytes(4, "big")  # One segment run
+    asrt += (1).to_bytes(4, "big") + frags.to_bytes(4, "big")
+    afrt = bytes(4) + (1000).to_bytes(4, "big") + bytes(1)
+    afrt += (2).to_bytes(4, "big")  # Two fragment runs
+    for first in (1, frags):
+        afrt += first.to_bytes(4, "big")
+        afrt += ((first - 1) * duration).to_bytes(8, "big")
+        afrt += duration.to_bytes(4, "big")
+    
+    abst = bytes(4 + 4 + 1) + (1000).to_bytes(4, "big")
+    abst += (frags * duration).to_bytes(8, "big") + bytes(8)
+    abst += bytes(1 + 1 + 1 + 1 + 1)  # Movie, servers, qualities, DRM, meta
+    abst += bytes((1,)) + box(b"asrt", asrt)
+    abst += bytes((1,)) + box(b"afrt", afrt)
+    return box(b"abst", abst)
+
+def dummy_manifest(url, session):
+    return dict(baseURL=url, media=[dict(url="media")])
+
+def dummy_bootstrap(media, *, session, url, player=""):
+    """Three one-second fragments, the last in its own run"""
+    import iview.hds
+    return dict(
+        movie_identifier="",
+        live=False,
+        time=3,
+        timescale=1,
+        seg_runs=iview.hds.seg_run_table([dict(first=1, frags=3)]),
+        frag_runs=iview.hds.frag_run_table([
+            dict(first=1, timestamp=0 * 1000, duration=1000 * 1000),
+            dict(first=3, timestamp=2000 * 1000, duration=1000 * 1000),
+        ]),
+        frag_timescale=1000,
+    )
+
+def flv_tag(type, timestamp, data):
+    header = bytes((type,)) + len(data).to_bytes(3, "big")
+    header += timestamp.to_bytes(3, "big") + bytes(1 + 3)
+    return header + data + (len(header) + len(data)).to_bytes(4, "big")
+
+def mdat_box(data):
+    return box(b"mdat", data)
+
+def box(type, data):
+    return (8 + len(data)).to_bytes(4, "big") + type + data
+
+class DummyFrontend:
+    def set_fraction(self, fraction):
+        pass
+    def set_size(self, size):
+        pass
+    def set_latency(self, latency):
+        pass
+
 class TestGui(TestCase):
     def setUp(self):
         path = os.path.join(os.path.dirname(__file__), "iview-gtk")
@@ -247,6 +1553,451 @@ class TestLoopbackHttp(TestPersistentHttp):
         self.assertEqual(1, self.handle_calls,
             "Server handle() retried for POST")
 
+class TestFragmentRetry(TestCase):
+    def setUp(self):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from threading import Thread
+        
+        self.ranges = list()
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_GET(handler):
+                body = b"0123456789"
+                range = handler.headers["Range"]
+                self.ranges.append(range)
+                if range is None:
+                    # Drop the connection half way through the body
+                    handler.send_response(200)
+                    handler.send_header("Content-Type", "video/f4f")
+                    handler.send_header("Content-Length", format(len(body)))
+                    handler.end_headers()
+                    handler.wfile.write(body[:5])
+                    handler.close_connection = True
+                else:
+                    start = int(range[len("bytes="):-len("-")])
+                    handler.send_response(206)
+                    handler.send_header("Content-Type", "video/f4f")
+                    handler.send_header("Content-Length",
+                        format(len(body) - start))
+                    handler.end_headers()
+                    handler.wfile.write(body[start:])
+            
+            def log_message(*pos, **kw):
+                pass
+        
+        server = HTTPServer(("localhost", 0), RequestHandler)
+        self.addCleanup(server.server_close)
+        self.url = "http://localhost:{}/".format(server.server_port)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+    
+    def test_range(self):
+        """Test a dropped fragment continues with a Range request"""
+        import iview.hds
+        pool = iview.utils.ConnectionPoolHandler()
+        self.addCleanup(pool.close)
+        session = urllib.request.build_opener(pool)
+        stats = dict(retries=0, saved=0)
+        with substattr(sys, "stderr", TextIOWrapper(BytesIO())), \
+        iview.hds.FragmentReader(session, self.url, stats=stats,
+        delay=0) as frag:
+            self.assertEqual(b"0123456789", frag.read())
+        self.assertEqual([None, "bytes=5-"], self.ranges)
+        self.assertEqual(dict(retries=1, saved=5), stats)
+
+class TestHostProbe(TestCase):
+    def test_probe(self):
+        """Connect latency and throughput are measured"""
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from threading import Thread
+        import iview.comm
+        import socket
+        
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                handler.send_response(404)
+                handler.send_header("Content-Length", "1000")
+                handler.end_headers()
+                handler.wfile.write(bytes(1000))
+            def log_message(*pos, **kw):
+                pass
+        server = HTTPServer(("localhost", 0), RequestHandler)
+        self.addCleanup(server.server_close)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        
+        url = "http://localhost:{}/".format(server.server_port)
+        result = iview.comm.probe_host("local", url)
+        self.assertEqual("local", result["host"])
+        self.assertIsNotNone(result["latency"])
+        self.assertGreater(result["throughput"], 0)
+        
+        with socket.socket() as unused:
+            unused.bind(("localhost", 0))
+            port = unused.getsockname()[1]
+        result = iview.comm.probe_host("closed",
+            "rtmp://localhost:{}/ondemand".format(port))
+        self.assertIsNone(result["latency"])
+        self.assertIsNotNone(result["error"])
+    
+    def test_rank(self):
+        """Hosts are ranked by throughput, then latency, and cached"""
+        import iview.comm
+        import iview.config
+        
+        probed = list()
+        results = dict(
+            slow=dict(latency=0.01, throughput=100),
+            fast=dict(latency=0.05, throughput=500),
+            rtmp=dict(latency=0.02, throughput=None),
+            down=dict(latency=None, throughput=None),
+        )
+        def probe_host(name, url):
+            probed.append(name)
+            return dict(results[name], host=name, error=None,
+                time=iview.comm.monotonic())
+        hosts = dict((name, dict(bwtest="http://" + name + "/",
+            server="http://" + name + "/")) for name in results)
+        auth = dict(free=False)
+        
+        with substattr(iview.comm, probe_host), \
+        substattr(iview.comm, "host_probes", dict()), \
+        substattr(iview.config, "stream_hosts", hosts):
+            ranking = [probe["host"] for probe in iview.comm.probe_hosts()]
+            self.assertEqual(["fast", "slow", "rtmp", "down"], ranking)
+            self.assertEqual("fast", iview.comm.fastest_host(auth))
+            self.assertCountEqual(results, probed, "Results not cached")
+            
+            del probed[:]
+            with substattr(iview.config, "host_probe_ttl", 0):
+                iview.comm.probe_hosts()
+            self.assertCountEqual(results, probed)
+            
+            for name in ("fast", "slow", "rtmp"):
+                del hosts[name]
+            self.assertIsNone(iview.comm.fastest_host(auth))
+    
+    def test_eligible(self):
+        """Only HDS hosts usable with the connection are picked"""
+        import iview.comm
+        import iview.config
+        
+        throughput = dict(rtmp=900, unmetered=500, metered=100)
+        def probe_host(name, url):
+            return dict(host=name, latency=0.01, error=None,
+                throughput=throughput[name], time=iview.comm.monotonic())
+        hosts = dict(
+            rtmp=dict(server="rtmp://rtmp/", bwtest="rtmp://rtmp/"),
+            unmetered=dict(server="http://unmetered/",
+                bwtest="http://unmetered/", unmetered=True),
+            metered=dict(server="http://metered/", bwtest="http://metered/"),
+        )
+        with substattr(iview.comm, probe_host), \
+        substattr(iview.comm, "host_probes", dict()), \
+        substattr(iview.config, "stream_hosts", hosts):
+            self.assertEqual("metered",
+                iview.comm.fastest_host(dict(free=False)))
+            self.assertEqual("unmetered",
+                iview.comm.fastest_host(dict(free=True)))
+
+class TestResponseCache(TestCase):
+    CONFIG = (b'<config>'
+        b'<param name="server_streaming" value="rtmp://stream/ondemand"/>'
+        b'<param name="server_fallback" value="rtmp://fallback/ondemand"/>'
+        b'<param name="categories" value="categories.xml"/>'
+        b'<param name="auth" value="http://auth/"/>'
+        b'<param name="api" value="http://api/"/>'
+        b'<param name="captions" value="http://captions/"/>'
+    b'</config>')
+    AUTH = (b'<iview xmlns='
+            b'"http://www.abc.net.au/iView/Services/iViewHandshaker">'
+        b'<server>http://server/</server><path>path/</path>'
+        b'<tokenhd>token</tokenhd><free>yes</free>'
+    b'</iview>')
+    
+    def setUp(self):
+        import iview.comm
+        import iview.config
+        
+        self.fetched = list()
+        def maybe_fetch(url, type=None, headers=()):
+            self.fetched.append(url)
+            return self.CONFIG
+        def fetch_url(url, types=None, headers=()):
+            self.fetched.append(url)
+            return self.AUTH
+        dir = TemporaryDirectory()
+        self.addCleanup(dir.cleanup)
+        for [obj, attr, value] in (
+            (iview.comm, "maybe_fetch", maybe_fetch),
+            (iview.comm, "fetch_url", fetch_url),
+            (iview.comm, "response_cache", dict()),
+            (iview.comm, "iview_config", None),
+            (iview.config, "response_cache_dir", dir.name),
+            (iview.config, "cache_auth", False),
+            (iview.config, "ip", None),
+            (iview.config, "override_host", None),
+        ):
+            context = substattr(obj, attr, value)
+            context.__enter__()
+            self.addCleanup(context.__exit__, None, None, None)
+    
+    def test_config(self):
+        """Config is reused in memory and from disk until it expires"""
+        import iview.comm
+        import iview.config
+        
+        iview.comm.get_config()
+        iview.comm.get_config()
+        self.assertEqual([iview.config.config_url], self.fetched)
+        self.assertEqual("http://auth/", iview.comm.iview_config["auth_url"])
+        self.assertIn("headers", iview.comm.iview_config)
+        
+        iview.comm.response_cache.clear()  # As for a new process
+        iview.comm.get_config()
+        self.assertEqual(1, len(self.fetched), "Not saved to disk")
+        self.assertEqual("http://auth/", iview.comm.iview_config["auth_url"])
+        
+        iview.comm.response_cache.clear()
+        with substattr(iview.config, "config_ttl", 0):
+            iview.comm.get_config()
+        self.assertEqual(2, len(self.fetched))
+        
+        with substattr(iview.config, "refresh", True):
+            iview.comm.get_config()
+        self.assertEqual(3, len(self.fetched))
+    
+    def test_auth(self):
+        """Auth is reused per IP address until expired or forgotten"""
+        import iview.comm
+        import iview.config
+        from iview.fetch import auth_check
+        from urllib.error import HTTPError
+        
+        iview.comm.get_config()
+        del self.fetched[:]
+        auth = iview.comm.get_auth()
+        auth["tokenhd"] = None  # Caller should not alter the cache
+        self.assertEqual("token", iview.comm.get_auth()["tokenhd"])
+        self.assertEqual(["http://auth/"], self.fetched)
+        
+        with substattr(iview.config, "ip", "192.0.2.1"):
+            iview.comm.get_auth()
+        self.assertEqual(2, len(self.fetched))
+        
+        iview.comm.response_cache.clear()
+        iview.comm.get_auth()
+        self.assertEqual(3, len(self.fetched), "Not kept only in memory")
+        
+        error = HTTPError("http://server/", 403, "Forbidden", dict(), None)
+        with self.assertRaises(HTTPError), auth_check():
+            raise error
+        iview.comm.get_auth()
+        self.assertEqual(4, len(self.fetched), "Not forgotten after 403")
+        
+        iview.comm.response_cache.clear()
+        with substattr(iview.config, "cache_auth", True):
+            iview.comm.get_auth()
+            iview.comm.response_cache.clear()
+            iview.comm.get_auth()
+            self.assertEqual(5, len(self.fetched), "Not saved to disk")
+            
+            # As for a shard download without the config loaded
+            with substattr(iview.comm, "iview_config", None):
+                iview.comm.forget_auth()
+            iview.comm.get_auth()
+        self.assertEqual(6, len(self.fetched), "Not forgotten on disk")
+
+class TestHedge(TestCase):
+    def test_hedge(self):
+        """Test a slow request is repeated and the first response used"""
+        import iview.hds
+        from threading import Event
+        
+        policy = iview.hds.HedgePolicy(50, min_samples=3)
+        self.addCleanup(policy.close)
+        for _ in range(3):
+            self.assertEqual("fast", policy.open(lambda: "fast"))
+        self.assertEqual(0, policy.hedged)
+        
+        release = Event()
+        closed = Event()
+        class SlowResponse:
+            def close(self):
+                closed.set()
+        requests = list()
+        def request():
+            requests.append(None)
+            if len(requests) > 1:
+                return "hedge"
+            release.wait()
+            return SlowResponse()
+        self.assertEqual("hedge", policy.open(request))
+        release.set()
+        self.assertTrue(closed.wait(10))
+        self.assertEqual(2, len(requests))
+        self.assertEqual((4, 1, 1),
+            (policy.requests, policy.hedged, policy.won))
+    
+    def test_busy_pool(self):
+        """A duplicate request is not queued behind busy first requests"""
+        import iview.hds
+        from threading import Event, Thread
+        
+        policy = iview.hds.HedgePolicy(50, min_samples=3, parallel=1)
+        self.addCleanup(policy.close)
+        for _ in range(3):
+            policy.open(lambda: "fast")
+        release = Event()
+        self.addCleanup(release.set)
+        for _ in range(2):  # Fill the pool with stalled requests
+            policy.executor.submit(release.wait, 10)
+        
+        closed = Event()
+        class SlowResponse:
+            def close(self):
+                closed.set()
+        def request():
+            if release.is_set():
+                return SlowResponse()
+            return "hedge"
+        result = list()
+        thread = Thread(target=lambda: result.append(policy.open(request)))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(["hedge"], result)
+        release.set()
+        self.assertTrue(closed.wait(10))
+
+class TestHostStriper(TestCase):
+    def test_weights(self):
+        """Fragments are spread by throughput, avoiding failed hosts"""
+        import iview.hds
+        from collections import Counter
+        
+        striper = iview.hds.HostStriper("http://a/media/",
+            ["http://b/", "http://a/"])
+        self.assertEqual({"http://a/media/", "http://b/media/"},
+            {striper.url(index) for index in range(2)})
+        striper.record("http://a/media/Seg1-Frag1", 3000, 1)
+        striper.record("http://b/media/Seg1-Frag2", 1000, 1)
+        hosts = Counter(striper.url(index) for index in range(40))
+        self.assertEqual({"http://a/media/": 30, "http://b/media/": 10},
+            hosts)
+        
+        self.assertEqual("http://b/media/Seg1-Frag3?pv",
+            striper.failed("http://a/media/Seg1-Frag3?pv"))
+        self.assertEqual({"http://b/media/"},
+            {striper.url(index) for index in range(5)})
+        self.assertIsNone(striper.failed("http://b/media/Seg1-Frag4"))
+        striper.cooldown = 0
+        self.assertEqual({"http://a/media/", "http://b/media/"},
+            {striper.url(index) for index in range(5)})
+    
+    def test_fetch(self):
+        """A striped download is the same as from one host"""
+        import iview.hds
+        
+        requested = list()
+        def get_frag(session, url, seg, frag, player="", striper=None,
+        **kw):
+            requested.append(url)
+            return BytesIO(mdat_box(flv_tag(9, (frag - 1) * 1000,
+                bytes((0x27, 1)) + b"frame")))
+        
+        output = list()
+        for stripe in (None, ["http://mirror/"]):
+            flv = BytesIO()
+            with substattr(iview.hds, get_frag), \
+            substattr(iview.hds, "get_manifest", dummy_manifest), \
+            substattr(iview.hds, "get_bootstrap", dummy_bootstrap), \
+            substattr(sys, "stderr", TextIOWrapper(BytesIO())):
+                iview.hds.fetch("http://localhost/manifest.f4m",
+                    dest_file=flv, frontend=DummyFrontend(), stripe=stripe)
+            output.append(flv.getvalue())
+        self.assertEqual(output[0], output[1])
+        self.assertEqual(["http://localhost/media"] * 3 +
+            ["http://localhost/media", "http://mirror/media",
+            "http://localhost/media"], requested)
+    
+    def test_content_type(self):
+        """A host returning the wrong content type is switched from"""
+        import iview.hds
+        from email.message import Message
+        
+        requested = list()
+        class Session:
+            def open(self, req):
+                requested.append(req.full_url)
+                response = BytesIO(b"fragment")
+                response.status = 200
+                response.geturl = lambda: req.full_url
+                headers = Message()
+                if req.full_url.startswith("http://bad/"):
+                    headers["Content-Type"] = "text/html"
+                else:
+                    headers["Content-Type"] = "video/f4f"
+                response.info = lambda: headers
+                return response
+        
+        striper = iview.hds.HostStriper("http://bad/media/",
+            ["http://good/"])
+        with substattr(sys, "stderr", TextIOWrapper(BytesIO())), \
+        iview.hds.FragmentReader(Session(), "http://bad/media/Seg1-Frag1",
+        striper=striper, delay=0) as frag:
+            self.assertEqual(b"fragment", frag.read())
+        self.assertEqual(["http://bad/media/Seg1-Frag1",
+            "http://good/media/Seg1-Frag1"], requested)
+        self.assertEqual(1, striper.failures[("http", "bad")])
+        self.assertIn(("http", "good"), striper.throughput)
+
+class TestWriteBehind(TestCase):
+    def test_commit(self):
+        """Commit actions run once earlier writes are in the file"""
+        from iview.utils import WriteBehindFile
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            path = os.path.join(dir, "file")
+            committed = list()
+            def check():
+                with open(path, "rb") as file:
+                    committed.append(file.read())
+            with open(path, "wb") as file, \
+            WriteBehindFile(file, limit=4, fsync="fragment") as writer:
+                writer.preallocate(1000)
+                writer.write(b"first ")
+                writer.write(memoryview(bytearray(b"fragment")))
+                writer.commit(check)
+                writer.write(b"partial")
+                self.assertEqual(21, writer.tell())
+                writer.seek(14)
+                writer.truncate()
+                writer.write(b"second")
+                writer.commit(check)
+            self.assertEqual(b"first fragment", committed[0][:14])
+            self.assertEqual(b"first fragmentsecond", committed[1][:20])
+            with open(path, "rb") as file:
+                self.assertEqual(b"first fragmentsecond", file.read())
+    
+    def test_error(self):
+        """Errors in the writer thread are raised by later calls"""
+        from iview.utils import WriteBehindFile
+        class BrokenFile(BytesIO):
+            def write(self, b):
+                raise OSError("Disk on fire")
+        writer = WriteBehindFile(BrokenFile(), limit=1000)
+        writer.write(b"data")
+        with self.assertRaises(OSError):
+            writer.flush()
+        with self.assertRaises(OSError):
+            writer.write(b"data")
+        with self.assertRaises(OSError):
+            writer.close()
+
 class TestMockHttp(TestPersistentHttp):
     def setUp(self):
         super().setUp()
@@ -310,6 +2061,63 @@ class TestHttpSocket(TestMockHttp):
             pass
         self.assertEqual("mock://localhost/", response.geturl())
 
+class TestHttpPool(TestCase):
+    class HTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = TestHttpSocket.Socket(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Length: 6\r\n"
+                b"\r\n"
+                b"body\r\n" * 2
+            )
+    
+    def setUp(self):
+        self.pool = iview.utils.ConnectionPoolHandler(per_host=2)
+        self.addCleanup(self.pool.close)
+        self.pool.conn_classes = dict(self.pool.conn_classes)
+        self.pool.conn_classes["mock"] = self.HTTPConnection
+        self.session = urllib.request.build_opener(self.pool)
+    
+    def test_concurrent(self):
+        """Test simultaneous requests to one host use separate connections"""
+        one = self.session.open("mock://localhost/one")
+        two = self.session.open("mock://localhost:80/two")
+        entries = self.pool._pool[("mock", "localhost", 80)]
+        self.assertEqual(2, len(entries))
+        self.assertIsNot(entries[0]["connection"], entries[1]["connection"])
+        with one, two:
+            self.assertEqual(b"body\r\n", one.read())
+            self.assertEqual(b"body\r\n", two.read())
+        
+        with self.session.open("mock://localhost/three") as response:
+            self.assertEqual(b"body\r\n", response.read())
+        self.assertEqual(2, len(entries), "Connection not reused")
+    
+    def test_late_close(self):
+        """Closing a finished response does not release the connection
+        once another request is using it"""
+        first = self.session.open("mock://localhost/one")
+        self.assertEqual(b"body\r\n", first.read())
+        second = self.session.open("mock://localhost/two")
+        first.close()
+        third = self.session.open("mock://localhost/three")
+        first.close()
+        entries = self.pool._pool[("mock", "localhost", 80)]
+        self.assertTrue(all(entry["busy"] for entry in entries))
+        with second, third:
+            self.assertEqual(b"body\r\n", second.read())
+            self.assertEqual(b"body\r\n", third.read())
+    
+    def test_hosts(self):
+        """Test a second host does not close the first connection"""
+        with self.session.open("mock://localhost/one") as response:
+            response.read()
+        with self.session.open("mock://otherhost/two") as response:
+            response.read()
+        [entry] = self.pool._pool[("mock", "localhost", 80)]
+        self.assertTrue(entry["connection"].sock.reader,
+            "First connection closed")
+
 class TestHttpEstablishError(TestMockHttp):
     """Connection establishment errors should not trigger a retry"""
     class HTTPConnection(http.client.HTTPConnection):
@@ -344,7 +2152,9 @@ class TestProxy(TestCase):
         import socket as socketmod
         def socket(*pos, **kw):
             raise self.DirectSocket("socket.socket() called")
-        with substattr(socketmod, socket):
+        with substattr(socketmod, socket), \
+        substattr(iview.config, "response_cache_dir", None), \
+        substattr(iview.comm, "response_cache", dict()):
             return TestCase.run(self, *pos, **kw)
     
     def test_patching(self):
@@ -413,5 +2223,8 @@ def load_script(path, name):
                 ("", "rb", imp.PY_SOURCE))
 
 if __name__ == "__main__":
-    import unittest
-    unittest.main()
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark_scriptdata()
+    else:
+        import unittest
+        unittest.main()